@@ -3,7 +3,7 @@ import logging
 import os
 import sys
 
-from sensor import utils, workflow
+from sensor import dbformat, imaging, sqlstore, utils, workflow
 from sensor.gui.canbus import gui_app as can_gui
 from sensor.gui.vents import app as vents_gui
 from sensor.gui.picam import hosted as picamera_gui
@@ -34,6 +34,17 @@ def process_command():
     subparsers.add_parser("vents", help="Simple gui for testing vents and gpio")
     subparsers.add_parser("cangui", help="Simple gui for testing CAN bus messaging")
     subparsers.add_parser("picamera", help="Use PiCameraApp gui to capture photos & control vents")
+    pack_parser = subparsers.add_parser("pack", help="Pack folder of sample images into memory-mapped stack")
+    pack_parser.add_argument("sample_dir")
+    convert_parser = subparsers.add_parser("convertdb", help="Convert db directory between text and binary format")
+    convert_parser.add_argument("db_dir")
+    convert_parser.add_argument("--to", choices=["binary", "text"], default="binary")
+    query_parser = subparsers.add_parser("querydb", help="Find snaps in sqlite stores of all db directories")
+    query_parser.add_argument("--time-from", type=float, default=None, help="Unix time")
+    query_parser.add_argument("--time-to", type=float, default=None, help="Unix time")
+    query_parser.add_argument("--min-particles", type=int, default=None)
+    sbd_parser = subparsers.add_parser("sbd", help="Detect keys of every sample folder in parallel")
+    sbd_parser.add_argument("--workers", type=int, default=None, help="Number of processes, one per cpu by default")
 
     args = parser.parse_args()
     return parser, args
@@ -52,6 +63,20 @@ def main():
         can_gui()
     elif args.cmd == "picamera":
         picamera_gui()
+    elif args.cmd == "pack":
+        print("Packed into %s" % imaging.pack_image_stack(args.sample_dir))
+    elif args.cmd == "convertdb":
+        if args.to == "binary":
+            dbformat.text_to_binary(args.db_dir)
+        else:
+            dbformat.binary_to_text(args.db_dir)
+    elif args.cmd == "querydb":
+        for db_dir, row in sqlstore.query_snaps(time_from=args.time_from, time_to=args.time_to,
+                                                min_particles=args.min_particles):
+            print("%s: %s" % (db_dir, row))
+    elif args.cmd == "sbd":
+        from sensor.detector import runner
+        runner.run_sbd_all(args.workers)
     else:
         parser.print_help()
 
@@ -1,12 +1,13 @@
 import logging
 import struct
+import time
 import traceback
 
 import j1939
 import numpy as np
 
-from sensor import utils, proxy
-from sensor.canbus import transfer, shutdown, state
+from sensor import utils, proxy, dbmanifest
+from sensor.canbus import transfer, shutdown, state, sender
 from sensor.canbus.requests import REQUEST
 
 TRANSFER = transfer.TRANSFER
@@ -18,6 +19,11 @@ logging.getLogger('can').setLevel(logging.INFO)
 DEFAULT_DEVICE_ADDR = 10
 STANDARD_SEND_DELAY = 1.0
 MIN_SEND_DELAY = 0.1
+# [s] between packets of TP broadcasts until bulk transfer paces them, 50 ms by default of j1939
+TP_BAM_INTERVAL = 0.01
+# attempts to start a TP message while the previous BAM is being sent,
+# wait between them doubles from the frame delay, so they outlast a BAM of 255 packets
+TP_RETRIES = 10
 
 """
 The interpretation of the PDU specific (PS) field changes based on the PF value:
@@ -46,6 +52,11 @@ def get_mid(priority, pgn, addr):
     return mid
 
 
+def set_bam_interval(ecu, interval):
+    # j1939 2.0 ignores minimum_tp_bam_dt_interval given to ElectronicControlUnit
+    ecu.j1939_dll._minimum_tp_bam_dt_interval = interval
+
+
 def init_app(device_addr=DEFAULT_DEVICE_ADDR, client_mode=False):
     name = j1939.Name(
         arbitrary_address_capable=1,
@@ -60,6 +71,7 @@ def init_app(device_addr=DEFAULT_DEVICE_ADDR, client_mode=False):
     )
 
     ecu = j1939.ElectronicControlUnit()
+    set_bam_interval(ecu, TP_BAM_INTERVAL)
     ecu.connect(bustype=proxy.bustype, channel='can0')
 
     cnt = CanApp(name, device_addr, client_mode=client_mode)
@@ -79,6 +91,7 @@ class CanApp(j1939.ControllerApplication):
         self.shutdown_handler = shutdown.ShutdownHandler(self)
         self.transfer_handler = transfer.TransferHandler(self)
         self.state_handler = state.StateHandler(self)
+        self.sender = sender.Sender(self.state_handler.pacer)
 
         self.priority = 6
 
@@ -86,13 +99,46 @@ class CanApp(j1939.ControllerApplication):
             self, name, device_address_preferred)
 
     def cmd_req(self, msg):
-        self.send_message(self.priority, PGN.REQUEST, msg)
+        self.sender.send(sender.CONTROL, self.send_message, self.priority, PGN.REQUEST, msg)
 
     def cmd_res(self, msg):
-        self.send_message(self.priority, PGN.RESPONSE, msg)
+        self.sender.send(sender.CONTROL, self.send_message, self.priority, PGN.RESPONSE, msg)
+
+    def cmd_res_data(self, msg):
+        """ Response of transferred file data, sent after control messages and states """
+        self.sender.send(sender.BULK, self.send_message, self.priority, PGN.RESPONSE, msg)
+
+    def cmd_req_bulk(self, msg, on_failed=None):
+        # PGN.REQUEST
+        self.sender.call(sender.CONTROL, self.send_tp, 0x65, msg, on_failed)
+
+    def cmd_res_bulk(self, msg, on_failed=None):
+        # PGN.RESPONSE
+        self.sender.call(sender.BULK, self.send_tp, 0x66, msg, on_failed)
+
+    def send_tp(self, pdu_specific, msg, on_failed=None):
+        """
+            Message longer than a frame, sent by transport protocol from the sender thread.
+            on_failed() is called from the sender thread when transport protocol stays busy.
+        """
+        pacer = self.state_handler.pacer
+        backoff = pacer.delay
+        for _ in range(TP_RETRIES):
+            # TP packets are paced like single frames
+            set_bam_interval(self._ecu, pacer.delay)
+            pacer.wait()
+            if self.send_pgn(0, 0xFF, pdu_specific, self.priority, list(msg)):
+                return True
+            time.sleep(backoff)
+            backoff *= 2
+        print("Couldn't send message, transport protocol is busy")
+        pacer.on_error()
+        if on_failed is not None:
+            on_failed()
+        return False
 
     def cmd_state(self, msg):
-        self.send_message(self.priority, PGN.STATE, msg)
+        self.sender.send(sender.STATE, self.send_message, self.priority, PGN.STATE, msg)
 
     def cmd_set_send_states(self, value):
         self.cmd_req([REQUEST.SET_SEND_STATES, value])
@@ -115,8 +161,13 @@ class CanApp(j1939.ControllerApplication):
     def cmd_get_que_length(self):
         self.cmd_req([REQUEST.GET_QUE_LENGTH, 0])
 
-    def cmd_get_file(self, arg_id):
-        self.cmd_req([REQUEST.GET_FILE, arg_id])
+    def cmd_get_file(self, arg_id, modes=transfer.SUPPORTED_MODES):
+        msg = bytes([REQUEST.GET_FILE, arg_id]) + self.transfer_handler.get_file_data(arg_id, modes)
+        if len(msg) <= 8:
+            self.cmd_req(msg)
+        else:
+            # resume data didn't go through, request the whole file
+            self.cmd_req_bulk(msg, lambda: self.cmd_get_file(arg_id, modes & ~transfer.MODE.RESUME))
 
     def cmd_enum_db(self):
         self.cmd_req([REQUEST.ENUM_DB, 0])
@@ -124,8 +175,8 @@ class CanApp(j1939.ControllerApplication):
     def cmd_clear_db(self, arg_id):
         self.cmd_req([REQUEST.CLEAR_DB, arg_id])
 
-    def cmd_get_bytes(self):
-        self.cmd_req([REQUEST.GET_BYTES, 0])
+    def cmd_get_bytes(self, arg_id=TRANSFER.NEXT):
+        self.cmd_req([REQUEST.GET_BYTES, arg_id])
 
     def request_state(self):
         self.cmd_req([REQUEST.GET_QUE_ITEM, 0])
@@ -143,13 +194,17 @@ class CanApp(j1939.ControllerApplication):
 
     def start(self):
         self._ecu.add_timer(STANDARD_SEND_DELAY, self.timer_callback)
+        self.subscribe(self.on_receive)
+        self.sender.start()
         return j1939.ControllerApplication.start(self)
 
     def stop(self):
         self._ecu.remove_timer(self.timer_callback)
+        self.unsubscribe(self.on_receive)
+        self.sender.stop()
 
     def parse_request_data(self, data):
-        request_id, arg_id, data = data[0:2]
+        request_id, arg_id = data[0:2]
         data = data[2:len(data)]
 
         if not request_id:
@@ -159,6 +214,9 @@ class CanApp(j1939.ControllerApplication):
 
         return request_id, arg_id, data
 
+    def on_receive(self, priority, pgn, sa, timestamp, data):
+        self.on_message(pgn, data)
+
     def on_message(self, pgn, data):
         mid = get_mid(0, pgn, 0)
         _pgn = j1939.ParameterGroupNumber()
@@ -221,16 +279,17 @@ class CanApp(j1939.ControllerApplication):
         elif request_id == REQUEST.SHUTDOWN:
             self.shutdown_handler.process(arg_id)
         elif request_id == REQUEST.ENUM_DB:
-            n_dbs = len(list(utils.Pathing.count_dbs(utils.Pathing.db_root)))
+            # ids of cleared dbs are skipped, so the client enumerates up to the last id
+            n_dbs = dbmanifest.count_ids(utils.Pathing.db_root)
             self.cmd_res([REQUEST.ENUM_DB, min(0xFF, n_dbs)])
         elif request_id == REQUEST.GET_FILE:
-            self.transfer_handler.request_get_file(arg_id)
+            self.transfer_handler.request_get_file(arg_id, data)
         elif request_id == REQUEST.GET_BYTES:
-            self.transfer_handler.request_get_bytes(arg_id)
+            self.transfer_handler.request_get_bytes(arg_id, data)
         elif request_id == REQUEST.CLEAR_DB:
             self.transfer_handler.clear_db(arg_id)
         elif request_id == REQUEST.UPLOAD:
-            self.cmd_req([REQUEST.GET_FILE, TRANSFER.REFLASH])
+            self.cmd_get_file(TRANSFER.REFLASH)
 
     def trigger_on_response(self, request_id, arg_id, data):
         if not self.client_mode and request_id not in REQUEST.TRANSFER:
@@ -249,7 +308,7 @@ class CanApp(j1939.ControllerApplication):
             if arg_id == TRANSFER.OK:
                 print('Shutdown confirmed')
         elif request_id == REQUEST.GET_FILE:
-            self.transfer_handler.response_get_file(arg_id)
+            self.transfer_handler.response_get_file(arg_id, data)
         elif request_id == REQUEST.GET_BYTES:
             self.transfer_handler.response_get_bytes(arg_id, data)
         else:
@@ -267,4 +326,5 @@ class CanApp(j1939.ControllerApplication):
             self.state_handler.callback()
         else:
             self.state_handler.send_state_message()
+        self.transfer_handler.check_timeout()
         return True
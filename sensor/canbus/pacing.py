@@ -0,0 +1,117 @@
+"""
+    Adaptive pacing of sent CAN frames.
+
+    Send rate grows additively while frames go out and acks come back in time,
+    and is cut in half on TX errors, full TX queue, lost frames or slow acks (AIMD).
+"""
+import threading
+import time
+
+import can
+
+# [frames/s] 250 kbit/s bus carries about 1900 extended frames per second
+BUS_FRAME_RATE = 1900
+# [s] delay between frames when sending starts
+START_DELAY = 0.01
+# [frames/s] rate grows by RATE_STEP each second of successful sending
+RATE_STEP = 50
+DECREASE = 0.5
+# [s] rate is cut at most once in this period, errors of one burst count once
+DECREASE_HOLDOFF = 0.2
+# ack is slow when it takes ACK_SLOW_FACTOR times the fastest ack and ACK_SLACK more
+ACK_SLOW_FACTOR = 2
+ACK_SLACK = 0.05
+SEND_RETRIES = 5
+
+
+class Pacer:
+    """ Delay between sent frames within min_delay and max_delay, shared by all senders of the app """
+
+    def __init__(self, min_delay, max_delay):
+        self.lock = threading.Lock()
+        self.rate = 1 / START_DELAY
+        self.set_bounds(min_delay, max_delay)
+        self.next_time = 0
+        self.last_decrease = 0
+        self.block_sent = None
+        self.fastest_ack = None
+        self.n_sent = 0
+        self.n_errors = 0
+        self.n_losses = 0
+        self.n_slow_acks = 0
+
+    def set_bounds(self, min_delay, max_delay):
+        with self.lock:
+            self.max_rate = min(1 / min_delay, BUS_FRAME_RATE) if min_delay > 0 else BUS_FRAME_RATE
+            self.min_rate = min(1 / max(max_delay, 1 / BUS_FRAME_RATE), self.max_rate)
+            self.rate = min(max(self.rate, self.min_rate), self.max_rate)
+
+    @property
+    def delay(self):
+        return 1 / self.rate
+
+    def wait(self):
+        """ Sleep until the next frame may be sent """
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.delay
+        if wait > 0:
+            time.sleep(wait)
+
+    def send(self, send_fn, *args):
+        """ Send with send_fn paced, retried on CAN errors, the last error is raised """
+        for attempt in range(SEND_RETRIES):
+            self.wait()
+            try:
+                send_fn(*args)
+            except can.CanError:
+                self.on_error()
+                if attempt == SEND_RETRIES - 1:
+                    raise
+                continue
+            self.on_sent()
+            return
+
+    def on_sent(self):
+        with self.lock:
+            self.n_sent += 1
+            self.rate = min(self.rate + RATE_STEP / self.rate, self.max_rate)
+
+    def decrease(self):
+        with self.lock:
+            now = time.time()
+            if now - self.last_decrease < DECREASE_HOLDOFF:
+                return
+            self.last_decrease = now
+            self.rate = max(self.rate * DECREASE, self.min_rate)
+
+    def on_error(self):
+        """ TX error or full TX queue """
+        self.n_errors += 1
+        self.decrease()
+
+    def on_loss(self):
+        """ Receiver asked for frames again """
+        self.n_losses += 1
+        self.decrease()
+
+    def on_block_sent(self, duration=0):
+        """ Block is sent, or being sent for duration more """
+        self.block_sent = time.time() + duration
+
+    def on_ack(self):
+        """ Receiver confirmed the last block, ack delay against the fastest one tells a loaded bus """
+        if self.block_sent is None:
+            return
+        ack_delay = max(time.time() - self.block_sent, 0)
+        self.block_sent = None
+        if self.fastest_ack is None or ack_delay < self.fastest_ack:
+            self.fastest_ack = ack_delay
+        elif ack_delay > ACK_SLOW_FACTOR * self.fastest_ack + ACK_SLACK:
+            self.n_slow_acks += 1
+            self.decrease()
+
+    def __str__(self):
+        return 'delay %.1f ms, %d sent, %d errors, %d losses, %d slow acks' % (
+            1000 * self.delay, self.n_sent, self.n_errors, self.n_losses, self.n_slow_acks)
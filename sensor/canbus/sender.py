@@ -0,0 +1,82 @@
+"""
+    Sender thread of outbound CAN traffic, so receive and timer callbacks of j1939 never block on sending.
+"""
+import itertools
+import queue
+import threading
+import time
+import traceback
+
+# priorities of queued messages, lower is sent first
+CONTROL = 0
+STATE = 1
+BULK = 2
+# stop is queued after everything else
+_STOP = 3
+
+# [s] to wait for queued messages to go out before shutdown
+FLUSH_TIMEOUT = 5
+
+
+class Sender:
+    """
+        Messages are sent in the order of priority, control messages first, then states, then bulk data,
+        in the order they were queued within a priority. Frames are paced by pacer.
+    """
+
+    def __init__(self, pacer):
+        self.pacer = pacer
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        # bulk items queued in earlier generations are dropped
+        self.generation = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='can sender', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.put(_STOP, False, None)
+            self.thread.join()
+            self.thread = None
+
+    def put(self, priority, paced, fn, *args):
+        self.queue.put((priority, next(self.counter), self.generation, paced, fn, args))
+
+    def send(self, priority, send_fn, *args):
+        """ Queue a frame sent by send_fn(*args) """
+        self.put(priority, True, send_fn, *args)
+
+    def call(self, priority, fn, *args):
+        """ Queue fn(*args) to run once the messages queued before it with the same priority are sent """
+        self.put(priority, False, fn, *args)
+
+    def drop_bulk(self):
+        """ Drop bulk items queued so far, e.g. blocks of a transfer that was replaced or cancelled """
+        self.generation += 1
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        end = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < end:
+            time.sleep(0.01)
+
+    def run(self):
+        while True:
+            priority, _, generation, paced, fn, args = self.queue.get()
+            try:
+                if fn is None:
+                    return
+                if priority == BULK and generation != self.generation:
+                    continue
+                if paced:
+                    self.pacer.send(fn, *args)
+                else:
+                    fn(*args)
+            except Exception:
+                print("Error sending CAN message with priority %d" % priority)
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
@@ -53,6 +53,7 @@ class ShutdownHandler:
                 if not self.sent_shutdown:
                     self.can_app.cmd_res([REQUEST.SHUTDOWN, TRANSFER.OK])
                     self.sent_shutdown = True
+                    self.can_app.sender.flush()
                 if self.shutdown_type == SHUTDOWN_TYPE.SHUTDOWN:
                     os.system('shutdown now')
                     os.system('systemctl poweroff -i')
@@ -65,3 +66,5 @@ class ShutdownHandler:
                 else:
                     os.system('reboot')
                 return False
+        # timer of the app keeps running
+        return True
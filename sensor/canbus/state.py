@@ -2,18 +2,16 @@ import collections
 import os
 import struct
 import threading
-import time
 import traceback
 
-import can
 import numpy as np
 
 from sensor import settings, utils
+from sensor.canbus import pacing
 from sensor.canbus.requests import REQUEST
 from sensor.canbus.transfer import TRANSFER
 
 QUEUE_MAX_LEN = 300
-ERROR_SEND_DELAY = 3
 
 
 class StateHandler:
@@ -22,10 +20,13 @@ class StateHandler:
         1: 'param_2',
         2: 'param_1_th',
         3: 'param_2_th',
-        4: 'min_delay'
+        4: 'min_delay',
+        5: 'max_delay',
+        # current delay of the pacer, read only
+        6: 'send_delay'
     }
 
-    allow_set = {2, 3, 4}
+    allow_set = {2, 3, 4, 5}
 
     def get_default_buffer(self):
         return [None] * 9
@@ -44,6 +45,11 @@ class StateHandler:
         self.param_1_th = np.float32(config['param_1_th'])
         self.param_2_th = np.float32(config['param_2_th'])
         self.min_delay = np.float32(config['min_delay'])
+        self.max_delay = np.float32(config['max_delay'])
+        if self.min_delay > self.max_delay:
+            print("min_delay %.3f is over max_delay %.3f, using it for both" % (self.min_delay, self.max_delay))
+            self.max_delay = self.min_delay
+        self.pacer = pacing.Pacer(self.min_delay, self.max_delay)
         self.n_particles = 0
 
         self.que_items_ready_to_fetch = 0
@@ -55,6 +61,10 @@ class StateHandler:
         self.vents_ok = 0xFF
         self.ready = 0
 
+    @property
+    def send_delay(self):
+        return self.pacer.delay
+
     def send_queue_item(self, request_id):
         try:
             with self.data_lock:
@@ -112,12 +122,18 @@ class StateHandler:
                 print('Error - empty data')
                 return
             value = struct.unpack('>f', data)[0]
-            if value < 0 and param_name == 'min_delay':
-                raise ValueError("Subzero param value")
+            if param_name in ('min_delay', 'max_delay'):
+                if value < 0:
+                    raise ValueError("Subzero param value")
+                bounds = {'min_delay': self.min_delay, 'max_delay': self.max_delay, param_name: value}
+                if bounds['min_delay'] > bounds['max_delay']:
+                    raise ValueError("min_delay %.3f is over max_delay %.3f" % (bounds['min_delay'],
+                                                                             bounds['max_delay']))
             print('Setting %s=%.3f from 0x%s' %
                   (param_name, value, bytearray(data).hex()))
             with self.data_lock:
                 setattr(self, param_name, value)
+            self.pacer.set_bounds(self.min_delay, self.max_delay)
             self.set_config_key(param_name, value)
             self.can_app.cmd_res([REQUEST.SET_PARAM, TRANSFER.OK])
         except Exception:
@@ -185,15 +201,10 @@ class StateHandler:
     def callback(self):
         if self.send_requests:
             if self.que_items_ready_to_fetch > 0:
+                # requests are paced by the sender thread
                 for _ in range(self.que_items_ready_to_fetch):
                     self.can_app.request_state()
-                    time.sleep(self.min_delay)
                 self.que_items_ready_to_fetch = 0
             else:
-                try:
-                    self.can_app.cmd_get_que_length()
-                    self.can_app.request_state()
-                except can.CanError:
-                    print("Error sending state request")
-                    time.sleep(ERROR_SEND_DELAY)
-                    traceback.print_exc()
+                self.can_app.cmd_get_que_length()
+                self.can_app.request_state()
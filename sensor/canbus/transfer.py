@@ -1,70 +1,143 @@
 import binascii
+import lzma
 import math
 import os
 import struct
 import time
 import shutil
 import traceback
+import zlib
 
 from sensor.canbus.requests import REQUEST
-from sensor.canbus import flashing
-from sensor import utils
+from sensor.canbus import flashing, sender
+from sensor import utils, dbformat, sqlstore, dbmanifest
+
+# raw bytes read from the file at once by compressed transfers
+COMPRESS_READ_SIZE = 4096
+ZLIB_LEVEL = 9
+# [s] without frames of the transfer before the receiver asks again
+RX_TIMEOUT = 5
+# timeouts in a row before the receiver gives the transfer up
+RX_RETRIES = 3
 
 
 class TransferHandler:
+    """
+        File transfer between the receiver, which requests a file with GET_FILE and its blocks with GET_BYTES,
+        and the sender, which responds with the blocks.
+        Blocks are sent in chunks of single frames or, in bulk mode, as one J1939 TP (BAM) message each.
+    """
+
     def __init__(self, can_app):
         self.can_app = can_app
         self.file_tx = None
         self.file_rx = None
+        self.mode = MODE.CHUNKED
+        # receiver: id and modes of the requested file, to request it again after timeouts
+        self.rx_request = None
+        self.last_rx = 0
+        self.rx_timeouts = 0
+
+    @property
+    def pacer(self):
+        return self.can_app.state_handler.pacer
 
     def send_block(self):
         crc32 = self.file_tx.get_crc32()
         packed_crc = struct.pack('>L', crc32)
+        if self.mode & MODE.BULK:
+            self.send_bulk(packed_crc + self.file_tx.block)
+            return
+        if self.mode & MODE.SEQUENCED:
+            self.send_sequenced(range(self.file_tx.count_chunks()))
+            return
         self.send_chunk(TRANSFER.CHECKSUM, packed_crc)
         n_chk = self.file_tx.count_chunks()
         for chk in self.file_tx.read_chunks():
             self.send_chunk(n_chk, chk)
-            time.sleep(self.can_app.min_delay)
+        self.can_app.sender.call(sender.BULK, self.pacer.on_block_sent)
+
+    def send_sequenced(self, indices):
+        """ Send chunks of the block by their index, followed by block CRC32 and number of chunks """
+        for i in indices:
+            self.send_chunk(i + 1, self.file_tx.get_chunk(i))
+        packed_crc = struct.pack('>L', self.file_tx.get_crc32())
+        self.send_chunk(TRANSFER.CHECKSUM, packed_crc + bytes([self.file_tx.count_chunks()]))
+        self.can_app.sender.call(sender.BULK, self.pacer.on_block_sent)
 
     def send_chunk(self, n_chk, data):
+        # chunks are queued by the sender thread, so callbacks don't wait for the block to go out
         msg = bytes([REQUEST.GET_BYTES, n_chk]) + data
-        self.can_app.cmd_res(msg)
-
-    def request_get_file(self, arg_id):
-        db_id = arg_id
-        if db_id == TRANSFER.REFLASH:
-            db_path = flashing.FLASH_OUT_PATH
-        else:
-            db_path = os.path.join(utils.Pathing.codes_root, 'transfer', str(db_id), 'snaps.db')
-        self.file_rx = FileRx(db_path)
-        self.can_app.cmd_get_bytes()
-
-    def request_get_bytes(self, arg_id):
-        # on get bytes request send get bytes response
+        self.can_app.cmd_res_data(msg)
+
+    def send_bulk(self, data):
+        msg = bytes([REQUEST.GET_BYTES, TRANSFER.BULK]) + data
+        file_tx = self.file_tx
+        self.can_app.cmd_res_bulk(msg, lambda: self.on_bulk_failed(file_tx, data))
+        self.can_app.sender.call(sender.BULK, self.on_bulk_sent, len(msg))
+
+    def on_bulk_failed(self, file_tx, data):
+        # transport protocol stayed busy, send the block again unless the transfer moved on
+        self.pacer.on_loss()
+        if file_tx is not None and file_tx is self.file_tx:
+            self.send_bulk(data)
+
+    def on_bulk_sent(self, n_bytes):
+        # packets are sent by j1939 in the background
+        self.pacer.on_block_sent(math.ceil(n_bytes / 7) * self.pacer.delay)
+
+    def request_get_file(self, arg_id, data=b''):
+        # sender: open the file and respond with transfer mode supported by both sides
+        db_path = None
         try:
             db_id = arg_id
             if db_id == TRANSFER.REFLASH:
                 db_path = flashing.FLASH_IN_PATH
+            elif db_id == TRANSFER.MANIFEST:
+                db_path = dbmanifest.manifest_path(utils.Pathing.db_root)
             else:
-                db_path = os.path.join(utils.Pathing.codes_root, 'dbs', str(db_id), 'snaps.db')
-            self.file_tx = FileTx(db_path)
-            self.can_app.cmd_res([REQUEST.GET_FILE, db_id])
+                db_dir = os.path.join(utils.Pathing.db_root, str(db_id))
+                db_path = dbformat.find_db(db_dir, 'snaps')
+                if not os.path.isfile(db_path) and sqlstore.has_store(db_dir):
+                    db_path = sqlstore.export_snaps(db_dir)
+            # clients without mode flags use chunks
+            self.mode = negotiate_mode(data[0] if len(data) else MODE.CHUNKED)
+            block_size = TRANSFER.BULK_BLOCK_SIZE if self.mode & MODE.BULK else TRANSFER.BLOCK_SIZE
+            offset = resume_offset(db_path, data) if self.mode & MODE.RESUME else 0
+            if self.file_tx:
+                self.file_tx.close()
+            # blocks of the previous transfer aren't sent anymore
+            self.can_app.sender.drop_bulk()
+            self.file_tx = FileTx(db_path, block_size, get_codec(self.mode), offset)
+            msg = bytes([REQUEST.GET_FILE, db_id, self.mode])
+            if self.mode & MODE.RESUME:
+                msg += struct.pack('>L', offset)
+            self.can_app.cmd_res(msg)
         except Exception:
             print("Couldn't find database #%d for transfer (%s)" % (arg_id, db_path))
             traceback.print_exc()
             self.can_app.cmd_res([REQUEST.GET_FILE, TRANSFER.NOT_FOUND])
 
-    def response_get_file(self, arg_id):
+    def request_get_bytes(self, arg_id, data=b''):
+        # sender: on get bytes request send get bytes response
         if arg_id == TRANSFER.RESEND:
             # there was communication error - attempt to resend previous block (without guards)
+            self.pacer.on_loss()
             try:
                 if self.file_tx and self.file_tx.block:
+                    self.can_app.sender.drop_bulk()
                     self.send_block()
             except Exception:
                 traceback.print_exc()
                 self.can_app.cmd_res([REQUEST.GET_BYTES, TRANSFER.NOT_FOUND])
+        elif arg_id == TRANSFER.NACK:
+            # resend only chunks the receiver is missing, only the checksum if none are
+            self.pacer.on_loss()
+            if self.file_tx and self.file_tx.block:
+                self.send_sequenced(unpack_nack(data))
         else:
             # just send next part of file
+            self.pacer.on_ack()
             try:
                 if self.file_tx:
                     self.file_tx.read_next()
@@ -74,45 +147,133 @@ class TransferHandler:
                     self.can_app.cmd_res([REQUEST.GET_BYTES, TRANSFER.NOT_FOUND])
             except StopIteration:
                 self.file_tx.close()
+                summary = self.file_tx.summary()
                 self.file_tx = None
+                self.can_app.sender.drop_bulk()
                 self.send_chunk(TRANSFER.STOP, bytes())
-                print("Transfer completed")
+                print("Transfer completed, %s, %s" % (summary, self.pacer))
+
+    def get_file_data(self, arg_id, modes):
+        """ GET_FILE request data: requested modes, size and CRC32 of the local copy to resume """
+        self.rx_request = (arg_id, modes)
+        self.last_rx = time.time()
+        if self.file_rx:
+            self.file_rx.f.flush()
+        path = receive_path(arg_id)
+        if modes & MODE.RESUME and os.path.isfile(path) and os.path.getsize(path):
+            size = os.path.getsize(path)
+            return bytes([modes]) + struct.pack('>LL', size, file_crc32(path, size))
+        return bytes([modes & ~MODE.RESUME])
+
+    def response_get_file(self, arg_id, data=b''):
+        # receiver: the sender opened the file, start requesting blocks
+        if arg_id == TRANSFER.NOT_FOUND:
+            print("File isn't available for transfer")
+            return
+        self.mode = data[0] if len(data) else MODE.CHUNKED
+        offset = 0
+        if self.mode & MODE.RESUME:
+            offset = struct.unpack('>L', bytes(data[1:5]))[0]
+            if offset:
+                print("Resuming transfer at byte %d" % offset)
+        if self.file_rx:
+            self.file_rx.close()
+        self.file_rx = FileRx(receive_path(arg_id), get_codec(self.mode), offset)
+        self.last_rx = time.time()
+        self.can_app.cmd_get_bytes(TRANSFER.NEXT)
 
     def response_get_bytes(self, arg_id, data):
         # print("Transfer command #arg", arg_id)
         if not self.file_rx:
             print("Client transfer error")
             return
+        self.last_rx = time.time()
+        self.rx_timeouts = 0
         if arg_id == TRANSFER.NOT_FOUND:
             print("Server file transfer isn't initialized with GET_FILE request")
         if arg_id == TRANSFER.CHECKSUM:
-            crc = struct.unpack('>L', data)[0]
+            crc = struct.unpack('>L', bytes(data[:4]))[0]
             self.file_rx.supposed_crc = crc
+            if self.mode & MODE.SEQUENCED:
+                # checksum follows the chunks of the block
+                self.receive_sequenced(data[4])
         elif arg_id == TRANSFER.STOP:
             self.file_rx.close()
+            print("Transfer finished, %s" % self.file_rx.summary())
             self.file_rx = None
-            print("Transfer finished")
+        elif arg_id == TRANSFER.BULK:
+            # TP messages are reassembled into lists
+            data = bytes(data)
+            self.file_rx.supposed_crc = struct.unpack('>L', data[:4])[0]
+            self.file_rx.set_block(memoryview(data)[4:])
+            self.receive_block()
+        elif 0 < arg_id <= TRANSFER.MAX_CHUNKS and self.mode & MODE.SEQUENCED:
+            if not self.file_rx.place_chunk(arg_id - 1, data):
+                print("Chunk #%d of %d bytes is out of the block" % (arg_id, len(data)))
         elif 0 < arg_id <= TRANSFER.MAX_CHUNKS:
             # print("Writing bytes")
             n_chk = arg_id
             self.file_rx.append_chunk(data)
             if self.file_rx.block_complete(n_chk):
-                if self.file_rx.check_crc32():
-                    self.file_rx.write_block()
-                    self.can_app.cmd_req([REQUEST.GET_BYTES, TRANSFER.NEXT])
-                    if self.file_rx.update_progress():
-                        print("%d packets written" %
-                              self.file_rx.writes)
-                else:
-                    self.can_app.cmd_req([REQUEST.GET_BYTES, TRANSFER.RESEND])
-                self.file_rx.chunks = []
+                self.receive_block()
+
+    def receive_sequenced(self, n_chk):
+        missing = self.file_rx.missing_chunks(n_chk)
+        if missing:
+            msg = bytes([REQUEST.GET_BYTES, TRANSFER.NACK]) + pack_nack(missing)
+            if len(msg) <= 8:
+                self.can_app.cmd_req(msg)
+            else:
+                # bitmap didn't go through, ask for the whole block
+                self.can_app.cmd_req_bulk(msg, lambda: self.can_app.cmd_get_bytes(TRANSFER.RESEND))
+            return
+        self.receive_block()
+
+    def check_timeout(self):
+        """
+            Receiver: ask again when the transfer went silent, a frame of it was lost.
+            Sequenced block gets an empty NACK, so the sender repeats the checksum and the receiver NACKs what's missing,
+            otherwise the file is requested again to resume from the received part.
+        """
+        if not self.file_rx or time.time() - self.last_rx < RX_TIMEOUT:
+            return
+        self.rx_timeouts += 1
+        if self.rx_timeouts > RX_RETRIES:
+            print("Transfer failed, sender doesn't respond")
+            self.file_rx.close()
+            self.file_rx = None
+            return
+        print("Transfer timed out, asking again (%d of %d)" % (self.rx_timeouts, RX_RETRIES))
+        self.last_rx = time.time()
+        if self.mode & MODE.SEQUENCED and self.file_rx.n_chunks:
+            self.can_app.cmd_req(bytes([REQUEST.GET_BYTES, TRANSFER.NACK]))
+        elif self.rx_request is not None:
+            self.can_app.cmd_get_file(*self.rx_request)
+
+    def receive_block(self):
+        if self.file_rx.check_crc32():
+            self.file_rx.write_block()
+            self.can_app.cmd_get_bytes(TRANSFER.NEXT)
+            if self.file_rx.update_progress():
+                print("%d packets written" %
+                      self.file_rx.writes)
+        elif self.file_rx.can_retry():
+            self.can_app.cmd_get_bytes(TRANSFER.RESEND)
+        else:
+            print("Transfer failed, block can't be decompressed")
+            self.file_rx.close()
+            self.file_rx = None
+            return
+        self.file_rx.clear_block()
 
     def clear_db(self, db_id):
         self.file_tx = None
+        self.can_app.sender.drop_bulk()
         try:
             path = os.path.join(utils.Pathing.db_root, str(db_id))
             print(path)
             shutil.rmtree(path, ignore_errors=True)
+            dbmanifest.remove_db(utils.Pathing.db_root, db_id)
             self.can_app.cmd_res([REQUEST.CLEAR_DB, TRANSFER.OK])
         except Exception:
             traceback.print_exc()
@@ -131,11 +292,142 @@ class TRANSFER:
     CHECKSUM = MAX_CHUNKS + 1
     STOP = MAX_CHUNKS + 2
     NOT_FOUND = MAX_CHUNKS + 3
+    # GET_BYTES arg of a block sent in bulk, data is CRC32 and the block
+    BULK = MAX_CHUNKS + 4
+    # GET_BYTES request arg of missing chunks, data is the first missing index and bitmap from it
+    NACK = MAX_CHUNKS + 5
+    # GET_FILE id of the db manifest
+    MANIFEST = 254
     CHUNK_SIZE = 6
     BLOCK_SIZE = CHUNK_SIZE * MAX_CHUNKS
+    # TP message is up to 1785 bytes, less request id, arg id and CRC32
+    BULK_BLOCK_SIZE = 1785 - 2 - 4
     REFLASH = 255
 
 
+class MODE:
+    """ Flags of transfer modes, requested in GET_FILE data and confirmed in its response """
+    CHUNKED = 0
+    BULK = 1
+    # chunk args are their index + 1, checksum follows the chunks, missing chunks are requested by NACK
+    SEQUENCED = 2
+    # file is sent as one compressed stream cut into blocks, CRC32 of a block is of its decompressed data
+    ZLIB = 4
+    LZMA = 8
+    COMPRESSED = ZLIB | LZMA
+    # request carries size and CRC32 of the receiver's copy, response the offset the file is sent from
+    RESUME = 16
+
+
+SUPPORTED_MODES = MODE.BULK | MODE.SEQUENCED | MODE.COMPRESSED | MODE.RESUME
+
+
+def negotiate_mode(requested):
+    mode = requested & SUPPORTED_MODES
+    if mode & MODE.ZLIB:
+        # one codec, zlib is preferred since its blocks can be received again after a CRC error
+        mode &= ~MODE.LZMA
+    return mode
+
+
+def receive_path(file_id):
+    if file_id == TRANSFER.REFLASH:
+        return flashing.FLASH_OUT_PATH
+    if file_id == TRANSFER.MANIFEST:
+        return os.path.join(utils.Pathing.codes_root, 'transfer', dbmanifest.MANIFEST_FN)
+    return os.path.join(utils.Pathing.codes_root, 'transfer', str(file_id), 'snaps.db')
+
+
+def file_crc32(path, size):
+    """ CRC32 of the first size bytes of the file """
+    crc = 0
+    with open(path, 'rb') as f:
+        while size > 0:
+            _bytes = f.read(min(size, COMPRESS_READ_SIZE))
+            if not _bytes:
+                break
+            crc = binascii.crc32(_bytes, crc)
+            size -= len(_bytes)
+    return crc
+
+
+def resume_offset(path, data):
+    """ Size of the receiver's copy if it's the start of the file, 0 otherwise """
+    if len(data) < 9:
+        return 0
+    size, crc = struct.unpack('>LL', bytes(data[1:9]))
+    if size <= os.path.getsize(path) and file_crc32(path, size) == crc:
+        return size
+    return 0
+
+
+class Codec:
+    """
+        Streaming compressor and decompressor of MODE.ZLIB or MODE.LZMA transfer.
+        Decompression of a block is committed after its CRC check, zlib decompressor is rolled back otherwise.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        if mode & MODE.ZLIB:
+            self.compressor = zlib.compressobj(ZLIB_LEVEL)
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.compressor = lzma.LZMACompressor()
+            self.decompressor = lzma.LZMADecompressor()
+        self.pending = None
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def can_retry(self):
+        return bool(self.mode & MODE.ZLIB)
+
+    def decompress(self, data):
+        if self.can_retry():
+            self.pending = self.decompressor.copy()
+            return self.pending.decompress(data)
+        return self.decompressor.decompress(data)
+
+    def commit(self):
+        if self.pending is not None:
+            self.decompressor = self.pending
+            self.pending = None
+
+
+def get_codec(mode):
+    return Codec(mode) if mode & MODE.COMPRESSED else None
+
+
+def pack_nack(missing):
+    """ First missing chunk index and bitmap of missing chunks from it, bit i of byte j is chunk first + 8 * j + i """
+    if not missing:
+        return b''
+    first = missing[0]
+    bitmap = bytearray((missing[-1] - first) // 8 + 1)
+    for i in missing:
+        i -= first
+        bitmap[i // 8] |= 1 << (i % 8)
+    return bytes([first]) + bitmap
+
+
+def unpack_nack(data):
+    if not len(data):
+        return []
+    first, bitmap = data[0], data[1:]
+    return [first + 8 * j + i for j, byte in enumerate(bitmap) for i in range(8) if byte & (1 << i)]
+
+
+def transfer_summary(raw_bytes, sent_bytes, seconds):
+    """ Compression ratio and effective throughput of file bytes """
+    ratio = raw_bytes / sent_bytes if sent_bytes else 1.0
+    return '%d bytes as %d (ratio %.2f) in %.1f s, %.0f B/s' % (
+        raw_bytes, sent_bytes, ratio, seconds, raw_bytes / max(seconds, 1e-6))
+
+
 class FileTx():
     """
         Class intended for reading file for transfer in blocks divided by chunks.
@@ -143,20 +435,47 @@ class FileTx():
         Each chunk is a pinch of bytes to transfer.
     """
 
-    def __init__(self, fn):
+    def __init__(self, fn, block_size=TRANSFER.BLOCK_SIZE, codec=None, offset=0):
         self.f = open(fn, 'rb')
         fsize = os.fstat(self.f.fileno()).st_size
+        self.offset = offset
+        self.f.seek(offset)
         self.block = None
-        self.n_blocks = fsize // TRANSFER.BLOCK_SIZE
+        self.block_size = block_size
+        self.n_blocks = (fsize - offset) // block_size
+        self.codec = codec
+        # decompressed CRC32 of compressed block, from a mirror of the receiver's decompressor
+        self.block_crc = None
+        self.mirror = Codec(codec.mode) if codec else None
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.start = time.time()
         self.tx = self.read_blocks()
 
     def read_blocks(self):
+        if self.codec:
+            yield from self.read_compressed_blocks()
+            return
         while True:
-            _bytes = self.f.read(TRANSFER.BLOCK_SIZE)
+            _bytes = self.f.read(self.block_size)
             if not _bytes:
                 break
+            self.raw_bytes += len(_bytes)
             yield _bytes
 
+    def read_compressed_blocks(self):
+        pending = bytearray()
+        while True:
+            _bytes = self.f.read(COMPRESS_READ_SIZE)
+            self.raw_bytes += len(_bytes)
+            pending += self.codec.compress(_bytes) if _bytes else self.codec.flush()
+            while len(pending) >= self.block_size or (not _bytes and pending):
+                block = bytes(pending[:self.block_size])
+                del pending[:self.block_size]
+                yield block
+            if not _bytes:
+                break
+
     def count_chunks(self):
         actual_len = len(self.block)
         bs = TRANSFER.CHUNK_SIZE
@@ -166,8 +485,15 @@ class FileTx():
 
     def read_next(self):
         self.block = next(self.tx)
+        self.sent_bytes += len(self.block)
+        if self.mirror:
+            self.block_crc = binascii.crc32(self.mirror.decompress(self.block))
+            self.mirror.commit()
         return self.block
 
+    def get_chunk(self, i):
+        return self.block[i * TRANSFER.CHUNK_SIZE:(i + 1) * TRANSFER.CHUNK_SIZE]
+
     def read_chunks(self):
         for i in range(0, len(self.block), TRANSFER.CHUNK_SIZE):
             chunk = self.block[i:i + TRANSFER.CHUNK_SIZE]
@@ -175,13 +501,21 @@ class FileTx():
             yield chunk
 
     def get_crc32(self):
+        if self.codec:
+            return self.block_crc
         crc = binascii.crc32(self.block, 0)
         return crc
 
     def reset(self):
-        self.f.seek(0, 0)
+        self.f.seek(self.offset, 0)
+        if self.codec:
+            self.codec = Codec(self.codec.mode)
+            self.mirror = Codec(self.codec.mode)
         self.tx = self.read_blocks()
 
+    def summary(self):
+        return transfer_summary(self.raw_bytes, self.sent_bytes, time.time() - self.start)
+
     def read(self):
         for _ in self.tx:
             for c in self.read_chunks():
@@ -192,33 +526,120 @@ class FileTx():
 
 
 class FileRx():
+    """
+        Class intended for writing transferred file by blocks.
+        Chunks are copied into a preallocated block buffer, appended in order or placed by their index,
+        CRC32 is updated as contiguous chunks arrive and the complete block is written by one call.
+    """
     WRITES_TO_UPDATE = 100
+    BUFFER_SIZE = max(TRANSFER.BLOCK_SIZE, TRANSFER.BULK_BLOCK_SIZE)
 
-    def __init__(self, fn):
+    def __init__(self, fn, codec=None, offset=0):
         os.makedirs(os.path.dirname(fn), exist_ok=True)
         self.writes = 0
-        self.f = open(fn, 'wb')
-        self.chunks = []
+        if offset:
+            # resumed transfer appends to what's already received
+            self.f = open(fn, 'r+b')
+            self.f.truncate(offset)
+            self.f.seek(offset)
+        else:
+            self.f = open(fn, 'wb')
+        self.codec = codec
+        # decompressed block of compressed transfer
+        self.output = None
+        self.raw_bytes = 0
+        self.received_bytes = 0
+        self.start = time.time()
         self.supposed_crc = None
-        self.block = None
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.received = bytearray(TRANSFER.MAX_CHUNKS)
+        self.clear_block()
+
+    def clear_block(self):
+        self.received[:] = bytes(TRANSFER.MAX_CHUNKS)
+        self.n_chunks = 0
+        self.block_len = 0
+        # running CRC32 of the first crc_len bytes of the block
+        self.crc = 0
+        self.crc_len = 0
 
     def append_chunk(self, data):
-        self.chunks += [bytes(data)]
+        start = self.block_len
+        self.block_len += len(data)
+        self.view[start:self.block_len] = data
+        self.n_chunks += 1
+        self.crc = binascii.crc32(data, self.crc)
+        self.crc_len = self.block_len
+
+    def place_chunk(self, i, data):
+        """ Copy chunk i into the block, False if it doesn't fit the block """
+        start = i * TRANSFER.CHUNK_SIZE
+        end = start + len(data)
+        if not 0 <= i < TRANSFER.MAX_CHUNKS or len(data) > TRANSFER.CHUNK_SIZE or end > self.BUFFER_SIZE:
+            return False
+        self.view[start:end] = data
+        if not self.received[i]:
+            self.received[i] = 1
+            self.n_chunks += 1
+        self.block_len = max(self.block_len, end)
+        if start == self.crc_len:
+            self.update_crc32()
+        return True
+
+    def set_block(self, data):
+        """ Whole block received at once """
+        self.clear_block()
+        self.block_len = len(data)
+        self.view[:self.block_len] = data
+        self.crc = binascii.crc32(data)
+        self.crc_len = self.block_len
+
+    def update_crc32(self):
+        # extend CRC over placed chunks following the ones it covers, up to the first missing chunk
+        crc_len = self.crc_len
+        while crc_len < self.block_len and self.received[crc_len // TRANSFER.CHUNK_SIZE]:
+            crc_len = min(crc_len + TRANSFER.CHUNK_SIZE, self.block_len)
+        self.crc = binascii.crc32(self.view[self.crc_len:crc_len], self.crc)
+        self.crc_len = crc_len
+
+    def missing_chunks(self, n_chk):
+        return [i for i in range(n_chk) if not self.received[i]]
+
+    def get_block(self):
+        return self.view[:self.block_len]
 
     def block_complete(self, n_chk):
-        complete = len(self.chunks) == n_chk
+        complete = self.n_chunks == n_chk
         return complete
 
     def check_crc32(self):
-        from functools import reduce
-        self.block = reduce(lambda a, b: a + b, self.chunks, bytes())
-        crc = binascii.crc32(self.block, 0)
-        return crc == self.supposed_crc
+        if self.codec:
+            try:
+                self.output = self.codec.decompress(self.get_block())
+            except (zlib.error, lzma.LZMAError):
+                return False
+            return binascii.crc32(self.output) == self.supposed_crc
+        return self.crc_len == self.block_len and self.crc == self.supposed_crc
+
+    def can_retry(self):
+        return self.codec is None or self.codec.can_retry()
 
     def write_block(self):
-        if self.block:
-            self.f.write(self.block)
-            self.writes += 1
+        if not self.block_len:
+            return
+        self.received_bytes += self.block_len
+        if self.codec:
+            self.codec.commit()
+            self.f.write(self.output)
+            self.raw_bytes += len(self.output)
+        else:
+            self.f.write(self.get_block())
+            self.raw_bytes += self.block_len
+        self.writes += 1
+
+    def summary(self):
+        return transfer_summary(self.raw_bytes, self.received_bytes, time.time() - self.start)
 
     def update_progress(self):
         return (self.writes % self.WRITES_TO_UPDATE) == 0
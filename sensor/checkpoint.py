@@ -0,0 +1,62 @@
+"""
+    Checkpoint of pipeline state for warm restart.
+
+    State is a flat dict of numpy arrays (background masks, rolling statistics, duty, counters),
+    masks are kept at reduced resolution to keep the file small.
+    It's saved atomically into one compressed .npz file every checkpoint_period seconds
+    and restored at startup when the checkpoint is fresh enough.
+"""
+import os
+import time
+
+import numpy as np
+
+from sensor import settings, utils
+
+VERSION = 2
+# background masks are saved averaged over MASK_REDUCE x MASK_REDUCE pixel blocks
+MASK_REDUCE = 4
+
+
+def checkpoint_path():
+    # outside of the code folder, so the checkpoint survives a reflash
+    return os.path.join(utils.Pathing.codes_root, 'checkpoint.npz')
+
+
+def prefixed(prefix, state):
+    return {'%s.%s' % (prefix, k): v for k, v in state.items()}
+
+
+def unprefixed(prefix, state):
+    start = prefix + '.'
+    return {k[len(start):]: v for k, v in state.items() if k.startswith(start)}
+
+
+def save(state, path=None):
+    path = path or checkpoint_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, _version=VERSION, _saved=time.time(), **state)
+    os.replace(tmp_path, path)
+
+
+def load(path=None, max_age=None):
+    """ State of the checkpoint, None if there's none, it's older than max_age seconds or unreadable """
+    path = path or checkpoint_path()
+    if max_age is None:
+        max_age = settings.get_config()['DEFAULT'].getfloat('checkpoint_max_age')
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as data:
+            state = {k: data[k] for k in data.files}
+    except (OSError, ValueError) as e:
+        print("Couldn't read checkpoint %s: %r" % (path, e))
+        return None
+    if state.pop('_version') != VERSION:
+        return None
+    age = time.time() - float(state.pop('_saved'))
+    if age > max_age:
+        print("Checkpoint is %d s old, starting cold" % age)
+        return None
+    return state
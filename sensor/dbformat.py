@@ -0,0 +1,222 @@
+"""
+    Append-only binary format of the detection databases.
+
+    File is a small header (magic, version, record dtype) followed by fixed-width records
+    of a numpy structured dtype, so it is appended with a single write and read memory-mapped.
+    Image paths aren't stored: snaps keep the capture time parsed from the image name,
+    diameters refer to snaps by image index.
+"""
+import json
+import os
+import struct
+from datetime import datetime
+
+import numpy as np
+
+from sensor import utils
+
+MAGIC = b'SNSRDB\x00\x00'
+VERSION = 1
+# magic, version, length of dtype json
+HEADER_FMT = '<8sHH'
+BINARY_EXT = '.bin'
+TEXT_EXT = '.db'
+# rows read from text files at once
+TEXT_CHUNK_ROWS = 100000
+
+SNAPS_DTYPE = np.dtype([
+    ('idx', '<u4'),
+    ('time_us', '<i8'),
+    ('n_particles', '<u4'),
+    ('mean_diam', '<f8'),
+    ('duty', '<u4'),
+    ('d_param', '<f8'),
+])
+DIAMS_DTYPE = np.dtype([
+    ('idx', '<u4'),
+    ('diam', '<f8'),
+])
+LOADS_DTYPE = np.dtype([
+    ('idx', '<u4'),
+    ('d_param_sum', '<f8'),
+])
+
+# db name: record dtype
+DBS = {
+    'snaps': SNAPS_DTYPE,
+    'data': DIAMS_DTYPE,
+    'loads': LOADS_DTYPE,
+}
+
+
+def pack_header(dtype):
+    descr = json.dumps(dtype.descr).encode()
+    return struct.pack(HEADER_FMT, MAGIC, VERSION, len(descr)) + descr
+
+
+def read_header(f):
+    """ Record dtype and data offset of the file, ValueError if it isn't a binary db """
+    head = f.read(struct.calcsize(HEADER_FMT))
+    if len(head) < struct.calcsize(HEADER_FMT):
+        raise ValueError('File is too short for binary db header.')
+    magic, version, descr_len = struct.unpack(HEADER_FMT, head)
+    if magic != MAGIC:
+        raise ValueError('Not a binary db file.')
+    if version > VERSION:
+        raise ValueError('Unsupported binary db version %d.' % version)
+    descr = json.loads(f.read(descr_len).decode())
+    dtype = np.dtype([tuple(field) for field in descr])
+    return dtype, f.tell()
+
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def path_to_time_us(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        moment = datetime.strptime(name, utils.IMAGE_TIME_FMT)
+    except ValueError:
+        return 0
+    return int(round(moment.timestamp() * 1e6))
+
+
+def time_us_to_path(time_us, folder=utils.Pathing.image_dir, ext='jpg'):
+    if not time_us:
+        return ''
+    moment = datetime.fromtimestamp(time_us / 1e6)
+    return os.path.join(folder, moment.strftime(utils.IMAGE_TIME_FMT) + '.' + ext)
+
+
+class RecordFile:
+    """
+        Binary db file opened for appending records of the given dtype.
+        Header is written to a new file and checked against dtype of an existing one.
+    """
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.f = open(path, 'ab+')
+        self.f.seek(0)
+        if os.fstat(self.f.fileno()).st_size:
+            try:
+                file_dtype, offset = read_header(self.f)
+                if file_dtype != self.dtype:
+                    raise ValueError('Records of %s have dtype %s, not %s.' % (path, file_dtype, self.dtype))
+            except ValueError:
+                self.f.close()
+                raise
+            # drop the partial record of an interrupted write
+            size = os.fstat(self.f.fileno()).st_size
+            self.f.truncate(offset + (size - offset) // self.dtype.itemsize * self.dtype.itemsize)
+        else:
+            self.f.write(pack_header(self.dtype))
+        self.f.seek(0, os.SEEK_END)
+
+    def append(self, records):
+        self.f.write(np.asarray(records, dtype=self.dtype).tobytes())
+
+    def write(self, data):
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+def find_db(db_dir, name):
+    """ Path of the text db of the directory, or of the binary one when there's no text db """
+    text_path = os.path.join(db_dir, name + TEXT_EXT)
+    bin_path = os.path.join(db_dir, name + BINARY_EXT)
+    if not os.path.isfile(text_path) and os.path.isfile(bin_path):
+        return bin_path
+    return text_path
+
+
+def read_records(path):
+    """ Memory-mapped records of the binary db, empty array when it has none """
+    with open(path, 'rb') as f:
+        dtype, offset = read_header(f)
+        size = os.fstat(f.fileno()).st_size
+    n = (size - offset) // dtype.itemsize
+    if not n:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n,))
+
+
+def iter_text_rows(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line.split(';')
+
+
+def parse_text_rows(name, rows):
+    dtype = DBS[name]
+    rows = list(rows)
+    records = np.zeros(len(rows), dtype=dtype)
+    if name == 'snaps':
+        for i, (idx, path, n_particles, mean_diam, duty, d_param) in enumerate(rows):
+            records[i] = (int(idx), path_to_time_us(path), int(n_particles), float(mean_diam),
+                          int(duty), float(d_param))
+    elif name == 'data':
+        records['idx'] = [int(row[0]) for row in rows]
+        records['diam'] = [float(row[-1]) for row in rows]
+    else:
+        records['idx'] = [int(row[0]) for row in rows]
+        records['d_param_sum'] = [float(row[1]) for row in rows]
+    return records
+
+
+def format_text_rows(name, records, paths=None):
+    """ Text rows of records in the format of DataWriter, paths is {idx: image path} for diameters """
+    paths = paths or {}
+    if name == 'snaps':
+        return ''.join('%d;%s;%d;%f;%d;%f\n' % (r['idx'], time_us_to_path(r['time_us']), r['n_particles'],
+                                                r['mean_diam'], r['duty'], r['d_param']) for r in records)
+    elif name == 'data':
+        return ''.join('%d;%s;%s\n' % (r['idx'], paths.get(int(r['idx']), ''), r['diam']) for r in records)
+    return ''.join('%d;%f\n' % (r['idx'], r['d_param_sum']) for r in records)
+
+
+def text_to_binary(db_dir):
+    """ Convert text dbs of the directory to binary ones next to them """
+    for name, dtype in DBS.items():
+        text_path = os.path.join(db_dir, name + TEXT_EXT)
+        if not os.path.isfile(text_path):
+            continue
+        bin_path = os.path.join(db_dir, name + BINARY_EXT)
+        if os.path.isfile(bin_path):
+            os.remove(bin_path)
+        out = RecordFile(bin_path, dtype)
+        rows = iter_text_rows(text_path)
+        while True:
+            chunk = [row for _, row in zip(range(TEXT_CHUNK_ROWS), rows)]
+            if not chunk:
+                break
+            out.append(parse_text_rows(name, chunk))
+        out.close()
+
+
+def binary_to_text(db_dir):
+    """ Convert binary dbs of the directory to text ones next to them """
+    paths = {}
+    for name in DBS:
+        bin_path = os.path.join(db_dir, name + BINARY_EXT)
+        if not os.path.isfile(bin_path):
+            continue
+        records = read_records(bin_path)
+        if name == 'snaps':
+            paths = {int(idx): time_us_to_path(t) for idx, t in zip(records['idx'], records['time_us'])}
+        with open(os.path.join(db_dir, name + TEXT_EXT), 'w') as f:
+            for start in range(0, len(records), TEXT_CHUNK_ROWS):
+                f.write(format_text_rows(name, records[start:start + TEXT_CHUNK_ROWS], paths))
@@ -0,0 +1,135 @@
+"""
+    Manifest of db directories, kept in db root by the writer.
+
+    Records id, creation time, row counts and byte sizes of every db, so dbs are enumerated
+    without probing directories, and ids stay valid when some dbs are cleared.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+
+MANIFEST_FN = 'manifest.json'
+# ids are sent in one byte, 254 and 255 are GET_FILE ids of the manifest and the reflash
+MAX_DB_ID = 253
+
+# manifest is updated by the writer and by CAN requests
+_lock = threading.RLock()
+
+
+def manifest_path(db_root):
+    return os.path.join(db_root, MANIFEST_FN)
+
+
+def dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def scan(db_root):
+    """ Manifest of existing db directories, for db roots written before the manifest """
+    dbs = {}
+    if os.path.isdir(db_root):
+        for entry in os.scandir(db_root):
+            if entry.is_dir() and entry.name.isdigit() and os.listdir(entry.path):
+                dbs[entry.name] = {'id': int(entry.name), 'created': entry.stat().st_mtime,
+                                   'rows': {}, 'bytes': dir_size(entry.path)}
+    return {'dbs': dbs}
+
+
+def load(db_root):
+    with _lock:
+        try:
+            with open(manifest_path(db_root)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            manifest = scan(db_root)
+            if manifest['dbs']:
+                save(db_root, manifest)
+            return manifest
+
+
+def save(db_root, manifest):
+    with _lock:
+        os.makedirs(db_root, exist_ok=True)
+        path = manifest_path(db_root)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, path)
+
+
+def list_dbs(db_root):
+    """ Manifest entries of dbs sorted by id """
+    return sorted(load(db_root)['dbs'].values(), key=lambda db: db['id'])
+
+
+def count_ids(db_root):
+    """ Number of ids to enumerate, one more than the last id since cleared dbs leave gaps """
+    ids = [db['id'] for db in list_dbs(db_root)]
+    return max(ids) + 1 if ids else 0
+
+
+def is_empty(db_root, db):
+    path = os.path.join(db_root, str(db['id']))
+    return not any(db['rows'].values()) and not (os.path.isdir(path) and os.listdir(path))
+
+
+def created_order(db):
+    return db['created'], db['id']
+
+
+def next_id(db_root, manifest):
+    """
+        Id of the last created db if it's still empty, otherwise the next free id after it, wrapping past MAX_DB_ID,
+        or the id of the oldest db when all ids are taken
+    """
+    dbs = manifest['dbs']
+    if not dbs:
+        return 0
+    last = max(dbs.values(), key=created_order)
+    if is_empty(db_root, last):
+        return last['id']
+    for step in range(1, MAX_DB_ID + 2):
+        db_id = (last['id'] + step) % (MAX_DB_ID + 1)
+        if str(db_id) not in dbs:
+            return db_id
+    oldest = min(dbs.values(), key=created_order)
+    print("No free db ids, db #%d is overwritten" % oldest['id'])
+    return oldest['id']
+
+
+def new_db(db_root):
+    """ Create the empty db directory with the next id and add it to the manifest """
+    with _lock:
+        manifest = load(db_root)
+        db_id = next_id(db_root, manifest)
+        path = os.path.abspath(os.path.join(db_root, str(db_id)))
+        # files left of an overwritten db
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+        manifest['dbs'][str(db_id)] = {'id': db_id, 'created': time.time(), 'rows': {}, 'bytes': 0}
+        save(db_root, manifest)
+        return path
+
+
+def update_db(db_root, db_id, rows, n_bytes=None):
+    """ Set row counts {db name: rows} and size of the db, size is scanned when n_bytes isn't known """
+    with _lock:
+        manifest = load(db_root)
+        db = manifest['dbs'].get(str(db_id))
+        if db is None:
+            return
+        db['rows'].update(rows)
+        if n_bytes is None:
+            n_bytes = dir_size(os.path.join(db_root, str(db_id)))
+        db['bytes'] = n_bytes
+        db['updated'] = time.time()
+        save(db_root, manifest)
+
+
+def remove_db(db_root, db_id):
+    with _lock:
+        manifest = load(db_root)
+        if manifest['dbs'].pop(str(db_id), None) is not None:
+            save(db_root, manifest)
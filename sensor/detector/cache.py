@@ -0,0 +1,155 @@
+"""
+    Persistent cache of decoded and preprocessed frames for offline runs.
+
+    Entries are .npy files keyed by source file content hash, decoder and preprocessing parameters,
+    loaded memory-mapped. The cache is bounded by size, least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from sensor import utils, imaging
+
+MAX_CACHE_MB = 4096
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    """ Content hash of the file, memoized by path, size and modification time """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _file_hashes[memo_key] = sha.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def mask_key(mask):
+    if mask is None or type(mask) is int:
+        return mask
+    mask = np.ascontiguousarray(mask)
+    return '%s_%s' % ('x'.join(map(str, mask.shape)), hashlib.sha1(mask).hexdigest())
+
+
+def params_key(params):
+    dump = json.dumps(params, sort_keys=True, default=float)
+    return hashlib.sha1(dump.encode()).hexdigest()[:16]
+
+
+class ImageCache:
+
+    def __init__(self, root=utils.Pathing.cache_root, max_mb=MAX_CACHE_MB):
+        self.root = root
+        self.max_bytes = max_mb * 1024 * 1024
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        # entries are loaded from prefetching threads
+        self.lock = threading.RLock()
+
+    def key(self, path, params=None):
+        key = file_hash(path)
+        if params is not None:
+            key += '_' + params_key(params)
+        return key
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            image = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        # modification time is the last access time for LRU eviction
+        os.utime(path)
+        return image
+
+    def put(self, key, image):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, image)
+        with self.lock:
+            # overwritten entry doesn't count anymore
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+            if self.size is None:
+                self.size = sum(size for _, _, size in self.entries())
+            else:
+                self.size += os.path.getsize(path) - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits into 90% of its size limit """
+        with self.lock:
+            entries = sorted(self.entries(), key=lambda e: e[1])
+            self.size = sum(size for _, _, size in entries)
+            for path, _, size in entries:
+                if self.size <= 0.9 * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    self.size -= size
+                except OSError:
+                    pass
+
+    def load(self, path, params, func):
+        key = self.key(path, params)
+        image = self.get(key)
+        if image is None:
+            self.misses += 1
+            image = func()
+            self.put(key, image)
+        else:
+            self.hits += 1
+        return image
+
+    def decode_params(self, reduce=1):
+        # decoders differ by a few levels of gray
+        return {'engine': imaging.DECODE_ENGINE, 'reduce': reduce}
+
+    def load_grayscale(self, path, reduce=1):
+        return self.load(path, self.decode_params(reduce), lambda: imaging.load_grayscale_image(path, reduce))
+
+    def load_preprocessed(self, path, sbd, mask=None, reduce=1):
+        """ Frame after SBDWrapper.preprocess_batch() with given mask """
+        params = dict(self.decode_params(reduce), mask=mask_key(mask), scale_factor=sbd.scale_factor)
+
+        def preprocess():
+            image = self.load_grayscale(path, reduce)
+            return sbd.preprocess_batch(np.asarray(image)[None], mask)[0]
+
+        return self.load(path, params, preprocess)
+
+    def clear(self):
+        for path, _, _ in list(self.entries()):
+            os.remove(path)
+        self.size = 0
+
+    def __str__(self):
+        return 'Image cache: %d hits, %d misses' % (self.hits, self.misses)
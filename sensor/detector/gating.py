@@ -0,0 +1,110 @@
+"""
+    Change-gated detection: when the stream is static, consecutive frames are nearly identical,
+    so only blocks that changed since the previous frame are re-detected.
+    Frames are compared as captured, since mask subtraction and rescale stretch sensor noise to full range.
+"""
+import math
+
+import numpy as np
+
+from sensor.detector.sbd import grid_boxes, grid_edges, keys_in_box, merge_tile_keys
+
+# [px] side of the block the frame is compared by
+BLOCK_SIZE = 128
+# pixel is changed when its value differs by more than DIFF_THRESHOLD
+DIFF_THRESHOLD = 25
+# block is changed when it has more than DIFF_MIN_PIXELS changed pixels
+DIFF_MIN_PIXELS = 4
+# run full detection every N frames regardless of changes
+FULL_DETECT_PERIOD = 20
+
+
+class ChangeGate:
+    """
+        Diff the frame against the previous one at block granularity,
+        re-run detection on changed blocks only and reuse previous keys elsewhere.
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE, threshold=DIFF_THRESHOLD, min_pixels=DIFF_MIN_PIXELS,
+                 full_period=FULL_DETECT_PERIOD):
+        self.block_size = block_size
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.full_period = full_period
+
+        self.prev_image = None
+        self.prev_keys = None
+        self.prev_kwargs = None
+        self.since_full = 0
+
+        # counters
+        self.n_frames = 0
+        self.n_full = 0
+        self.blocks_total = 0
+        self.blocks_processed = 0
+        self.last_fraction = 1.0
+
+    def get_grid(self, shape):
+        h, w = shape[:2]
+        return math.ceil(h / self.block_size), math.ceil(w / self.block_size)
+
+    def changed_blocks(self, image):
+        """ Boolean (rows, cols) map of blocks changed since the previous frame """
+        ys, xs = grid_edges(image.shape, self.get_grid(image.shape))
+        changed = np.abs(image.astype('int16') - self.prev_image.astype('int16')) > self.threshold
+        counts = np.add.reduceat(np.add.reduceat(changed, ys[:-1], axis=0), xs[:-1], axis=1)
+        return counts > self.min_pixels
+
+    def needs_full(self, image, kwargs):
+        return (self.prev_image is None
+                or self.prev_image.shape != image.shape
+                or self.prev_kwargs != kwargs
+                or self.since_full >= self.full_period)
+
+    def detect(self, sbd, imagedef, raw_image=None, **kwargs):
+        """ raw_image is the frame of the same shape before preprocessing, compared instead of the detected image """
+        if kwargs['maxThreshold'] < kwargs['minThreshold']:
+            return None
+
+        image, image_fn = imagedef
+        compared = image if raw_image is None else raw_image
+        boxes = grid_boxes(image.shape, self.get_grid(image.shape))
+
+        if self.needs_full(compared, kwargs):
+            keys, _, _ = sbd.detect_frame(imagedef, **kwargs)
+            keys = keys.reshape(-1, 3)
+            n_processed = len(boxes)
+            self.since_full = 0
+            self.n_full += 1
+        else:
+            changed = self.changed_blocks(compared).ravel()
+            changed_boxes = [box for box, ch in zip(boxes, changed) if ch]
+            n_processed = len(changed_boxes)
+            keys = self.prev_keys
+            if changed_boxes:
+                stale = np.zeros(len(keys), dtype=bool)
+                for box in changed_boxes:
+                    stale |= keys_in_box(keys, box)
+                new_keys = sbd.detect_boxes(image, changed_boxes, **kwargs)
+                keys = merge_tile_keys([keys[~stale], new_keys], kwargs['minDistBetweenBlobs'])
+            self.since_full += 1
+
+        self.prev_image = compared
+        self.prev_keys = keys
+        self.prev_kwargs = kwargs
+
+        self.n_frames += 1
+        self.blocks_total += len(boxes)
+        self.blocks_processed += n_processed
+        self.last_fraction = n_processed / len(boxes)
+        return keys, image_fn, kwargs
+
+    @property
+    def processed_fraction(self):
+        if not self.blocks_total:
+            return 0.0
+        return self.blocks_processed / self.blocks_total
+
+    def __str__(self):
+        return "Processed %.1f%% of frame, %.1f%% of %d frames (%d full)" % (
+            100 * self.last_fraction, 100 * self.processed_fraction, self.n_frames, self.n_full)
@@ -1,4 +1,7 @@
+import itertools
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -7,40 +10,115 @@ from skimage import io
 from sklearn.model_selection import ParameterGrid
 
 from sensor import utils, imaging
-from sensor.detector import utils as det_utils
+from sensor.detector import cache, stats, sweep, utils as det_utils
 from sensor.detector.sbd import SBDWrapper
 
 # SMB_NAME = 'sample_3_170-180'
 SMB_NAME = 'sample_1'
+# number of images loaded into a stack at once
+BATCH_SIZE = 16
+# processes for run_sbd_all(), None for one per cpu
+SBD_WORKERS = None
+
+image_cache = cache.ImageCache()
 
 
 def load_images(sample_name=SMB_NAME):
     sample_dir = os.path.join(utils.Pathing.image_dir, sample_name)
-    files = list(utils.list_images(sample_dir))
+    files = [fp for _, fp in utils.list_images(sample_dir)]
     # files = files[:10]
     return files
 
 
-def generate_masks():
-    image_fns = load_images()
-    image_fns = image_fns[:10]
-    images = [imaging.load_grayscale_image(im) for im in image_fns]
-    for im_fn, im in zip(image_fns, images):
+def load_image(image_fn):
+    return np.asarray(image_cache.load_grayscale(image_fn))
+
+
+def load_stack(image_fns):
+    return np.stack([image for image, _ in imaging.iter_images(image_fns, loader=load_image)])
+
+
+def iter_sample_images(sample_name=SMB_NAME, preprocess=None):
+    """ Yield (image, path) imagedefs of the sample, read from packed stack when there is one """
+    sample_dir = os.path.join(utils.Pathing.image_dir, sample_name)
+    if imaging.ImageStack.exists(sample_dir):
+        for image, path in imaging.ImageStack(sample_dir).imagedefs():
+            if preprocess is not None:
+                image = preprocess(image)
+            yield image, path
+    else:
+        # prefetch a batch ahead so decoding overlaps with processing
+        yield from imaging.iter_images(load_images(sample_name), loader=load_image, preprocess=preprocess,
+                                       depth=2 * BATCH_SIZE)
+
+
+def iter_sample_batches(sample_name, batch_size=BATCH_SIZE):
+    """ Yield (start index, stack) batches of the sample """
+    sample_dir = os.path.join(utils.Pathing.image_dir, sample_name)
+    if imaging.ImageStack.exists(sample_dir):
+        frames = imaging.ImageStack(sample_dir).frames
+        for start in range(0, len(frames), batch_size):
+            yield start, frames[start:start + batch_size]
+    else:
+        start = 0
+        for batch in utils.batched(iter_sample_images(sample_name), batch_size):
+            yield start, np.stack([image for image, _ in batch])
+            start += len(batch)
+
+
+def pack_samples():
+    """ Pack every sample folder into memory-mapped stack """
+    for sample_dir in [f.path for f in os.scandir(utils.Pathing.image_dir) if f.is_dir()]:
+        print('Packing %s' % sample_dir)
+        imaging.pack_image_stack(sample_dir)
+
+
+def generate_masks(n_images=10, window=None):
+    """
+        Save mean masks of the first 1..n_images sample images
+        and, if window is given, of every `window` consecutive images, in one pass.
+    """
+    prefix = imaging.RunningMean()
+    sliding = imaging.RunningMean(window=window) if window else None
+    for i, (im, im_fn) in enumerate(itertools.islice(iter_sample_images(), n_images), 1):
         io.imsave(det_utils.get_out_path('1_mask', im_fn, 'mask'), im)
-    for i in range(1, len(images)):
-        maskarr = images[:i]
-        mask = imaging.mean_pixels(maskarr).astype('uint8')
-        mask_path = det_utils.get_out_path('of_%s_images.jpg' % i, 'mask', 'mask')
+        prefix.add(im)
+        mask_path = det_utils.get_out_path('of_%d_images.jpg' % i, 'mask', 'mask')
         print(mask_path)
-        io.imsave(mask_path, mask)
+        io.imsave(mask_path, prefix.mean().astype('uint8'))
+        if sliding is not None:
+            sliding.add(im)
+            if sliding.full:
+                mask_path = det_utils.get_out_path('window_%d_%d.jpg' % (i - window + 1, i), 'mask', 'mask')
+                print(mask_path)
+                io.imsave(mask_path, sliding.mean().astype('uint8'))
+
+
+def build_background_mask(sample_name=SMB_NAME, window=None):
+    """
+        Background mask as the mean of a whole sample (or of its last `window` images).
+        Images are streamed from disk, so the sample can be of any length.
+    """
+    running = imaging.RunningMean(window=window)
+    for im, _ in iter_sample_images(sample_name):
+        running.add(im)
+    if not running.count:
+        print('No images in sample %s' % sample_name)
+        return None
+    mask = running.mean().astype('uint8')
+    sample_dir = os.path.join(utils.Pathing.image_dir, sample_name)
+    mask_path = det_utils.get_out_path('background', sample_dir, '.jpg')
+    os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+    print('Background mask of %d images: %s' % (running.count, mask_path))
+    io.imsave(mask_path, mask)
+    return mask
 
 
 def generate_mask():
-    image_fns = load_images()
-    image_fns = image_fns[:4]
-    images = [imaging.load_grayscale_image(im) for im in image_fns]
-    for im_fn, im in zip(image_fns, images):
+    images = []
+    for im, im_fn in itertools.islice(iter_sample_images(), 4):
         io.imsave(det_utils.get_out_path('1_mask', im_fn, 'mask'), im)
+        images.append(im)
     mask = imaging.mean_pixels(images).astype('uint8')
     mask_path = det_utils.get_out_path('1_mask', 'masks.jpg', 'mask')
     io.imsave(mask_path, mask)
@@ -50,21 +128,39 @@ def run_sbd_default():
     run_sbd(sample_name=SMB_NAME)
 
 
-def run_sbd_all():
-    def get_dirs(path):
-        return [f.path for f in os.scandir(path) if f.is_dir()]
-
-    samples = get_dirs(utils.Pathing.image_dir)
-
-    for s in samples:
-        sample_name = os.path.basename(s)
-        run_sbd(sample_name)
+def run_sbd_all(workers=SBD_WORKERS):
+    """
+        Detect keys of every sample folder, samples are scheduled across a process pool.
+        Summary of each sample is appended to sbd_all.csv as soon as it completes.
+    """
+    samples = sorted(f.name for f in os.scandir(utils.Pathing.image_dir) if f.is_dir())
+    workers = min(workers or os.cpu_count(), len(samples)) or 1
+    summary_path = os.path.join(utils.Pathing.out_root, 'sbd_all.csv')
+    os.makedirs(utils.Pathing.out_root, exist_ok=True)
+    start = time.time()
+    n_frames = 0
+    with ProcessPoolExecutor(workers) as pool, open(summary_path, 'a') as f:
+        # one detection thread per process, the pool saturates the cpus
+        futures = {pool.submit(run_sbd, sample_name, 1): sample_name for sample_name in samples}
+        for i, future in enumerate(as_completed(futures), 1):
+            sample_name = futures[future]
+            try:
+                sample_frames, sample_keys, seconds = future.result()
+            except Exception as e:
+                print('Error processing sample %s: %r' % (sample_name, e))
+                continue
+            f.write('%s;%d;%d;%f\n' % (sample_name, sample_frames, sample_keys, seconds))
+            f.flush()
+            n_frames += sample_frames
+            rate = n_frames / (time.time() - start)
+            print('%d/%d samples, %s: %d frames, %d keys; %.2f frames/s' % (
+                i, len(samples), sample_name, sample_frames, sample_keys, rate))
 
 
 def run_bruteforce():
     image_fn = os.path.join(
         '.', 'data', 'sample.jpg')
-    img = imaging.load_grayscale_image(image_fn)
+    img = load_image(image_fn)
     mask = (np.zeros(img.shape) + 1) * 80
     mask = mask.astype('uint8')
 
@@ -95,12 +191,11 @@ def run_bruteforce():
             max_len_keys = len(keys)
 
 
-def run_bruteforce_custom():
-    images_max = list(utils.list_images(os.path.join('.', 'data', 'max')))
-    images_min = list(utils.list_images(os.path.join('.', 'data', 'min')))
-
-    imagedefs_max = [(imaging.load_grayscale_image(ifn), ifn) for ifn in images_max]
-    imagedefs_min = [(imaging.load_grayscale_image(ifn), ifn) for ifn in images_min]
+def run_bruteforce_custom(workers=None):
+    groups = {
+        'max': [fp for _, fp in utils.list_images(os.path.join('.', 'data', 'max'))],
+        'min': [fp for _, fp in utils.list_images(os.path.join('.', 'data', 'min'))],
+    }
 
     scale = 2
 
@@ -117,55 +212,22 @@ def run_bruteforce_custom():
         'minConvexity': [0.5, 0.8, 0.9, 0.95],
         'minRepeatability': [3, 4, 5]
     }
-    pg = ParameterGrid(kwargs)
-    sbd = SBDWrapper()
-
-    for p in pg:
+    param_sets = []
+    for p in ParameterGrid(kwargs):
         p['minArea'] = 16
         p['filterByCircularity'] = True
-        try:
-
-            brute_seed = utils.get_random_string(20)
-
-            def get_brute_path(ifn):
-                di = os.path.dirname(ifn)
-                ba = os.path.basename(ifn)
-                ifn = ba.replace('_3_gray8_6_unmasked_True', '')
-                new_path = os.path.join(di, brute_seed, ifn)
-                return new_path
-
-            keys_max = [sbd.process((idf[0], get_brute_path(idf[1])), None, p)
-                        for idf in imagedefs_max]
-            keys_max = list(
-                filter(lambda x: x is not None and x.any(), keys_max))
-            if keys_max:
-                keys_max = np.concatenate(keys_max)
-            else:
-                keys_max = []
-
-            keys_min = [sbd.process((idf[0], get_brute_path(idf[1])), None, p)
-                        for idf in imagedefs_min]
-            keys_min = list(
-                filter(lambda x: x is not None and x.any(), keys_min))
-
-            if keys_min:
-                keys_min = np.concatenate(keys_min)
-            else:
-                keys_min = []
-
-            mn, mx = len(keys_min), len(keys_max)
-
-            out_path = os.path.join('.', 'brute_multi.csv')
-            with open(out_path, 'a') as f:
-                f.write('%s%d%d%d%s\n' % (brute_seed, mx, mn, mx - mn, p))
-        except Exception as exc:
-            print(exc)
-            breakpoint()
+        param_sets.append(p)
+
+    out_path = os.path.join('.', 'brute_multi.jsonl')
+    brute = sweep.Sweep(groups, param_sets, out_path, score=lambda c: c['max'] - c['min'], workers=workers,
+                        image_cache=image_cache)
+    for row in brute.run():
+        print('%d (max %d, min %d): %s' % (row['score'], row['counts']['max'], row['counts']['min'], row['params']))
 
 
 def run_single():
     image_fn = os.path.join('..', 'data', 'sample.jpg')
-    img = imaging.load_grayscale_image(image_fn)
+    img = load_image(image_fn)
     sbd = SBDWrapper()
     # mask = load_as_gray8(os.path.join('.', 'data', 'sample_mask.jpg'))
     mask = None
@@ -174,40 +236,77 @@ def run_single():
     print(len(keys))
 
 
-def run_sbd(sample_name):
-    sbd = SBDWrapper()
-    image_fns = load_images(sample_name)
-    keyarr = []
-    for image_fn in image_fns:
-        img = imaging.load_grayscale_image(image_fn)
-        imagedef = img, image_fn
-        keys = sbd.process_dynamic_mask(imagedef)
-        keyarr.append(keys)
-    keyarr = list(filter(lambda x: x is not None and x.any(), keyarr))
-    if keyarr:
-        keyarr = np.concatenate(keyarr)
-        res_df = pd.DataFrame(keyarr, columns=['x', 'y', 'r'])
-        res_df.to_csv(os.path.join(utils.Pathing.out_root, sample_name) + '.csv')
+def get_sizes_path(sample_name):
+    return os.path.join(utils.Pathing.out_root, sample_name) + '_sizes.json'
+
+
+def run_sbd(sample_name, threads=None):
+    """
+        Detect keys of the sample, streaming them to csv and the size distribution.
+        Returns number of frames, number of keys and seconds taken.
+    """
+    start_time = time.time()
+    sbd = SBDWrapper(workers=threads)
+    sbd.sizes = stats.SizeDistribution()
+    csv_path = os.path.join(utils.Pathing.out_root, sample_name) + '.csv'
+    os.makedirs(utils.Pathing.out_root, exist_ok=True)
+    n_keys = 0
+    n_frames = 0
+    with open(csv_path, 'w') as f:
+        for start, stack in iter_sample_batches(sample_name):
+            keys = sbd.process_dynamic_batch(stack)
+            keys[:, 3] += start
+            res_df = pd.DataFrame(keys, columns=['x', 'y', 'r', 'image'], index=range(n_keys, n_keys + len(keys)))
+            res_df.to_csv(f, header=start == 0)
+            n_keys += len(keys)
+            n_frames += len(stack)
+    if n_keys:
+        sbd.sizes.save(get_sizes_path(sample_name))
+        print(sbd.sizes)
         build_hist(sample_name)
+    else:
+        os.remove(csv_path)
+    return n_frames, n_keys, time.time() - start_time
 
 
 def hist():
     build_hist('model')
 
 
+def load_sizes(sample_name):
+    """ Size distribution of the sample, built from its csv by chunks when not saved yet """
+    sizes_path = get_sizes_path(sample_name)
+    if os.path.isfile(sizes_path):
+        return stats.SizeDistribution.load(sizes_path)
+    sizes = stats.SizeDistribution()
+    csv_path = os.path.join(utils.Pathing.out_root, sample_name) + '.csv'
+    for chunk in pd.read_csv(csv_path, usecols=['r'], chunksize=100000):
+        sizes.update(chunk['r'].values)
+    sizes.save(sizes_path)
+    return sizes
+
+
+def merge_sizes(sample_names, out_name):
+    """ Merge size distributions of several samples or runs into one """
+    sizes = stats.SizeDistribution()
+    for sample_name in sample_names:
+        sizes.merge(load_sizes(sample_name))
+    sizes.save(get_sizes_path(out_name))
+    print(sizes)
+    return sizes
+
+
 def build_hist(sample_name):
-    res_df = pd.read_csv(os.path.join(utils.Pathing.out_root, sample_name) + '.csv')
-    res_df = res_df['r']
-    res_df.to_excel(os.path.join(utils.Pathing.out_root, sample_name) + '.xlsx')
-    # plt.hist(res_df, bins=[0, 5, 10, 15, 20, 25])
-    plt.hist(res_df)
+    sizes = load_sizes(sample_name)
+    edges, counts = sizes.histogram()
+    sizes.save_histogram(os.path.join(utils.Pathing.out_root, sample_name) + '_hist.csv')
+    plt.hist(edges[:-1], bins=edges, weights=counts)
     plt.xscale('log')
     plt.title('Diameter distribution (ln scale)')
     ax = plt.gca()
     if sample_name == 'model':
         ax.axvline(15, color='black')
-    d_mean = np.exp(np.log(res_df).mean())
-    ax.axvline(d_mean, color='red')
+    ax.axvline(sizes.geometric_mean, color='red')
     ax.xaxis.set_minor_locator(plt.NullLocator())
     ax.xaxis.set_major_locator(plt.MaxNLocator())
     ax.xaxis.set_major_formatter(plt.ScalarFormatter())
@@ -1,8 +1,10 @@
-import collections
+import math
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
+from scipy import spatial
 from skimage import transform
 
 from sensor import imaging
@@ -53,15 +55,103 @@ scan_kwargs = default_kwargs.copy()
 scan_kwargs.update(scan_add_kwargs)
 UM_PER_SCREEN = 519
 
+# [px] margin added to each tile when blob size isn't limited by maxArea
+TILE_OVERLAP = 64
+# number of frames preprocessed at once by process_batch
+BATCH_CHUNK = 16
+
+
+def grid_edges(shape, grid):
+    h, w = shape[:2]
+    rows, cols = grid
+    ys = np.linspace(0, h, rows + 1).astype(int)
+    xs = np.linspace(0, w, cols + 1).astype(int)
+    return ys, xs
+
+
+def grid_boxes(shape, grid):
+    """ Split image of given shape onto (rows, cols) grid of (y0, x0, y1, x1) boxes """
+    rows, cols = grid
+    ys, xs = grid_edges(shape, grid)
+    return [(ys[i], xs[j], ys[i + 1], xs[j + 1]) for i in range(rows) for j in range(cols)]
+
+
+def pad_box(box, overlap, shape):
+    y0, x0, y1, x1 = box
+    h, w = shape[:2]
+    return max(y0 - overlap, 0), max(x0 - overlap, 0), min(y1 + overlap, h), min(x1 + overlap, w)
+
+
+def blob_overlap(kwargs):
+    """ [px] tile margin of the largest blob diameter allowed by maxArea """
+    if not kwargs.get('filterByArea', True):
+        return TILE_OVERLAP
+    return int(math.ceil(2 * math.sqrt(kwargs['maxArea'] / math.pi)))
+
+
+def keys_in_box(keys, box):
+    # keys are (y, x, r), box is half-open so each key belongs to exactly one tile
+    y0, x0, y1, x1 = box
+    y, x = keys[:, 0], keys[:, 1]
+    return (y0 <= y) & (y < y1) & (x0 <= x) & (x < x1)
+
+
+def merge_tile_keys(tile_keys, min_dist):
+    """
+        Concatenate keys found on separate tiles,
+        dropping keys closer than min_dist to a key of another tile (blobs split by the tile border).
+    """
+    tile_keys = [k for k in tile_keys if len(k) > 0]
+    if not tile_keys:
+        return np.empty((0, 3))
+    keys = np.concatenate(tile_keys)
+    tile_ids = np.concatenate([np.full(len(k), i) for i, k in enumerate(tile_keys)])
+    if len(tile_keys) == 1:
+        return keys
+
+    # (i, j) pairs with i < j, sorted
+    pairs = spatial.cKDTree(keys[:, :2]).query_pairs(min_dist, output_type='ndarray')
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    dist = np.hypot(*(keys[pairs[:, 0], :2] - keys[pairs[:, 1], :2]).T)
+    pairs = pairs[(dist < min_dist) & (tile_ids[pairs[:, 0]] != tile_ids[pairs[:, 1]])]
+    keep = np.ones(len(keys), dtype=bool)
+    for i, j in pairs:
+        if keep[i]:
+            # keep the first one, drop its duplicates from the neighbouring tiles
+            keep[j] = False
+    return keys[keep]
+
 
 class SBDWrapper:
 
-    def __init__(self):
+    def __init__(self, tiles=None, tile_overlap=None, workers=None):
         MASK_IMAGE_COUNT = 3
         self.scale_factor = 1
         # mask for static background filtering
-        self.masks = collections.deque(maxlen=MASK_IMAGE_COUNT)
+        self.masks = imaging.RunningMean(window=MASK_IMAGE_COUNT)
         self.pixel_to_um = 0  # 'auto'
+        # (rows, cols) grid to detect tiles of the frame in parallel, None for whole frame detection
+        self.tiles = tiles
+        # [px] margin of tiles, None to derive from maxArea
+        self.tile_overlap = tile_overlap
+        self.workers = workers
+        # pool of tile detection, created on first use and kept across frames
+        self._tile_pool = None
+        # gating.ChangeGate to re-detect only changed blocks of the frame
+        self.gate = None
+        # stats.SizeDistribution updated with sizes of every processed frame
+        self.sizes = None
+
+    @property
+    def tile_pool(self):
+        if self._tile_pool is None:
+            self._tile_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sbd tile')
+        return self._tile_pool
+
+    def close(self):
+        if self._tile_pool is not None:
+            self._tile_pool.shutdown()
+            self._tile_pool = None
 
     def setup_detector(self, **kwargs):
         params = cv2.SimpleBlobDetector_Params()
@@ -86,8 +176,44 @@ class SBDWrapper:
 
         return keys, image_fn, kwargs
 
+    def detect_boxes(self, image, boxes, **kwargs):
+        """
+            Detect keys within each box of the image in a thread pool (opencv releases the GIL).
+            Boxes are padded with tile_overlap, so blobs crossing box border are detected whole,
+            and each key is kept only by the box that holds its center.
+        """
+        overlap = self.tile_overlap if self.tile_overlap is not None else blob_overlap(kwargs)
+
+        def detect_box(box):
+            y0, x0, y1, x1 = pad_box(box, overlap, image.shape)
+            tile = np.ascontiguousarray(image[y0:y1, x0:x1])
+            keys, _, _ = self.detect((tile, None), **kwargs)
+            keys = keys.reshape(-1, 3) + (y0, x0, 0)
+            return keys[keys_in_box(keys, box)]
+
+        tile_keys = list(self.tile_pool.map(detect_box, boxes))
+        return merge_tile_keys(tile_keys, kwargs['minDistBetweenBlobs'])
+
+    def detect_tiled(self, image, **kwargs):
+        if kwargs['maxThreshold'] < kwargs['minThreshold']:
+            return None
+
+        image, image_fn = image
+        boxes = grid_boxes(image.shape, self.tiles)
+        keys = self.detect_boxes(image, boxes, **kwargs)
+        return keys, image_fn, kwargs
+
+    def detect_frame(self, image, **kwargs):
+        detect = self.detect_tiled if self.tiles else self.detect
+        return detect(image, **kwargs)
+
     def update_masks(self, image):
-        self.masks.append(image)
+        self.masks.add(image)
+
+    def check_masks(self, shape):
+        """ Drop mask history of other frame size, e.g. restored from checkpoint before a resolution change """
+        if self.masks.sum is not None and self.masks.sum.shape != tuple(shape):
+            self.masks.clear()
 
     def process_kwargs(self, kwargs):
         min_area_px = 16
@@ -104,15 +230,34 @@ class SBDWrapper:
 
     def process_dynamic_mask(self, imagedef):
         image, image_fn = imagedef
+        self.check_masks(image.shape)
         masks = self.masks
         keys, steps = None, None
-        if len(masks) == masks.maxlen:
-            mask = imaging.mean_pixels(masks)
+        if masks.full:
+            mask = masks.mean()
             mask = mask.astype('uint8')
             keys, steps = self.process(imagedef, mask)
         self.update_masks(image)
         return keys, steps
 
+    def process_dynamic_batch(self, stack):
+        """
+            Batch version of process_dynamic_mask().
+            Frame mask is the mean of previous frames, which carry over between calls.
+        """
+        self.check_masks(stack.shape[1:])
+        masks = []
+        for image in stack:
+            if self.masks.full:
+                masks.append(self.masks.mean().astype('uint8'))
+            self.update_masks(np.array(image))
+        start = len(stack) - len(masks)
+        keys = np.empty((0, 4))
+        if masks:
+            keys = self.process_batch(stack[start:], np.stack(masks))
+            keys[:, 3] += start
+        return keys
+
     def mask_from_integer(self, shape, value):
         assert value < 256
         mask = np.ones(shape, dtype="uint8") * (255 - value)
@@ -144,13 +289,21 @@ class SBDWrapper:
         scale_factor = self.scale_factor
         final_kwargs = self.process_kwargs(kwargs)
         scaled_image = transform.downscale_local_mean(image, (scale_factor, scale_factor)).astype('uint8')
-        keys, _, _ = self.detect((scaled_image, image_fn), **final_kwargs)
+        if self.gate is not None:
+            raw_image = im_original
+            if scale_factor > 1:
+                raw_image = transform.downscale_local_mean(im_original, (scale_factor, scale_factor)).astype('uint8')
+            keys, _, _ = self.gate.detect(self, (scaled_image, image_fn), raw_image=raw_image, **final_kwargs)
+        else:
+            keys, _, _ = self.detect_frame((scaled_image, image_fn), **final_kwargs)
         keys = keys * scale_factor
 
         im_keys = imaging.draw_keys_to_image(image, keys).astype('uint8')
 
         if keys is not None and len(keys) > 0:
             keys[:, 2] = keys[:, 2] * 2 / self.pixel_to_um
+            if self.sizes is not None:
+                self.sizes.update_keys(keys)
 
         steps = [
             ("original", im_original),
@@ -159,3 +312,53 @@ class SBDWrapper:
         ]
 
         return keys, steps
+
+    def preprocess_batch(self, stack, mask=None):
+        """ Vectorized preprocessing of process() over (N, H, W) uint8 stack """
+        if mask is None:
+            mask = stack.mean(axis=(1, 2), keepdims=True)
+        elif type(mask) is int:
+            assert mask < 256
+            mask = np.uint8(255 - mask)
+
+        inverted, inverted_mask = 255 - stack, 255 - mask
+        diff = inverted - inverted_mask
+        diff[np.broadcast_to(inverted_mask > inverted, diff.shape)] = 0
+        images = imaging.rescale_batch(255 - diff, 0, 255)
+
+        scale_factor = self.scale_factor
+        if scale_factor > 1:
+            images = transform.downscale_local_mean(images, (1, scale_factor, scale_factor))
+        return images.astype('uint8')
+
+    def process_batch(self, stack, mask=None, kwargs=None):
+        """
+            Batch version of process() for (N, H, W) uint8 stack, which may be memory-mapped.
+            mask is None (mean of each image), int, (H, W) or per-image (N, H, W) array.
+            Returns single (M, 4) array of (y, x, r, image index) keys.
+        """
+        self.pixel_to_um = stack.shape[2] / UM_PER_SCREEN
+        final_kwargs = self.process_kwargs(kwargs)
+        per_image_mask = mask is not None and np.ndim(mask) == 3
+
+        def detect(image):
+            result = self.detect_frame((image, None), **final_kwargs)
+            if result is None:
+                return np.empty((0, 3))
+            return result[0].reshape(-1, 3)
+
+        batch_keys = [np.empty((0, 4))]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for start in range(0, len(stack), BATCH_CHUNK):
+                chunk = np.asarray(stack[start:start + BATCH_CHUNK])
+                chunk_mask = mask[start:start + BATCH_CHUNK] if per_image_mask else mask
+                images = self.preprocess_batch(chunk, chunk_mask)
+                for i, keys in enumerate(pool.map(detect, images), start):
+                    batch_keys.append(np.column_stack([keys, np.full(len(keys), i)]))
+
+        keys = np.concatenate(batch_keys)
+        keys[:, :3] *= self.scale_factor
+        keys[:, 2] = keys[:, 2] * 2 / self.pixel_to_um
+        if self.sizes is not None:
+            self.sizes.update_keys(keys)
+        return keys
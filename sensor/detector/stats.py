@@ -0,0 +1,208 @@
+"""
+    Streaming size distribution of detected particles.
+
+    Sizes are accumulated per frame into fixed log-spaced histogram bins and a quantile sketch,
+    so summaries never need all detections in memory. Distributions of different samples
+    and runs are merged by adding their counts.
+"""
+import json
+import math
+
+import numpy as np
+
+# [um] histogram range, sizes outside go to the under/overflow bins
+SIZE_MIN = 0.1
+SIZE_MAX = 1000
+BINS_PER_DECADE = 20
+# relative error of sketch quantiles
+SKETCH_ACCURACY = 0.01
+
+
+def log_bin_edges(size_min=SIZE_MIN, size_max=SIZE_MAX, bins_per_decade=BINS_PER_DECADE):
+    n_bins = int(round(math.log10(size_max / size_min) * bins_per_decade))
+    return np.logspace(math.log10(size_min), math.log10(size_max), n_bins + 1)
+
+
+class QuantileSketch:
+    """
+        Mergeable quantile sketch with bounded relative error (DDSketch-like).
+        Positive values fall into logarithmic buckets of ratio gamma = (1 + a) / (1 - a),
+        so any reported quantile is within `accuracy` of the true value.
+    """
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64').ravel()
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        if len(positive):
+            idx = np.ceil(np.log(positive) / self.log_gamma).astype('int64')
+            for k, n in zip(*np.unique(idx, return_counts=True)):
+                self.buckets[int(k)] = self.buckets.get(int(k), 0) + int(n)
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError('Sketches must have the same accuracy.')
+        for k, n in other.buckets.items():
+            self.buckets[k] = self.buckets.get(k, 0) + n
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if rank < seen:
+                return 2 * self.gamma ** k / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {'accuracy': self.accuracy, 'zero_count': self.zero_count,
+                'buckets': {str(k): n for k, n in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['accuracy'])
+        sketch.buckets = {int(k): n for k, n in d['buckets'].items()}
+        sketch.zero_count = d['zero_count']
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        return sketch
+
+
+class SizeDistribution:
+    """
+        Histogram, moments and quantile sketch of particle sizes, updated per frame.
+        counts[0] and counts[-1] are under- and overflow of the log-spaced bins.
+    """
+
+    def __init__(self, edges=None, accuracy=SKETCH_ACCURACY):
+        self.edges = log_bin_edges() if edges is None else np.asarray(edges, dtype='float64')
+        self.counts = np.zeros(len(self.edges) + 1, dtype='int64')
+        self.sketch = QuantileSketch(accuracy)
+        self.count = 0
+        self.sum = 0.0
+        self.sum_log = 0.0
+        self.sum_cube = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, sizes):
+        sizes = np.asarray(sizes, dtype='float64').ravel()
+        if not len(sizes):
+            return
+        self.counts += np.bincount(np.searchsorted(self.edges, sizes, side='right'), minlength=len(self.counts))
+        self.sketch.update(sizes)
+        self.count += len(sizes)
+        self.sum += sizes.sum()
+        self.sum_log += np.log(sizes[sizes > 0]).sum()
+        self.sum_cube += (sizes ** 3).sum()
+        self.min = min(self.min, sizes.min())
+        self.max = max(self.max, sizes.max())
+
+    def update_keys(self, keys):
+        """ Update with sizes of (y, x, size, ...) detector keys """
+        if keys is not None and len(keys):
+            self.update(np.asarray(keys)[:, 2])
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Distributions must have the same bins.')
+        self.counts += other.counts
+        self.sketch.merge(other.sketch)
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_log += other.sum_log
+        self.sum_cube += other.sum_cube
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    @property
+    def geometric_mean(self):
+        n_positive = self.count - self.sketch.zero_count
+        return math.exp(self.sum_log / n_positive) if n_positive else 0.0
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+    def histogram(self):
+        """ (edges, counts) of the log-spaced bins, without under/overflow """
+        return self.edges, self.counts[1:-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'geometric_mean': self.geometric_mean,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'p10': self.quantile(0.1),
+            'median': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+        }
+
+    def to_dict(self):
+        return {
+            'edges': self.edges.tolist(),
+            'counts': self.counts.tolist(),
+            'sketch': self.sketch.to_dict(),
+            'count': self.count,
+            'sum': self.sum,
+            'sum_log': self.sum_log,
+            'sum_cube': self.sum_cube,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        dist = cls(d['edges'], d['sketch']['accuracy'])
+        dist.counts = np.asarray(d['counts'], dtype='int64')
+        dist.sketch = QuantileSketch.from_dict(d['sketch'])
+        dist.count = d['count']
+        dist.sum = d['sum']
+        dist.sum_log = d['sum_log']
+        dist.sum_cube = d['sum_cube']
+        if dist.count:
+            dist.min, dist.max = d['min'], d['max']
+        return dist
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def save_histogram(self, path):
+        """ Histogram as csv of bin_start;bin_end;count """
+        edges, counts = self.histogram()
+        with open(path, 'w') as f:
+            f.write('bin_start;bin_end;count\n')
+            for lo, hi, n in zip(edges[:-1], edges[1:], counts):
+                f.write('%f;%f;%d\n' % (lo, hi, n))
+
+    def __str__(self):
+        if not self.count:
+            return 'No sizes'
+        return '%d sizes, geometric mean %.3f, median %.3f, p10-p90 %.3f-%.3f' % (
+            self.count, self.geometric_mean, self.quantile(0.5), self.quantile(0.1), self.quantile(0.9))
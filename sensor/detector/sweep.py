@@ -0,0 +1,200 @@
+"""
+    Parallel, resumable parameter sweep for detector tuning.
+
+    Every (params, image) pair is a job for the process pool.
+    Images are preprocessed once and shared with the workers as a memory-mapped .npy stack.
+    Results are appended to a json-lines file keyed by the hash of images, mask and parameters,
+    so an interrupted sweep resumes from the parameter sets it hasn't finished, and sets that failed are retried.
+"""
+import collections
+import hashlib
+import heapq
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sensor import imaging, utils
+from sensor.detector import cache
+from sensor.detector.sbd import SBDWrapper, UM_PER_SCREEN, BATCH_CHUNK
+
+# number of best parameter sets to report
+N_BEST = 5
+# parameter sets submitted to the pool ahead of the one being collected, per worker
+WINDOW_PER_WORKER = 2
+
+_worker = {}
+
+
+def images_hash(groups):
+    """ Hash of image groups, changes when images are added, renamed or modified """
+    h = hashlib.sha1()
+    for name, fns in groups.items():
+        h.update(name.encode())
+        for fn in fns:
+            st = os.stat(fn)
+            h.update(('%s:%d:%d' % (os.path.abspath(fn), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+
+def run_hash(images_key, mask_key, params):
+    key = '%s:%s:%s' % (images_key, mask_key, cache.params_key(params))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _init_worker(stack_path, pixel_to_um):
+    _worker['stack'] = np.load(stack_path, mmap_mode='r')
+    _worker['sbd'] = SBDWrapper()
+    _worker['sbd'].pixel_to_um = pixel_to_um
+
+
+def _detect_job(params, image_idx):
+    sbd = _worker['sbd']
+    image = np.asarray(_worker['stack'][image_idx])
+    result = sbd.detect_frame((image, None), **sbd.process_kwargs(params))
+    if result is None:
+        return 0
+    return len(result[0])
+
+
+def sum_score(counts):
+    return sum(counts.values())
+
+
+def load_results(results_path):
+    """ Last result row of each hash, error rows included """
+    results = {}
+    if os.path.isfile(results_path):
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # last line of an interrupted sweep may be truncated
+                    continue
+                results[row['hash']] = row
+    return results
+
+
+def best_results(results_path, n=N_BEST, hashes=None):
+    """ n best rows, of given hashes only if set """
+    rows = [r for h, r in load_results(results_path).items() if 'score' in r and (hashes is None or h in hashes)]
+    return heapq.nlargest(n, rows, key=lambda r: r['score'])
+
+
+class Sweep:
+    """
+        Sweep detector parameters over groups of images.
+        groups - {group name: list of image paths}, all images have the same shape;
+        score - function of {group name: number of keys} to rank parameter sets by.
+    """
+
+    def __init__(self, groups, param_sets, results_path, mask=None, score=sum_score, workers=None,
+                 image_cache=None):
+        self.groups = groups
+        self.param_sets = list(param_sets)
+        self.results_path = results_path
+        self.stack_path = os.path.splitext(results_path)[0] + '_images.npy'
+        self.mask = mask
+        self.score = score
+        self.workers = workers or os.cpu_count()
+        self.image_cache = image_cache
+        self.best = []
+        self.best_score = None
+
+    def prepare_stack(self):
+        """ Preprocess all images once into the memory-mapped stack shared by workers """
+        image_fns = [fn for fns in self.groups.values() for fn in fns]
+        first = imaging.load_grayscale_image(image_fns[0])
+        sbd = SBDWrapper()
+        shape = (len(image_fns),) + tuple(s // sbd.scale_factor for s in first.shape)
+        os.makedirs(os.path.dirname(os.path.abspath(self.stack_path)), exist_ok=True)
+        stack = np.lib.format.open_memmap(self.stack_path, mode='w+', dtype='uint8', shape=shape)
+        if self.image_cache is not None:
+            images = utils.prefetch_map(lambda fn: self.image_cache.load_preprocessed(fn, sbd, self.mask), image_fns)
+            for i, image in enumerate(images):
+                stack[i] = image
+            print(self.image_cache)
+        else:
+            images = imaging.iter_images(image_fns, depth=2 * BATCH_CHUNK)
+            start = 0
+            for batch in utils.batched(images, BATCH_CHUNK):
+                chunk = np.stack([image for image, _ in batch])
+                stack[start:start + len(chunk)] = sbd.preprocess_batch(chunk, self.mask)
+                start += len(chunk)
+        stack.flush()
+        return first.shape[1] / UM_PER_SCREEN
+
+    def image_groups(self):
+        idx = 0
+        for name, fns in self.groups.items():
+            for _ in fns:
+                yield idx, name
+                idx += 1
+
+    def report(self, row, verbose=True):
+        if len(self.best) < N_BEST:
+            heapq.heappush(self.best, (row['score'], row['hash'], row))
+        elif row['score'] > self.best[0][0]:
+            heapq.heapreplace(self.best, (row['score'], row['hash'], row))
+        if self.best_score is None or row['score'] > self.best_score:
+            self.best_score = row['score']
+            if verbose:
+                print('New best score %s: %s %s' % (row['score'], row['counts'], row['params']))
+
+    def write_result(self, f, row):
+        f.write(json.dumps(row, default=float) + '\n')
+        f.flush()
+
+    def run(self):
+        # failed sets are run again
+        done = {h: row for h, row in load_results(self.results_path).items() if 'score' in row}
+        images_key, mask_key = images_hash(self.groups), cache.mask_key(self.mask)
+        hashes = {run_hash(images_key, mask_key, params): params for params in self.param_sets}
+        pending = {}
+        for h, params in hashes.items():
+            if h in done:
+                self.report(done[h], verbose=False)
+            else:
+                pending[h] = params
+        print('%d of %d parameter sets done, %d to go' % (len(hashes) - len(pending), len(hashes), len(pending)))
+        if not pending:
+            return best_results(self.results_path, hashes=hashes)
+
+        pixel_to_um = self.prepare_stack()
+        image_groups = list(self.image_groups())
+        start = time.time()
+        try:
+            with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                     initargs=(self.stack_path, pixel_to_um)) as pool, \
+                    open(self.results_path, 'a') as f:
+                # sets are submitted in a window, so only its futures are held and workers stay busy
+                to_submit = iter(pending.items())
+                window = collections.deque()
+                window_size = WINDOW_PER_WORKER * self.workers
+                for i in range(1, len(pending) + 1):
+                    for h, params in to_submit:
+                        window.append((h, [pool.submit(_detect_job, params, idx) for idx, _ in image_groups]))
+                        if len(window) >= window_size:
+                            break
+                    h, futures = window.popleft()
+                    row = {'hash': h, 'params': pending[h]}
+                    try:
+                        counts = dict.fromkeys(self.groups, 0)
+                        for (_, name), future in zip(image_groups, futures):
+                            counts[name] += future.result()
+                        row.update(counts=counts, score=self.score(counts))
+                        self.report(row)
+                    except Exception as e:
+                        print('Error for params %s' % pending[h])
+                        traceback.print_exc()
+                        row['error'] = repr(e)
+                    self.write_result(f, row)
+                    rate = i / (time.time() - start)
+                    print('%d/%d parameter sets, %.2f sets/s' % (i, len(pending), rate))
+        finally:
+            os.remove(self.stack_path)
+        return best_results(self.results_path, hashes=hashes)
@@ -1,5 +1,8 @@
+import collections
+import csv
 import os
 
+import cv2
 import numpy as np
 from PIL import Image as PILImage
 from scipy import ndimage
@@ -7,10 +10,73 @@ from skimage import color, draw, feature, filters, io
 from skimage.color import rgb2gray
 from skimage.measure import regionprops
 
+from sensor import utils
+
+
+# default decoder for load_image, "cv2" or "pil"
+DECODE_ENGINE = "cv2"
+
+# JPEG is decoded with DCT scaling at 1/2, 1/4 and 1/8 resolution
+_cv2_flags = {
+    ("L", 1): cv2.IMREAD_GRAYSCALE,
+    ("L", 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    ("L", 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    ("L", 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    ("RGB", 1): cv2.IMREAD_COLOR,
+    ("RGB", 2): cv2.IMREAD_REDUCED_COLOR_2,
+    ("RGB", 4): cv2.IMREAD_REDUCED_COLOR_4,
+    ("RGB", 8): cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def decode_cv2(filepath, mode="RGB", reduce=1, out=None):
+    """
+        Decode straight into numpy array.
+        Grayscale of a color JPEG is its luma channel, which may differ from PIL conversion by a few levels.
+    """
+    # np.fromfile handles non-ascii paths, unlike cv2.imread
+    data = np.fromfile(filepath, dtype='uint8')
+    image = cv2.imdecode(data, _cv2_flags[(mode, reduce)])
+    if image is None:
+        raise OSError("Can't decode image %s" % filepath)
+    if mode == "RGB":
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=out)
+    if out is not None:
+        np.copyto(out, image)
+        return out
+    return image
+
 
-def load_image(filepath, mode="RGB", dtype="uint8"):
-    image = PILImage.open(filepath).convert(mode)
-    image = np.array(image, dtype)
+def decode_pil(filepath, mode="RGB", reduce=1, out=None):
+    image = PILImage.open(filepath)
+    if reduce > 1:
+        width = image.width
+        # JPEG is decoded with DCT scaling, the rest of the reduction is done after decoding
+        image.draft(mode, (width // reduce, image.height // reduce))
+        drafted = round(width / image.width)
+        if drafted < reduce:
+            image = image.reduce(reduce // drafted)
+    image = image.convert(mode)
+    if out is not None:
+        np.copyto(out, np.asarray(image))
+        return out
+    return np.array(image)
+
+
+def load_image(filepath, mode="RGB", dtype="uint8", reduce=1, out=None, engine=None):
+    """
+        Load image as numpy array.
+        :reduce - decode at 1/reduce resolution (1, 2, 4, 8)
+        :out - caller-provided buffer to decode into
+        :engine - "cv2" or "pil", DECODE_ENGINE by default
+    """
+    engine = engine or DECODE_ENGINE
+    if engine == "cv2" and (mode, reduce) in _cv2_flags:
+        image = decode_cv2(filepath, mode, reduce, out)
+    else:
+        image = decode_pil(filepath, mode, reduce, out)
+    if image.dtype != np.dtype(dtype):
+        image = image.astype(dtype)
     return image
 
 
@@ -19,19 +85,115 @@ def save_image(image, filepath):
     image.save(filepath)
 
 
-def load_grayscale_image(filepath):
-    return load_image(filepath, "L")
-
-
-def load_rgb_image(filepath):
-    return load_image(filepath, "RGB")
+def load_grayscale_image(filepath, reduce=1, out=None):
+    return load_image(filepath, "L", reduce=reduce, out=out)
+
+
+def load_rgb_image(filepath, reduce=1, out=None):
+    return load_image(filepath, "RGB", reduce=reduce, out=out)
+
+
+def iter_images(image_fps, loader=None, preprocess=None, depth=utils.PREFETCH_DEPTH, workers=utils.PREFETCH_WORKERS):
+    """
+        Decode and optionally preprocess images in background threads,
+        yielding (image, path) imagedefs in order.
+    """
+    loader = loader or load_grayscale_image
+
+    def load(fp):
+        image = loader(fp)
+        if preprocess is not None:
+            image = preprocess(image)
+        return image, fp
+
+    return utils.prefetch_map(load, image_fps, depth, workers)
+
+
+STACK_FN = 'stack.npy'
+STACK_INDEX_FN = 'stack.csv'
+
+
+def pack_image_stack(sample_dir):
+    """
+        Convert folder of images into single (N, H, W) uint8 grayscale stack file
+        and an index of original filenames and capture timestamps, both saved into the folder.
+    """
+    image_fps = [fp for _, fp in utils.list_images(sample_dir)]
+    image_fps.sort(key=lambda fp: (utils.parse_image_time(fp), fp))
+    if not image_fps:
+        raise ValueError('No images found in %s' % sample_dir)
+
+    shape = load_grayscale_image(image_fps[0]).shape
+    stack_path = os.path.join(sample_dir, STACK_FN)
+    stack = np.lib.format.open_memmap(stack_path + '.tmp', mode='w+', dtype='uint8',
+                                      shape=(len(image_fps),) + shape)
+    index = []
+    for fp in image_fps:
+        try:
+            load_grayscale_image(fp, out=stack[len(index)])
+        except ValueError:
+            print('Skipping %s: image shape differs from %s' % (fp, shape))
+            continue
+        index.append((os.path.basename(fp), utils.parse_image_time(fp)))
+    stack.flush()
+    del stack
+
+    if len(index) < len(image_fps):
+        # drop slots of skipped images
+        frames = np.load(stack_path + '.tmp', mmap_mode='r')[:len(index)]
+        np.save(stack_path, frames)
+        del frames
+        os.remove(stack_path + '.tmp')
+    else:
+        os.replace(stack_path + '.tmp', stack_path)
+
+    with open(os.path.join(sample_dir, STACK_INDEX_FN), 'w', newline='') as f:
+        w = csv.writer(f, delimiter=';')
+        for i, (fn, timestamp) in enumerate(index):
+            w.writerow([i, fn, '%.6f' % timestamp])
+    return stack_path
+
+
+class ImageStack:
+    """
+        Memory-mapped frames of the folder packed with pack_image_stack().
+        Frames are read from disk on access without decoding or copying.
+    """
+
+    def __init__(self, sample_dir):
+        self.sample_dir = sample_dir
+        self.frames = np.load(os.path.join(sample_dir, STACK_FN), mmap_mode='r')
+        self.filenames = []
+        self.timestamps = []
+        with open(os.path.join(sample_dir, STACK_INDEX_FN), newline='') as f:
+            for _, fn, timestamp in csv.reader(f, delimiter=';'):
+                self.filenames.append(fn)
+                self.timestamps.append(float(timestamp))
+
+    @staticmethod
+    def exists(sample_dir):
+        return (os.path.isfile(os.path.join(sample_dir, STACK_FN))
+                and os.path.isfile(os.path.join(sample_dir, STACK_INDEX_FN)))
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+    def paths(self):
+        return [os.path.join(self.sample_dir, fn) for fn in self.filenames]
+
+    def imagedefs(self):
+        for frame, path in zip(self.frames, self.paths()):
+            yield frame, path
 
 
 def draw_keys_to_image(image, keys):
     im_keys = np.copy(image)
     im_keys = color.gray2rgb(im_keys)
 
-    keys = keys.astype(np.int)
+    keys = keys.astype(int)
     for key in keys:
         y, x, r = key
         rr, cc = draw.circle_perimeter(y, x, r, shape=im_keys.shape)
@@ -49,6 +211,119 @@ def mean_pixels(images):
     return np.mean(images, axis=0)
 
 
+class RunningMean:
+    """
+        Incremental pixel mean of a stream of same-shaped images, O(1) per image.
+        window=None keeps the mean of all images so far,
+        otherwise the mean of the last `window` images, which are kept in a ring buffer.
+    """
+
+    def __init__(self, window=None):
+        self.window = window
+        self.frames = collections.deque(maxlen=window) if window else None
+        self.sum = None
+        self.count = 0
+
+    def add(self, image):
+        if self.sum is None:
+            # exact integer sum for uint8 images
+            dtype = 'uint32' if image.dtype == np.uint8 else 'float64'
+            self.sum = np.zeros(image.shape, dtype=dtype)
+        elif image.shape != self.sum.shape:
+            raise ValueError('Images must have the same shape.')
+
+        self.sum += image
+        if self.window:
+            if len(self.frames) == self.window:
+                self.sum -= self.frames[0]
+            self.frames.append(image)
+            self.count = len(self.frames)
+        else:
+            self.count += 1
+
+    @property
+    def full(self):
+        return self.window is not None and self.count == self.window
+
+    def mean(self):
+        return self.sum / self.count
+
+    def clear(self):
+        self.__init__(self.window)
+
+    def get_state(self, reduce=1):
+        """
+            Sum and count, integer sum in the smallest dtype that holds it.
+            With reduce > 1 the sum is averaged over reduce x reduce blocks and scaled back up by set_state().
+        """
+        if self.sum is None:
+            return {}
+        total = self.sum
+        state = {}
+        if reduce > 1:
+            h, w = total.shape[:2]
+            pad = [(0, -h % reduce), (0, -w % reduce)] + [(0, 0)] * (total.ndim - 2)
+            padded = np.pad(total, pad, mode='edge')
+            blocks = padded.reshape((padded.shape[0] // reduce, reduce, padded.shape[1] // reduce, reduce)
+                                    + total.shape[2:])
+            total = blocks.mean(axis=(1, 3))
+            if self.sum.dtype.kind == 'u':
+                total = np.rint(total).astype(self.sum.dtype)
+            state['shape'] = np.asarray(self.sum.shape)
+            state['reduce'] = np.asarray(reduce)
+        if total.dtype.kind == 'u':
+            total = total.astype(np.min_scalar_type(int(total.max())))
+        state.update(sum=total, count=np.asarray(self.count))
+        return state
+
+    def set_state(self, state):
+        """
+            Frames of a window aren't saved, they are restored as equal parts of the sum,
+            so the mean is exact and turns to the mean of new frames as they replace the parts.
+        """
+        self.clear()
+        if 'frames' in state:
+            for image in state['frames']:
+                self.add(image)
+        elif 'sum' in state:
+            total = np.asarray(state['sum'])
+            count = int(state['count'])
+            if 'reduce' in state:
+                reduce = int(state['reduce'])
+                h, w = state['shape'][:2]
+                total = total.repeat(reduce, axis=0).repeat(reduce, axis=1)[:h, :w]
+            if self.window and count > self.window:
+                # window got shorter, start over
+                return
+            if total.dtype.kind == 'u':
+                self.sum = total.astype('uint32')
+                base, remainder = np.divmod(self.sum, count)
+                parts = [(base + (k < remainder)).astype('uint8') for k in range(count)] if self.window else []
+            else:
+                self.sum = total.astype('float64')
+                parts = [self.sum / count] * count if self.window else []
+            self.count = count
+            if self.window:
+                self.frames.extend(parts)
+
+
+def prefix_means(images):
+    """ Yield mean of the first 1, 2, ..., N images in a single pass """
+    running = RunningMean()
+    for image in images:
+        running.add(image)
+        yield running.mean()
+
+
+def sliding_means(images, width):
+    """ Yield mean of every `width` consecutive images in a single pass """
+    running = RunningMean(window=width)
+    for image in images:
+        running.add(image)
+        if running.full:
+            yield running.mean()
+
+
 def subtract_image(image, minus_image):
     if image.shape != minus_image.shape:
         raise ValueError('Images must have the same shape.')
@@ -86,6 +361,16 @@ def rescale(image, a, b):
     return image
 
 
+def rescale_batch(images, a, b):
+    """ rescale() applied to each image of (N, H, W) stack """
+    a0 = images.min(axis=(1, 2), keepdims=True)
+    b0 = images.max(axis=(1, 2), keepdims=True)
+    flat = b0 == a0
+    k = (b - a) / np.where(flat, 1, b0 - a0)
+    rescaled = ((images - a0) * k + a).astype('uint8')
+    return np.where(flat, images, rescaled)
+
+
 def blob_search(img, **kwargs):
     inverted = np.copy(img)
     # inverted = 255 - inverted
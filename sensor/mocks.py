@@ -4,6 +4,9 @@ from unittest import mock
 from sensor import utils, imaging
 import numpy as np
 
+# sample images decoded and kept in memory by mock_capture_images(), the rest of the folder isn't used
+DECODED_IMAGES = 8
+
 
 class MockButton:
     is_pressed = True
@@ -24,12 +27,26 @@ def cyclic_list_images(dirname, limit=0):
 
 
 def mock_capture_images(path=utils.Pathing.sample_images_path):
-    image_files = cyclic_list_images(path)
+    """ Cycle through sample images of the folder, frames of its packed stack are used when there is one """
+    if imaging.ImageStack.exists(path):
+        return mock_capture_stack(path)
+    images = itertools.cycle([imaging.load_image(fp)
+                              for _, fp in itertools.islice(utils.list_images(path), DECODED_IMAGES)])
+
+    def get_next_image(*args, **kwargs):
+        return next(images).copy()
+
+    return get_next_image
+
+
+def mock_capture_stack(path=utils.Pathing.sample_images_path):
+    """ Cycle through frames of the folder packed with imaging.pack_image_stack() """
+    frames = itertools.cycle(imaging.ImageStack(path).frames)
 
     def get_next_image(*args, **kwargs):
-        image_fn = next(image_files)
-        img = imaging.load_image(image_fn)
-        return img
+        frame = next(frames)
+        # camera returns rgb
+        return np.repeat(frame[:, :, None], 3, axis=2)
 
     return get_next_image
 
@@ -10,7 +10,15 @@ def is_windows():
 
 
 def is_ubuntu():
-    return platform.system() == "Linux" and platform.linux_distribution()[0] == "Ubuntu"
+    if platform.system() != "Linux":
+        return False
+    if hasattr(platform, 'linux_distribution'):
+        return platform.linux_distribution()[0] == "Ubuntu"
+    # linux_distribution() is removed since Python 3.8
+    try:
+        return platform.freedesktop_os_release().get('ID') == 'ubuntu'
+    except (AttributeError, OSError):
+        return False
 
 
 def import_leds():
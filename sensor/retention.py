@@ -0,0 +1,142 @@
+"""
+    Retention of saved frames: the image folder is a ring buffer bounded by a byte quota,
+    frame age and a free disk space floor, the oldest frames are evicted first.
+"""
+import collections
+import os
+import time
+
+from skimage import io
+
+from sensor import imaging, settings, utils
+
+# [MB] frames are evicted to keep at least this much free space
+MIN_FREE_MB = 4096
+# [s] free space is queried at this period and estimated from written/evicted bytes in between
+FREE_SPACE_PERIOD = 30
+# thumbnails are decoded at 1/THUMBNAIL_REDUCE resolution
+THUMBNAIL_REDUCE = 8
+THUMBNAIL_SUFFIX = '_thumb'
+# what to do with frames without detections
+KEEP_ALL = 'all'
+KEEP_THUMBNAIL = 'thumbnail'
+KEEP_NONE = 'none'
+
+
+class FreeSpace:
+    """ Cached free space of the disk of path """
+
+    def __init__(self, path, period=FREE_SPACE_PERIOD):
+        self.path = path
+        self.period = period
+        self.free_mb = None
+        self.last_check = 0
+
+    def get(self):
+        if self.free_mb is None or time.time() - self.last_check >= self.period:
+            self.free_mb = utils.get_free_space(self.path)
+            self.last_check = time.time()
+        return self.free_mb
+
+    def add_bytes(self, n_bytes):
+        """ Account for bytes written (positive) or freed (negative) since the last check """
+        if self.free_mb is not None:
+            self.free_mb -= n_bytes / 1024 / 1024
+
+
+class FrameRetention:
+    """
+        Index of saved frames (path: size, save time) in the order they were saved.
+        quota_mb / max_age_days of 0 don't limit frames by size / age.
+        Low free space evicts frames only with evict_low_space, saving stops otherwise.
+    """
+
+    def __init__(self, image_dir=None, quota_mb=None, max_age_days=None, keep_empty=None, min_free_mb=MIN_FREE_MB,
+                 evict_low_space=None):
+        config = settings.get_config()['DEFAULT']
+        self.image_dir = image_dir or utils.Pathing.image_dir
+        self.quota_bytes = 1024 * 1024 * (config.getfloat('frames_quota_mb') if quota_mb is None else quota_mb)
+        max_age_days = config.getfloat('frames_max_age_days') if max_age_days is None else max_age_days
+        self.max_age = max_age_days * 24 * 3600
+        self.keep_empty = keep_empty or config['frames_keep_empty']
+        self.min_free_mb = min_free_mb
+        if evict_low_space is None:
+            evict_low_space = config.getboolean('frames_evict_low_space')
+        self.evict_low_space = evict_low_space
+        self.free_space = FreeSpace(os.path.dirname(os.path.abspath(self.image_dir)))
+
+        self.frames = collections.OrderedDict()
+        self.total_bytes = 0
+        self.n_evicted = 0
+        self.scan()
+
+    def scan(self):
+        """ Index frames already in the image folder, oldest first """
+        if not os.path.isdir(self.image_dir):
+            return
+        entries = []
+        for entry in os.scandir(self.image_dir):
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        for mtime, path, size in sorted(entries):
+            self.frames[path] = (size, mtime)
+            self.total_bytes += size
+
+    def add(self, path):
+        size = os.path.getsize(path)
+        old_size = self.frames.pop(path, (0, 0))[0]
+        self.frames[path] = (size, time.time())
+        self.total_bytes += size - old_size
+        self.free_space.add_bytes(size - old_size)
+
+    def remove(self, path):
+        size, _ = self.frames.pop(path, (0, 0))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self.total_bytes -= size
+        self.free_space.add_bytes(-size)
+
+    def save(self, path, image):
+        """ Save the frame, evicting old frames to make room """
+        self.evict()
+        if self.free_space.get() <= self.min_free_mb:
+            print("Not enough free space to save %s" % path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        io.imsave(path, image)
+        self.add(path)
+        return True
+
+    def set_detections(self, path, n_particles):
+        """ Apply keep_empty policy to the saved frame once it's processed """
+        if n_particles or path not in self.frames or self.keep_empty == KEEP_ALL:
+            return
+        if self.keep_empty == KEEP_THUMBNAIL:
+            name, ext = os.path.splitext(path)
+            thumb_path = name + THUMBNAIL_SUFFIX + ext
+            io.imsave(thumb_path, imaging.load_image(path, "L", reduce=THUMBNAIL_REDUCE))
+            self.remove(path)
+            self.add(thumb_path)
+        else:
+            self.remove(path)
+
+    def over_limits(self):
+        if not self.frames:
+            return False
+        _, oldest_time = next(iter(self.frames.values()))
+        return ((self.quota_bytes and self.total_bytes > self.quota_bytes)
+                or (self.max_age and time.time() - oldest_time > self.max_age)
+                or (self.evict_low_space and self.free_space.get() <= self.min_free_mb))
+
+    def evict(self):
+        """ Evict oldest frames while frames are over the quota, too old or disk is too full (if allowed) """
+        while self.over_limits():
+            self.remove(next(iter(self.frames)))
+            self.n_evicted += 1
+
+    def __str__(self):
+        return 'Frames: %d, %.1f MB, %d evicted, %.0f MB free' % (
+            len(self.frames), self.total_bytes / 1024 / 1024, self.n_evicted, self.free_space.get())
@@ -0,0 +1,84 @@
+"""
+    Rolling statistics of a stream of values in O(1) per value and per query.
+"""
+import numpy as np
+
+
+class RollingStats:
+    """
+        Ring buffer of running sums of the last `history` values and their squares.
+        Sum, mean, variance and rate of change of any window up to `history` values
+        are differences of two running sums, so several windows are reported without rescanning.
+    """
+
+    def __init__(self, history):
+        self.history = history
+        self.cum = np.zeros(history + 1)
+        self.cum_sq = np.zeros(history + 1)
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.total_sq += value * value
+        slot = self.count % (self.history + 1)
+        self.cum[slot] = self.total
+        self.cum_sq[slot] = self.total_sq
+        if self.count % self.history == 0:
+            self.rebase()
+
+    def get_state(self):
+        return {'cum': self.cum, 'cum_sq': self.cum_sq,
+                'sums': np.array([self.count, self.total, self.total_sq])}
+
+    def set_state(self, state):
+        if len(state['cum']) != self.history + 1:
+            # history length changed, start over
+            return
+        self.cum = np.array(state['cum'])
+        self.cum_sq = np.array(state['cum_sq'])
+        count, self.total, self.total_sq = state['sums']
+        self.count = int(count)
+
+    def rebase(self):
+        """ Keep running sums small, so differences of them don't lose precision """
+        base, base_sq = self.total, self.total_sq
+        self.cum -= base
+        self.cum_sq -= base_sq
+        self.total, self.total_sq = 0.0, 0.0
+
+    def size(self, window):
+        return min(window, self.count, self.history)
+
+    def window_sums(self, window):
+        n = self.size(window)
+        slot = (self.count - n) % (self.history + 1)
+        return n, self.total - self.cum[slot], self.total_sq - self.cum_sq[slot]
+
+    def sum(self, window):
+        return self.window_sums(window)[1]
+
+    def mean(self, window):
+        n, s, _ = self.window_sums(window)
+        return s / n if n else 0.0
+
+    def var(self, window):
+        n, s, s_sq = self.window_sums(window)
+        if not n:
+            return 0.0
+        mean = s / n
+        return max(s_sq / n - mean * mean, 0.0)
+
+    def rate(self, window):
+        """ Relative change of the sum of the last window against the window before it, None without history """
+        if 2 * window > min(self.count, self.history):
+            return None
+        s1 = self.sum(window)
+        s0 = self.sum(2 * window) - s1
+        return (s1 - s0) / s0 if s0 != 0 else 0
+
+    def summary(self, windows):
+        """ {window: (mean, var, rate)} """
+        return {w: (self.mean(w), self.var(w), self.rate(w)) for w in windows}
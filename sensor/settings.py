@@ -9,7 +9,22 @@ defaults = {
     'send_states': 'True',
     'param_1_th': '0.0',
     'param_2_th': '0.0',
-    'min_delay': '0.1',
+    # [s] bounds of the delay between sent CAN frames, adapted to the bus load
+    'min_delay': '0.002',
+    'max_delay': '0.5',
+    # [s] fsync db files at this period, 0 to leave it to the os
+    'db_fsync_period': '0',
+    # saved frames quota, 0 for no limit
+    'frames_quota_mb': '0',
+    'frames_max_age_days': '0',
+    # frames without detections: all / thumbnail / none
+    'frames_keep_empty': 'all',
+    # evict saved frames when free space is low, otherwise frames aren't saved until there's space
+    'frames_evict_low_space': 'False',
+    # [s] restore state from checkpoint not older than this
+    'checkpoint_max_age': '3600',
+    # [s] between checkpoints of the work loop
+    'checkpoint_period': '900',
 }
 
 
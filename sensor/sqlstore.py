@@ -0,0 +1,134 @@
+"""
+    SQLite store of detection results, an alternative to the text dbs of DataWriter.
+
+    Database is in WAL mode and written in batched transactions. Snaps are indexed by image index
+    and capture time, so frames in a time range or with many particles are found without scanning.
+"""
+import os
+import sqlite3
+
+from sensor import utils
+
+STORE_FN = 'detections.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snaps (
+    idx INTEGER, path TEXT, time REAL, n_particles INTEGER, mean_diam REAL, duty INTEGER, d_param REAL);
+CREATE TABLE IF NOT EXISTS diams (idx INTEGER, diam REAL);
+CREATE TABLE IF NOT EXISTS loads (idx INTEGER, d_param_sum REAL);
+CREATE INDEX IF NOT EXISTS snaps_idx ON snaps (idx);
+CREATE INDEX IF NOT EXISTS snaps_time ON snaps (time);
+CREATE INDEX IF NOT EXISTS diams_idx ON diams (idx);
+CREATE INDEX IF NOT EXISTS loads_idx ON loads (idx);
+"""
+
+# table: insert statement
+INSERTS = {
+    'snaps': 'INSERT INTO snaps VALUES (?, ?, ?, ?, ?, ?, ?)',
+    'diams': 'INSERT INTO diams VALUES (?, ?)',
+    'loads': 'INSERT INTO loads VALUES (?, ?)',
+}
+# table: text row format of DataWriter
+TEXT_FMTS = {
+    'snaps': '%d;%s;%d;%f;%d;%f\n',
+    'diams': '%d;%s;%s\n',
+    'loads': '%d;%f\n',
+}
+
+
+def store_path(db_dir):
+    return os.path.join(db_dir, STORE_FN)
+
+
+def has_store(db_dir):
+    return os.path.isfile(store_path(db_dir))
+
+
+class DetectionStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # with WAL, commits are durable at checkpoints, which is enough for detection results
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def insert(self, table, rows):
+        """ Insert rows in one transaction """
+        with self.conn:
+            self.conn.executemany(INSERTS[table], rows)
+
+    def insert_many(self, tables_rows):
+        """ Insert {table: rows} in one transaction """
+        with self.conn:
+            for table, rows in tables_rows.items():
+                if rows:
+                    self.conn.executemany(INSERTS[table], rows)
+
+    def checkpoint(self):
+        self.conn.execute('PRAGMA wal_checkpoint(FULL)')
+
+    def snaps(self, time_from=None, time_to=None, min_particles=None, idx_from=None, idx_to=None):
+        """ Snap rows (idx, path, time, n_particles, mean_diam, duty, d_param) matching all given bounds """
+        conditions, args = [], []
+        for column, op, value in [('time', '>=', time_from), ('time', '<', time_to),
+                                  ('n_particles', '>=', min_particles),
+                                  ('idx', '>=', idx_from), ('idx', '<', idx_to)]:
+            if value is not None:
+                conditions.append('%s %s ?' % (column, op))
+                args.append(value)
+        query = 'SELECT * FROM snaps'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self.conn.execute(query + ' ORDER BY idx', args).fetchall()
+
+    def diams(self, idx):
+        return [diam for diam, in self.conn.execute('SELECT diam FROM diams WHERE idx = ?', (idx,))]
+
+    def loads(self):
+        return self.conn.execute('SELECT * FROM loads ORDER BY idx').fetchall()
+
+    def count(self, table):
+        return self.conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+    def export_text(self, table, path):
+        """ Write the table in the text format of DataWriter """
+        fmt = TEXT_FMTS[table]
+        if table == 'snaps':
+            query = 'SELECT idx, path, n_particles, mean_diam, duty, d_param FROM snaps ORDER BY idx'
+        elif table == 'diams':
+            query = 'SELECT diams.idx, snaps.path, diams.diam FROM diams LEFT JOIN snaps ON diams.idx = snaps.idx'
+        else:
+            query = 'SELECT idx, d_param_sum FROM loads ORDER BY idx'
+        with open(path, 'w') as f:
+            for row in self.conn.execute(query):
+                f.write(fmt % tuple('' if v is None else v for v in row))
+        return path
+
+    def close(self):
+        self.conn.close()
+
+
+def export_snaps(db_dir):
+    """ Text snaps of the store of db directory, for the transfer of stores to clients """
+    store = DetectionStore(store_path(db_dir))
+    try:
+        return store.export_text('snaps', os.path.join(db_dir, 'snaps_export.db'))
+    finally:
+        store.close()
+
+
+def query_snaps(db_root=utils.Pathing.db_root, **bounds):
+    """ Yield (db directory, snap row) from stores of all db directories, see DetectionStore.snaps() for bounds """
+    if not os.path.isdir(db_root):
+        return
+    for entry in sorted(os.scandir(db_root), key=lambda e: e.name):
+        if entry.is_dir() and has_store(entry.path):
+            store = DetectionStore(store_path(entry.path))
+            try:
+                rows = store.snaps(**bounds)
+            finally:
+                store.close()
+            for row in rows:
+                yield entry.path, row
@@ -1,28 +1,33 @@
+import collections
+import itertools
 import os
 import random
 import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import psutil
 
+# timestamp format of captured image filenames
+IMAGE_TIME_FMT = '%m-%d-%Y-%H=%M=%S_%f'
+
+PREFETCH_DEPTH = 8
+PREFETCH_WORKERS = 2
+
 
 class Pathing:
 
     @staticmethod
     def count_dbs(db_root):
-        for i in range(1_000_000):
-            path = os.path.abspath(os.path.join(db_root, str(i)))
-            if os.path.isdir(path) and os.listdir(path):
-                yield path
-            else:
-                break
+        from sensor import dbmanifest
+        for db in dbmanifest.list_dbs(db_root):
+            yield os.path.abspath(os.path.join(db_root, str(db['id'])))
 
     @staticmethod
     def get_new_db_dir(db_root):
-        new = len(list(Pathing.count_dbs(db_root)))
-        path = os.path.abspath(os.path.join(db_root, str(new)))
-        return path
+        from sensor import dbmanifest
+        return dbmanifest.new_db(db_root)
 
     codes_root = os.path.abspath(os.path.join(
         os.path.dirname(__file__), '..', '..'))
@@ -33,6 +38,7 @@ class Pathing:
     sample_images_path = os.path.join(codes_root, 'data', 'samples', 'model')
 
     out_root = os.path.join(codes_root, 'out')
+    cache_root = os.path.join(codes_root, 'cache')
     image_dir = os.path.join(codes_root, 'photos')
 
     image_dir = os.path.abspath(image_dir)
@@ -50,7 +56,7 @@ def get_random_string(length):
 
 def image_save_to(folder=None, ext='jpg'):
     folder = folder or Pathing.image_dir
-    fmt = '%m-%d-%Y-%H=%M=%S_%f.' + ext
+    fmt = IMAGE_TIME_FMT + '.' + ext
     time_stamp = datetime.now().strftime(fmt)
     path = os.path.join(folder, time_stamp)
     return Pathing.image_dir, path
@@ -78,6 +84,44 @@ def list_files(path, formats=None):
             yield fn, fp
 
 
+def parse_image_time(path):
+    """ Capture time of the image from its filename, modification time if it isn't a capture """
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return datetime.strptime(name, IMAGE_TIME_FMT).timestamp()
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+def prefetch_map(func, items, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS):
+    """
+        Lazily map func over items in background threads.
+        Results are yielded in order, at most depth of them are computed ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = collections.deque()
+        try:
+            for item in items:
+                futures.append(pool.submit(func, item))
+                if len(futures) >= depth:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            # consumer stopped early
+            for future in futures:
+                future.cancel()
+
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
 def get_date_str():
     return datetime.now().strftime('%Y-%m-%d; %H=%M=%S')
 
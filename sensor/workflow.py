@@ -6,10 +6,12 @@ import os
 import time
 import traceback
 
-from skimage import io
+import numpy as np
 
-from sensor import utils, proxy, cycles, exc, capturing, leds
+from sensor import utils, proxy, cycles, exc, capturing, leds, settings, dbformat, sqlstore, dbmanifest, retention, \
+    rolling, checkpoint
 from sensor.canbus import app as can_app
+from sensor.detector import gating
 from sensor.detector.sbd import SBDWrapper
 
 
@@ -56,11 +58,12 @@ class ImageCapture:
         # reserved
         self.vents_ok = True
         self.camera_ok = proxy.camera_ok
+        self.frames = retention.FrameRetention()
 
-        search = capturing.IntensitySearch(self.camera)
+        self.search = capturing.IntensitySearch(self.camera)
 
         def capture():
-            return search.capture()
+            return self.search.capture()
 
         if cycles.CYCLE_TYPE == cycles.CycleType.VENTS:
             self.worker = VentsCycleProcessor(capture)
@@ -76,8 +79,15 @@ class ImageCapture:
         camera.color_effects = (128, 128)
         return camera
 
+    def get_state(self):
+        return {'duty': np.asarray(self.search.duty)}
+
+    def set_state(self, state):
+        if 'duty' in state:
+            self.search.duty = int(state['duty'])
+
     def image_save_to(self, ext='jpg'):
-        fmt = '%m-%d-%Y-%H=%M=%S_%f.' + ext
+        fmt = utils.IMAGE_TIME_FMT + '.' + ext
         time_stamp = datetime.datetime.now().strftime(fmt)
         path = os.path.join(utils.Pathing.image_dir, time_stamp)
         return utils.Pathing.image_dir, path
@@ -100,10 +110,7 @@ class ImageCapture:
             return None, None
         _, path = self.image_save_to()
         imagedef = (image, path)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        free_space_mb = utils.get_free_space('.')
-        if free_space_mb > 4096:
-            io.imsave(path, image)
+        self.frames.save(path, image)
         return imagedef
 
 
@@ -113,10 +120,23 @@ class DetectorWrapper:
     """
 
     SNAPSHOT_CYCLE_PERIOD = 50
+    # update dt_param every cycle over the sliding window of SNAPSHOT_CYCLE_PERIOD cycles,
+    # instead of once per tumbling window
+    DT_PARAM_SLIDING = False
+    # [cycles] windows of d_param statistics reported with every snapshot
+    REPORT_WINDOWS = (10, 50, 200)
+    # re-detect only the blocks that changed since the previous frame
+    CHANGE_GATED = False
+    # [cycles] period of change gate stats printout
+    GATE_REPORT_PERIOD = 100
+    # format of written dbs: 'text', 'binary' (dbformat module) or 'sqlite' (sqlstore module)
+    DB_FORMAT = 'text'
 
     def __init__(self):
         self.detector = SBDWrapper()
-        self.writer = DataWriter()
+        if self.CHANGE_GATED:
+            self.detector.gate = gating.ChangeGate()
+        self.writer = DB_WRITERS[self.DB_FORMAT]()
 
         self.image_idx = 1
         self.n_particles = 0
@@ -124,8 +144,8 @@ class DetectorWrapper:
         self.d_param = 0
         self.dt_param = 0
 
-        self.d_params = []
-        self.d_params_old = []
+        history = 2 * max(self.SNAPSHOT_CYCLE_PERIOD, *self.REPORT_WINDOWS)
+        self.d_param_stats = rolling.RollingStats(history)
 
     def process(self, imagedef):
         print("Executing cycle №%d" % (self.image_idx + 1))
@@ -133,6 +153,8 @@ class DetectorWrapper:
         if image is None:
             return
         keys, _ = self.detector.process_dynamic_mask(imagedef)
+        if self.detector.gate is not None and self.image_idx % self.GATE_REPORT_PERIOD == 0:
+            print(self.detector.gate)
         mean_diam = 0
         n_particles = 0
         d_param = 0
@@ -141,7 +163,7 @@ class DetectorWrapper:
             mean_diam = diams.mean()
             n_particles = len(keys)
             d_param = (diams ** 3).sum() / 1e6
-            self.writer.write_detection_diams(self.image_idx, diams)
+            self.writer.write_detection_diams(self.image_idx, path, diams)
             results_summary = (self.image_idx, path, n_particles, mean_diam, cycles.hw_pwm_duty, d_param)
             self.writer.write_detection_results(results_summary)
         if n_particles > 0:
@@ -149,40 +171,245 @@ class DetectorWrapper:
         self.mean_diam = mean_diam
         self.n_particles = n_particles
         self.d_param = d_param
-        self.d_params.append(d_param)
+        self.d_param_stats.add(d_param)
         self.update_batch_data()
         self.image_idx += 1
 
+    def close(self):
+        self.writer.close()
+        self.detector.close()
+
+    def get_state(self):
+        state = {
+            'counters': np.array([self.image_idx, self.n_particles]),
+            'params': np.array([self.mean_diam, self.d_param, self.dt_param]),
+        }
+        state.update(checkpoint.prefixed('masks', self.detector.masks.get_state(checkpoint.MASK_REDUCE)))
+        state.update(checkpoint.prefixed('d_param_stats', self.d_param_stats.get_state()))
+        return state
+
+    def set_state(self, state):
+        self.image_idx, self.n_particles = (int(v) for v in state['counters'])
+        self.mean_diam, self.d_param, self.dt_param = (float(v) for v in state['params'])
+        self.detector.masks.set_state(checkpoint.unprefixed('masks', state))
+        d_param_stats = checkpoint.unprefixed('d_param_stats', state)
+        if d_param_stats:
+            self.d_param_stats.set_state(d_param_stats)
+
     def update_batch_data(self):
-        if len(self.d_params) >= self.SNAPSHOT_CYCLE_PERIOD:
-            d1 = sum(self.d_params)
-            if self.d_params_old:
-                d0 = sum(self.d_params_old)
-                self.dt_param = (d1 - d0) / d0 if d0 != 0 else 0
-            self.d_params_old = self.d_params
-            self.d_params = []
-            self.writer.write_d_param_sum(self.image_idx, d1)
+        stats = self.d_param_stats
+        period = self.SNAPSHOT_CYCLE_PERIOD
+        batch_complete = stats.count % period == 0
+        if self.DT_PARAM_SLIDING or batch_complete:
+            dt_param = stats.rate(period)
+            if dt_param is not None:
+                self.dt_param = dt_param
+        if batch_complete:
+            self.writer.write_d_param_sum(self.image_idx, stats.sum(period))
+            for window, (mean, var, rate) in stats.summary(self.REPORT_WINDOWS).items():
+                print('d_param over %d cycles: mean %.4f, std %.4f, rate %s' % (
+                    window, mean, var ** 0.5, 'n/a' if rate is None else '%.3f' % rate))
 
 
 class DataWriter:
-    def __init__(self):
-        db_dir = utils.Pathing.get_new_db_dir(utils.Pathing.db_root)
-        self.param_db = os.path.join(db_dir, "loads.db")
-        self.diams_db = os.path.join(db_dir, "data.db")
-        self.snaps_db = os.path.join(db_dir, "snaps.db")
+    """
+        Write detection results to the db files of the new db directory.
+        Files are kept open and rows are buffered in memory, they are written out
+        every FLUSH_ROWS rows or FLUSH_PERIOD seconds and on close().
+        With db_fsync_period set in config, flushed files are also fsync'ed at that period.
+        Row counts and size of the db are saved to the manifest every MANIFEST_PERIOD seconds and on close().
+    """
+
+    FLUSH_ROWS = 1000
+    # [s]
+    FLUSH_PERIOD = 10
+    # [s]
+    MANIFEST_PERIOD = 600
+    DB_EXT = dbformat.TEXT_EXT
+
+    def __init__(self, fsync_period=None):
+        self.db_root = utils.Pathing.db_root
+        db_dir = utils.Pathing.get_new_db_dir(self.db_root)
+        self.db_id = int(os.path.basename(db_dir))
+        self.param_db = os.path.join(db_dir, "loads" + self.DB_EXT)
+        self.diams_db = os.path.join(db_dir, "data" + self.DB_EXT)
+        self.snaps_db = os.path.join(db_dir, "snaps" + self.DB_EXT)
+
+        if fsync_period is None:
+            fsync_period = settings.get_config()['DEFAULT'].getfloat('db_fsync_period')
+        self.fsync_period = fsync_period
+        self.files = {}
+        self.buffers = {self.param_db: [], self.diams_db: [], self.snaps_db: []}
+        self.n_rows = 0
+        # rows written to each db, for the manifest
+        self.db_rows = dict.fromkeys(self.buffers, 0)
+        self.manifest_dirty = False
+        self.last_flush = time.time()
+        self.last_fsync = time.time()
+        self.last_manifest = time.time()
+
+    def write(self, db_path, text, n_rows=1):
+        self.buffers[db_path].append(text)
+        self.n_rows += n_rows
+        self.db_rows[db_path] += n_rows
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.n_rows >= self.FLUSH_ROWS or time.time() - self.last_flush >= self.FLUSH_PERIOD:
+            self.flush()
+
+    def flush(self, fsync=False):
+        for db_path, buffer in self.buffers.items():
+            if not buffer:
+                continue
+            f = self.files.get(db_path)
+            if f is None:
+                # files are created on first flush, so an idle run leaves no empty dbs
+                f = self.files[db_path] = self.open_db(db_path)
+            f.write(self.join_rows(buffer))
+            f.flush()
+            buffer.clear()
+        self.manifest_dirty |= self.n_rows > 0
+        self.n_rows = 0
+        self.last_flush = time.time()
+        if fsync or (self.fsync_period and self.last_flush - self.last_fsync >= self.fsync_period):
+            for f in self.files.values():
+                os.fsync(f.fileno())
+            self.last_fsync = self.last_flush
+        self.maybe_update_manifest()
+
+    def open_db(self, db_path):
+        return open(db_path, 'a')
+
+    def db_bytes(self):
+        """ Size of the open db files, without scanning the db directory """
+        return sum(os.fstat(f.fileno()).st_size for f in self.files.values())
+
+    def maybe_update_manifest(self, force=False):
+        if self.manifest_dirty and (force or time.time() - self.last_manifest >= self.MANIFEST_PERIOD):
+            self.update_manifest()
+
+    def update_manifest(self):
+        rows = {os.path.splitext(os.path.basename(db_path))[0]: n for db_path, n in self.db_rows.items()}
+        dbmanifest.update_db(self.db_root, self.db_id, rows, self.db_bytes())
+        self.manifest_dirty = False
+        self.last_manifest = time.time()
+
+    def join_rows(self, buffer):
+        return ''.join(buffer)
+
+    def close(self):
+        self.flush(fsync=True)
+        self.maybe_update_manifest(force=True)
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def write_d_param_sum(self, idx, d_param_sum):
+        self.write(self.param_db, '%d;%f\n' % (idx, d_param_sum))
+
+    def write_detection_diams(self, idx, path, diams):
+        if not len(diams):
+            return
+        prefix = '%d;%s;' % (idx, path)
+        text = prefix + ('\n' + prefix).join(np.asarray(diams).astype(str)) + '\n'
+        self.write(self.diams_db, text, len(diams))
+
+    def write_detection_results(self, results):
+        self.write(self.snaps_db, '%d;%s;%d;%f;%d;%f\n' % results)
+
+
+class BinaryDataWriter(DataWriter):
+    """
+        DataWriter of the binary record format of dbformat module.
+        Rows are buffered as structured arrays and appended with one write per flush.
+    """
+
+    DB_EXT = dbformat.BINARY_EXT
+
+    def open_db(self, db_path):
+        name = os.path.splitext(os.path.basename(db_path))[0]
+        return dbformat.RecordFile(db_path, dbformat.DBS[name])
+
+    def join_rows(self, buffer):
+        return b''.join(records.tobytes() for records in buffer)
+
+    def write_d_param_sum(self, idx, d_param_sum):
+        self.write(self.param_db, np.array([(idx, d_param_sum)], dtype=dbformat.LOADS_DTYPE))
+
+    def write_detection_diams(self, idx, path, diams):
+        if not len(diams):
+            return
+        records = np.empty(len(diams), dtype=dbformat.DIAMS_DTYPE)
+        records['idx'] = idx
+        records['diam'] = diams
+        self.write(self.diams_db, records, len(diams))
+
+    def write_detection_results(self, results):
+        idx, path, n_particles, mean_diam, duty, d_param = results
+        record = (idx, dbformat.path_to_time_us(path), n_particles, mean_diam, duty, d_param)
+        self.write(self.snaps_db, np.array([record], dtype=dbformat.SNAPS_DTYPE))
+
+
+class SqliteDataWriter(DataWriter):
+    """
+        DataWriter into sqlstore.DetectionStore of the db directory.
+        Buffered rows are inserted in one transaction per flush, fsync is a WAL checkpoint.
+    """
+
+    def __init__(self, fsync_period=None):
+        super().__init__(fsync_period)
+        self.tables = {self.param_db: 'loads', self.diams_db: 'diams', self.snaps_db: 'snaps'}
+        self.store = None
+
+    def flush(self, fsync=False):
+        if self.n_rows:
+            if self.store is None:
+                self.store = sqlstore.DetectionStore(sqlstore.store_path(os.path.dirname(self.snaps_db)))
+            self.store.insert_many({self.tables[db_path]: [row for rows in buffer for row in rows]
+                                    for db_path, buffer in self.buffers.items()})
+            for buffer in self.buffers.values():
+                buffer.clear()
+            self.manifest_dirty = True
+        self.n_rows = 0
+        self.last_flush = time.time()
+        if self.store is not None and (
+                fsync or (self.fsync_period and self.last_flush - self.last_fsync >= self.fsync_period)):
+            self.store.checkpoint()
+            self.last_fsync = self.last_flush
+        self.maybe_update_manifest()
+
+    def db_bytes(self):
+        # store keeps WAL and journal files aside, the directory is scanned
+        return None
+
+    def close(self):
+        self.flush(fsync=True)
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        self.maybe_update_manifest(force=True)
 
     def write_d_param_sum(self, idx, d_param_sum):
-        with open(self.param_db, 'a') as f:
-            f.write('%d;%f\n' % (idx, d_param_sum))
+        self.write(self.param_db, [(idx, d_param_sum)])
 
     def write_detection_diams(self, idx, path, diams):
-        with open(self.diams_db, 'a') as f:
-            for diam in diams:
-                f.write('%d;%s;%s\n' % (idx, path, diam))
+        if not len(diams):
+            return
+        self.write(self.diams_db, [(idx, diam) for diam in np.asarray(diams, dtype=float).tolist()], len(diams))
 
     def write_detection_results(self, results):
-        with open(self.snaps_db, 'a') as f:
-            f.write('%d;%s;%d;%f;%d;%f\n' % results)
+        idx, path, n_particles, mean_diam, duty, d_param = results
+        capture_time = dbformat.path_to_time_us(path) / 1e6 or time.time()
+        self.write(self.snaps_db, [(idx, path, capture_time, int(n_particles), float(mean_diam), duty,
+                                    float(d_param))])
+
+
+DB_WRITERS = {
+    'text': DataWriter,
+    'binary': BinaryDataWriter,
+    'sqlite': SqliteDataWriter,
+}
 
 
 class WorkController:
@@ -195,6 +422,27 @@ class WorkController:
             self.can_app = can_app.init_app()
         self.image_capture = ImageCapture()
         self.detector_wrapper = DetectorWrapper()
+        self.checkpoint_period = settings.get_config()['DEFAULT'].getfloat('checkpoint_period')
+        self.last_checkpoint = time.time()
+        self.restore_checkpoint()
+
+    def save_checkpoint(self):
+        state = checkpoint.prefixed('detector', self.detector_wrapper.get_state())
+        state.update(checkpoint.prefixed('capture', self.image_capture.get_state()))
+        checkpoint.save(state)
+        self.last_checkpoint = time.time()
+
+    def restore_checkpoint(self):
+        state = checkpoint.load()
+        if state is None:
+            return
+        try:
+            self.detector_wrapper.set_state(checkpoint.unprefixed('detector', state))
+            self.image_capture.set_state(checkpoint.unprefixed('capture', state))
+            print("Restored state of cycle №%d from checkpoint" % self.detector_wrapper.image_idx)
+        except (KeyError, ValueError):
+            print("Couldn't restore checkpoint")
+            traceback.print_exc()
 
     def check_ups(self):
         raise NotImplementedError
@@ -214,7 +462,7 @@ class WorkController:
             'vents_ok': self.image_capture.vents_ok
         }
         self.can_app.state_handler.set_data(data)
-        free_space_mb = utils.get_free_space('.')
+        free_space_mb = self.image_capture.frames.free_space.get()
         progress_item = [self.detector_wrapper.image_idx,
                          self.can_app.state_handler.allow_capture,
                          self.image_capture.camera_ok,
@@ -236,6 +484,8 @@ class WorkController:
             except Exception:
                 print("Unhandled exception at work loop")
                 traceback.print_exc()
+        self.save_checkpoint()
+        self.detector_wrapper.close()
         if self.can_app:
             self.can_app.ready_for_shutdown = True
         while True:
@@ -250,10 +500,15 @@ class WorkController:
 
         if not should_work:
             print("Can't work, idling")
+            self.detector_wrapper.writer.maybe_flush()
             time.sleep(3)
             return
 
         self.detector_wrapper.process(imagedef)
+        if imagedef[0] is not None:
+            self.image_capture.frames.set_detections(imagedef[1], self.detector_wrapper.n_particles)
+        if time.time() - self.last_checkpoint >= self.checkpoint_period:
+            self.save_checkpoint()
 
 
 def run():
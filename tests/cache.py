@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from sensor import imaging
+from sensor.detector import cache
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = cache.ImageCache(self.root)
+        self.path = os.path.join(os.path.dirname(__file__), 'data', 'shapes', 'shapes_0.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_decoder_is_part_of_the_key(self):
+        full = self.cache.load_grayscale(self.path)
+        assert np.array_equal(self.cache.load_grayscale(self.path), full)
+        reduced = self.cache.load_grayscale(self.path, reduce=2)
+        assert reduced.shape == (-(-full.shape[0] // 2), -(-full.shape[1] // 2))
+        with mock.patch.object(imaging, 'DECODE_ENGINE', 'pil'):
+            self.cache.load_grayscale(self.path)
+        assert (self.cache.hits, self.cache.misses) == (1, 3)
+
+    def test_eviction_order(self):
+        image = np.zeros(1000, dtype='uint8')
+        for t, key in enumerate('abc'):
+            self.cache.put(key * 8, image)
+            os.utime(self.cache.entry_path(key * 8), (t, t))
+        entry_size = os.path.getsize(self.cache.entry_path('a' * 8))
+        # overwriting doesn't count the entry twice
+        self.cache.put('c' * 8, image)
+        assert self.cache.size == 3 * entry_size
+        # 'a' is used, 'b' is least recently used
+        self.cache.get('a' * 8)
+        self.cache.max_bytes = 3.5 * entry_size
+        self.cache.put('d' * 8, image)
+        assert self.cache.size == 3 * entry_size
+        assert [self.cache.get(key * 8) is None for key in 'abcd'] == [False, True, False, False]
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from sensor import checkpoint, imaging, rolling, utils
+from sensor.detector.sbd import SBDWrapper
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'checkpoint.npz')
+        path = os.path.join(os.path.dirname(__file__), 'data', 'shapes')
+        self.images = [imaging.load_grayscale_image(fp) for _, fp in sorted(utils.list_images(path))]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_masks_and_stats_warm_restart(self):
+        sbd = SBDWrapper()
+        stats = rolling.RollingStats(20)
+        for i, image in enumerate(self.images[:3]):
+            sbd.process_dynamic_mask((image, None))
+            stats.add(float(i))
+        state = checkpoint.prefixed('masks', sbd.masks.get_state())
+        state.update(checkpoint.prefixed('stats', stats.get_state()))
+        checkpoint.save(state, self.path)
+
+        state = checkpoint.load(self.path, max_age=60)
+        restored, restored_stats = SBDWrapper(), rolling.RollingStats(20)
+        restored.masks.set_state(checkpoint.unprefixed('masks', state))
+        restored_stats.set_state(checkpoint.unprefixed('stats', state))
+        keys, _ = restored.process_dynamic_mask((self.images[3], None))
+        expected, _ = sbd.process_dynamic_mask((self.images[3], None))
+        assert keys is not None
+        assert np.allclose(keys, expected)
+        assert restored_stats.count == 3 and restored_stats.sum(10) == stats.sum(10)
+
+    def test_compact_window_state(self):
+        masks = imaging.RunningMean(window=3)
+        for image in self.images[:4]:
+            masks.add(image)
+        state = masks.get_state()
+        assert state['sum'].dtype == np.uint16
+        restored = imaging.RunningMean(window=3)
+        restored.set_state(state)
+        assert restored.full and np.array_equal(restored.mean(), masks.mean())
+        # restored parts of the sum are replaced by new frames
+        for image in self.images[:3]:
+            masks.add(image)
+            restored.add(image)
+        assert np.array_equal(restored.sum, masks.sum)
+
+    def test_reduced_window_state(self):
+        masks = imaging.RunningMean(window=3)
+        for image in self.images[:3]:
+            masks.add(image)
+        state = masks.get_state(reduce=4)
+        assert state['sum'].shape == (250, 250)
+        restored = imaging.RunningMean(window=3)
+        restored.set_state(state)
+        assert restored.full and restored.sum.shape == masks.sum.shape
+        assert abs(restored.mean().mean() - masks.mean().mean()) < 1
+        # odd shapes are padded and cropped back
+        masks = imaging.RunningMean(window=2)
+        for image in self.images[:2]:
+            masks.add(image[:101, :99])
+        restored.set_state(masks.get_state(reduce=4))
+        assert restored.sum.shape == (101, 99)
+
+    def test_stale_checkpoint_is_ignored(self):
+        checkpoint.save({'a': np.zeros(1)}, self.path)
+        assert checkpoint.load(self.path, max_age=60) is not None
+        old = time.time() - 120
+        checkpoint.save({'a': np.zeros(1)}, self.path)
+        with np.load(self.path) as data:
+            state = dict(data)
+        state['_saved'] = old
+        np.savez(self.path, **state)
+        assert checkpoint.load(self.path, max_age=60) is None
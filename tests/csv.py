@@ -1,5 +1,6 @@
 import csv
 import os
+import tempfile
 import unittest
 
 
@@ -8,9 +9,9 @@ class TestLoadWrite(unittest.TestCase):
         thing = ['hello', 800, 600]
         things = [thing, thing]
 
-        fn = os.path.join("data", "test.csv")
-
-        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        fn = os.path.join(tmp_dir.name, "test.csv")
 
         csv_args = {
             'delimiter': ';',
@@ -0,0 +1,124 @@
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from sensor import dbformat, dbmanifest, sqlstore, utils
+
+try:
+    from sensor import workflow
+except ImportError:
+    # off Ubuntu and Windows sensor.proxy drives the gpio, the writers don't use it
+    sys.modules['sensor.proxy'] = types.SimpleNamespace(bustype='virtual')
+    try:
+        from sensor import workflow
+    finally:
+        del sys.modules['sensor.proxy']
+
+FSYNC_PERIOD = 30
+
+
+class WriterTests:
+    """ Buffering of the DataWriter backend WRITER, run by the TestCase of each backend """
+
+    WRITER = None
+
+    def setUp(self):
+        self.db_root = tempfile.mkdtemp()
+        self.now = 1000.0
+        clock = mock.patch.object(workflow, 'time', types.SimpleNamespace(time=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+        with mock.patch.object(utils.Pathing, 'db_root', self.db_root):
+            self.writer = self.WRITER(fsync_period=FSYNC_PERIOD)
+        self.writer.FLUSH_ROWS = 5
+        self.db_dir = os.path.dirname(self.writer.param_db)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.db_root)
+
+    def write(self, n_rows):
+        for idx in range(n_rows):
+            self.writer.write_d_param_sum(idx, 0.5)
+
+    def count_loads(self):
+        raise NotImplementedError
+
+    def patch_fsync(self):
+        return mock.patch.object(workflow.os, 'fsync')
+
+    def test_rows_held_until_row_threshold(self):
+        self.write(4)
+        assert self.count_loads() == 0
+        self.write(1)
+        assert self.count_loads() == 5
+
+    def test_rows_held_until_time_threshold(self):
+        self.write(1)
+        self.now += self.writer.FLUSH_PERIOD - 1
+        self.write(1)
+        assert self.count_loads() == 0
+        self.now += 1
+        self.write(1)
+        assert self.count_loads() == 3
+
+    def test_rows_flushed_on_close(self):
+        self.write(2)
+        assert self.count_loads() == 0
+        self.writer.close()
+        assert self.count_loads() == 2
+        db = dbmanifest.load(self.db_root)['dbs'][str(self.writer.db_id)]
+        assert db['rows']['loads'] == 2 and db['bytes'] > 0
+
+    def test_fsync_period(self):
+        with self.patch_fsync() as fsync:
+            self.write(5)
+            assert not fsync.called
+            self.now += FSYNC_PERIOD
+            self.write(5)
+            assert fsync.called
+            fsync.reset_mock()
+            self.now += FSYNC_PERIOD - 1
+            self.write(5)
+            assert not fsync.called
+            # close always syncs
+            self.writer.close()
+            assert fsync.called
+
+
+class TestTextWriter(WriterTests, unittest.TestCase):
+    WRITER = workflow.DataWriter
+
+    def count_loads(self):
+        if not os.path.isfile(self.writer.param_db):
+            return 0
+        return len(list(dbformat.iter_text_rows(self.writer.param_db)))
+
+
+class TestBinaryWriter(WriterTests, unittest.TestCase):
+    WRITER = workflow.BinaryDataWriter
+
+    def count_loads(self):
+        if not os.path.isfile(self.writer.param_db):
+            return 0
+        return len(dbformat.read_records(self.writer.param_db))
+
+
+class TestSqliteWriter(WriterTests, unittest.TestCase):
+    WRITER = workflow.SqliteDataWriter
+
+    def count_loads(self):
+        if not sqlstore.has_store(self.db_dir):
+            return 0
+        store = sqlstore.DetectionStore(sqlstore.store_path(self.db_dir))
+        try:
+            return store.count('loads')
+        finally:
+            store.close()
+
+    def patch_fsync(self):
+        return mock.patch.object(sqlstore.DetectionStore, 'checkpoint')
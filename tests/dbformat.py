@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from sensor import dbformat, utils
+
+SNAPS = [
+    (1, '/photos/05-04-2021-12=00=00_123456.jpg', 2, 12.5, 30000, 0.004),
+    (2, '/photos/05-04-2021-12=00=01_654321.jpg', 1, 8.25, 30000, 0.001),
+]
+DIAMS = [(1, 10.5), (1, 14.5), (2, 8.25)]
+LOADS = [(50, 0.25)]
+
+
+class TestBinaryDb(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def write_text(self):
+        paths = {idx: path for idx, path, *_ in SNAPS}
+        with open(os.path.join(self.db_dir, 'snaps.db'), 'w') as f:
+            f.writelines('%d;%s;%d;%f;%d;%f\n' % row for row in SNAPS)
+        with open(os.path.join(self.db_dir, 'data.db'), 'w') as f:
+            f.writelines('%d;%s;%s\n' % (idx, paths[idx], diam) for idx, diam in DIAMS)
+        with open(os.path.join(self.db_dir, 'loads.db'), 'w') as f:
+            f.writelines('%d;%f\n' % row for row in LOADS)
+
+    def test_append_and_read(self):
+        path = os.path.join(self.db_dir, 'data.bin')
+        f = dbformat.RecordFile(path, dbformat.DIAMS_DTYPE)
+        f.append(DIAMS[:2])
+        f.close()
+        f = dbformat.RecordFile(path, dbformat.DIAMS_DTYPE)
+        f.append(DIAMS[2:])
+        f.close()
+        assert dbformat.is_binary(path)
+        records = dbformat.read_records(path)
+        assert records['idx'].tolist() == [1, 1, 2]
+        assert np.allclose(records['diam'], [d for _, d in DIAMS])
+        with self.assertRaises(ValueError):
+            dbformat.RecordFile(path, dbformat.LOADS_DTYPE)
+
+    def test_text_round_trip(self):
+        self.write_text()
+        texts = {}
+        for name in dbformat.DBS:
+            with open(os.path.join(self.db_dir, name + '.db')) as f:
+                texts[name] = f.read()
+        dbformat.text_to_binary(self.db_dir)
+        snaps = dbformat.read_records(os.path.join(self.db_dir, 'snaps.bin'))
+        assert snaps['n_particles'].tolist() == [2, 1]
+        for name in dbformat.DBS:
+            os.remove(os.path.join(self.db_dir, name + '.db'))
+        dbformat.binary_to_text(self.db_dir)
+        for name in dbformat.DBS:
+            with open(os.path.join(self.db_dir, name + '.db')) as f:
+                text = f.read()
+            # image folder isn't stored in binary db
+            text = text.replace(utils.Pathing.image_dir, '/photos')
+            assert text == texts[name], name
+
+    def test_arbitrary_floats(self):
+        diams = np.random.RandomState(0).lognormal(2, 1, 1000)
+        path = os.path.join(self.db_dir, 'data.bin')
+        f = dbformat.RecordFile(path, dbformat.DIAMS_DTYPE)
+        f.append([(1, d) for d in diams])
+        f.close()
+        records = dbformat.read_records(path)
+        assert records['diam'].tolist() == diams.tolist()
+        # text diameters are written with repr and survive the round trip exactly
+        with open(os.path.join(self.db_dir, 'data.db'), 'w') as f:
+            f.writelines('1;;%s\n' % d for d in diams.tolist())
+        dbformat.text_to_binary(self.db_dir)
+        os.remove(os.path.join(self.db_dir, 'data.db'))
+        dbformat.binary_to_text(self.db_dir)
+        with open(os.path.join(self.db_dir, 'data.db')) as f:
+            assert [float(line.split(';')[-1]) for line in f] == diams.tolist()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sensor import dbmanifest, utils
+
+
+class TestDbManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_root)
+
+    def test_scan_existing_dbs(self):
+        for i in [0, 1, 3]:
+            os.makedirs(os.path.join(self.db_root, str(i)))
+            with open(os.path.join(self.db_root, str(i), 'snaps.db'), 'w') as f:
+                f.write('1;a.jpg;1;1.0;1;1.0\n')
+        assert [db['id'] for db in dbmanifest.list_dbs(self.db_root)] == [0, 1, 3]
+        assert os.path.isfile(dbmanifest.manifest_path(self.db_root))
+
+    def new_db(self, rows=1):
+        path = utils.Pathing.get_new_db_dir(self.db_root)
+        if rows:
+            with open(os.path.join(path, 'snaps.db'), 'w') as f:
+                f.write('1;a.jpg;1;1.0;1;1.0\n')
+            dbmanifest.update_db(self.db_root, int(os.path.basename(path)), {'snaps': rows})
+        return path
+
+    def test_new_and_cleared_dbs(self):
+        paths = [self.new_db() for _ in range(3)]
+        assert [os.path.basename(p) for p in paths] == ['0', '1', '2']
+        dbmanifest.update_db(self.db_root, 1, {'snaps': 5})
+        dbmanifest.remove_db(self.db_root, 1)
+        assert dbmanifest.count_ids(self.db_root) == 3
+        assert list(utils.Pathing.count_dbs(self.db_root)) == [paths[0], paths[2]]
+        assert os.path.basename(utils.Pathing.get_new_db_dir(self.db_root)) == '3'
+
+    def test_empty_db_is_reused(self):
+        paths = [self.new_db(rows=0) for _ in range(3)]
+        assert [os.path.basename(p) for p in paths] == ['0', '0', '0']
+        assert dbmanifest.count_ids(self.db_root) == 1
+
+    def test_ids_wrap(self):
+        manifest = {'dbs': {str(i): {'id': i, 'created': i, 'rows': {'snaps': 1}, 'bytes': 0}
+                            for i in range(dbmanifest.MAX_DB_ID + 1)}}
+        dbmanifest.save(self.db_root, manifest)
+        os.makedirs(os.path.join(self.db_root, '0'))
+        with open(os.path.join(self.db_root, '0', 'snaps.db'), 'w') as f:
+            f.write('1;a.jpg;1;1.0;1;1.0\n')
+        # all ids are taken, the oldest db is overwritten
+        path = dbmanifest.new_db(self.db_root)
+        assert os.path.basename(path) == '0' and os.listdir(path) == []
+        # empty last db is reused even though it isn't the highest id
+        assert os.path.basename(dbmanifest.new_db(self.db_root)) == '0'
+        dbmanifest.update_db(self.db_root, 0, {'snaps': 1}, n_bytes=10)
+        dbmanifest.remove_db(self.db_root, 5)
+        dbmanifest.remove_db(self.db_root, 3)
+        # next free id after the last created one
+        assert os.path.basename(dbmanifest.new_db(self.db_root)) == '3'
+        assert dbmanifest.count_ids(self.db_root) == dbmanifest.MAX_DB_ID + 1
@@ -0,0 +1,165 @@
+import os
+import unittest
+
+import cv2
+import numpy as np
+
+from sensor import imaging, utils
+from sensor.detector import gating, stats
+from sensor.detector.sbd import SBDWrapper, UM_PER_SCREEN, merge_tile_keys
+
+
+def sorted_keys(keys):
+    keys = np.asarray(keys).reshape(-1, 3)
+    return keys[np.lexsort((keys[:, 1], keys[:, 0]))]
+
+
+class TestTiledDetection(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(os.path.dirname(__file__), 'data', 'shapes')
+        self.imagedefs = [(imaging.load_grayscale_image(fp), fp) for _, fp in utils.list_images(path)]
+
+    def get_kwargs(self, sbd, image):
+        sbd.pixel_to_um = image.shape[1] / UM_PER_SCREEN
+        return sbd.process_kwargs(None)
+
+    def test_tiled_matches_whole_frame(self):
+        whole = SBDWrapper()
+        for grid in [(1, 2), (2, 2), (3, 4)]:
+            tiled = SBDWrapper(tiles=grid)
+            for imagedef in self.imagedefs:
+                kwargs = self.get_kwargs(whole, imagedef[0])
+                keys, _, _ = whole.detect(imagedef, **kwargs)
+                tiled_keys, _, _ = tiled.detect_tiled(imagedef, **kwargs)
+                keys, tiled_keys = sorted_keys(keys), sorted_keys(tiled_keys)
+                assert len(keys) == len(tiled_keys), (grid, imagedef[1])
+                assert np.allclose(keys, tiled_keys, atol=1e-3)
+
+    def test_full_resolution_large_blobs(self):
+        # camera frame with blobs up to ~100 um crossing the tile borders
+        image = np.full((1944, 2592), 255, dtype='uint8')
+        for (x, y), r in zip([(1296, 972), (648, 486), (1944, 1458), (1296, 300), (400, 972), (2200, 700)],
+                             [240, 150, 200, 60, 100, 30]):
+            cv2.circle(image, (x, y), r, 0, -1)
+        whole = SBDWrapper()
+        kwargs = self.get_kwargs(whole, image)
+        keys, _, _ = whole.detect((image, None), **kwargs)
+        assert len(keys) == 6
+        for grid in [(2, 2), (3, 4)]:
+            tiled = SBDWrapper(tiles=grid)
+            tiled_keys, _, _ = tiled.detect_tiled((image, None), **kwargs)
+            tiled.close()
+            assert np.allclose(sorted_keys(keys), sorted_keys(tiled_keys), atol=1e-3), grid
+
+    def test_merge_drops_duplicates_of_other_tiles(self):
+        a = np.array([[10, 10, 3], [50, 50, 3], [10, 14, 3]])
+        b = np.array([[10, 12, 3], [100, 100, 3]])
+        merged = merge_tile_keys([a, b], min_dist=5)
+        # keys of the same tile are kept even when close
+        assert np.array_equal(merged, [[10, 10, 3], [50, 50, 3], [10, 14, 3], [100, 100, 3]])
+
+
+class TestChangeGate(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(os.path.dirname(__file__), 'data', 'shapes', 'shapes_0.jpg')
+        self.image = imaging.load_grayscale_image(path)
+        self.sbd = SBDWrapper()
+        self.sbd.pixel_to_um = self.image.shape[1] / UM_PER_SCREEN
+        self.kwargs = self.sbd.process_kwargs(None)
+        self.gate = gating.ChangeGate(full_period=5)
+
+    def detect(self, image):
+        keys, _, _ = self.gate.detect(self.sbd, (image, None), **self.kwargs)
+        return keys
+
+    def test_static_frame_is_skipped(self):
+        keys = self.detect(self.image)
+        assert self.gate.last_fraction == 1.0
+        same_keys = self.detect(self.image.copy())
+        assert self.gate.last_fraction == 0.0
+        assert np.allclose(sorted_keys(keys), sorted_keys(same_keys))
+
+    def test_changed_blocks_are_redetected(self):
+        self.detect(self.image)
+        changed = self.image.copy()
+        cv2.circle(changed, (500, 500), 15, 0, -1)
+        keys = self.detect(changed)
+        assert 0.0 < self.gate.last_fraction < 0.5
+
+        whole_keys, _, _ = self.sbd.detect((changed, None), **self.kwargs)
+        assert np.allclose(sorted_keys(keys), sorted_keys(whole_keys), atol=1e-3)
+
+    def test_noisy_static_stream_is_skipped(self):
+        # mask subtraction and rescale stretch noise, raw frames are compared instead
+        noise = np.random.RandomState(0)
+        for sigma in [0.5, 1, 2]:
+            sbd = SBDWrapper()
+            sbd.gate = gating.ChangeGate(full_period=100)
+            fractions = []
+            for _ in range(8):
+                frame = np.clip(self.image + noise.normal(0, sigma, self.image.shape), 0, 255).astype('uint8')
+                keys, _ = sbd.process_dynamic_mask((frame, None))
+                if keys is not None:
+                    fractions.append(sbd.gate.last_fraction)
+            # first detection is full
+            assert fractions[0] == 1.0 and fractions[1:] == [0.0] * (len(fractions) - 1), (sigma, fractions)
+
+    def test_full_detection_period(self):
+        for _ in range(7):
+            self.detect(self.image)
+        assert self.gate.n_full == 2
+
+
+class TestBatchDetection(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(os.path.dirname(__file__), 'data', 'shapes')
+        image_fns = sorted(fp for _, fp in utils.list_images(path))
+        self.stack = np.stack([imaging.load_grayscale_image(fp) for fp in image_fns])
+
+    def test_batch_matches_single(self):
+        sbd = SBDWrapper()
+        for mask in [None, 80, self.stack[0]]:
+            batch_keys = sbd.process_batch(self.stack, mask)
+            assert batch_keys.shape[1] == 4
+            for i, image in enumerate(self.stack):
+                keys, _ = sbd.process((image, None), mask)
+                image_keys = batch_keys[batch_keys[:, 3] == i][:, :3]
+                assert np.allclose(sorted_keys(keys), sorted_keys(image_keys))
+
+    def test_dynamic_batch_matches_dynamic_mask(self):
+        single, batch = SBDWrapper(), SBDWrapper()
+        keys = [single.process_dynamic_mask((image, None))[0] for image in self.stack]
+        keys = np.concatenate([k.reshape(-1, 3) for k in keys if k is not None])
+        batch_keys = np.concatenate([batch.process_dynamic_batch(self.stack[:2]),
+                                     batch.process_dynamic_batch(self.stack[2:])])
+        assert np.allclose(sorted_keys(keys), sorted_keys(batch_keys[:, :3]))
+
+
+class TestSizeDistribution(unittest.TestCase):
+
+    def setUp(self):
+        self.sizes = np.random.RandomState(0).lognormal(2, 0.5, 5000)
+
+    def test_summary(self):
+        dist = stats.SizeDistribution()
+        for frame_sizes in np.array_split(self.sizes, 50):
+            dist.update(frame_sizes)
+        assert dist.count == len(self.sizes)
+        assert np.isclose(dist.geometric_mean, np.exp(np.log(self.sizes).mean()))
+        assert dist.histogram()[1].sum() == len(self.sizes)
+        for q in [0.1, 0.5, 0.9]:
+            exact = np.quantile(self.sizes, q)
+            assert abs(dist.quantile(q) - exact) / exact < 0.02
+
+    def test_merge(self):
+        whole, a, b = stats.SizeDistribution(), stats.SizeDistribution(), stats.SizeDistribution()
+        whole.update(self.sizes)
+        a.update(self.sizes[:1000])
+        b.update(self.sizes[1000:])
+        merged = stats.SizeDistribution.from_dict(a.to_dict()).merge(b)
+        assert np.array_equal(merged.counts, whole.counts)
+        assert merged.sketch.buckets == whole.sketch.buckets
+        assert np.isclose(merged.geometric_mean, whole.geometric_mean)
@@ -1,7 +1,12 @@
 import os
+import shutil
+import tempfile
+import time
 import unittest
 
 import numpy as np
+from PIL import Image
+
 from sensor import utils, imaging, mocks
 
 
@@ -33,6 +38,15 @@ class TestImageConvert(unittest.TestCase):
         im_equal = images[1] == images.mean(axis=0)
         assert im_equal.all()
 
+    def test_running_means(self):
+        images = np.random.RandomState(0).randint(0, 256, (7, 4, 5)).astype('uint8')
+        for i, mean in enumerate(imaging.prefix_means(images), 1):
+            assert np.allclose(mean, imaging.mean_pixels(images[:i]))
+        means = list(imaging.sliding_means(images, 3))
+        assert len(means) == 5
+        for i, mean in enumerate(means):
+            assert np.allclose(mean, imaging.mean_pixels(images[i:i + 3]))
+
     def test_uint8_subtract_uint8_is_proper(self):
         image = np.arange(8, dtype='uint8').reshape((2, 4))
         diff = imaging.subtract_image_uint8(image, 2 * image)
@@ -59,3 +73,65 @@ class TestImageConvert(unittest.TestCase):
         image2 = np.asarray([[127, -128, -1, 0]], dtype='int8')
         image_conv = image.astype('int8')
         assert (image_conv == image2).all()
+
+
+class TestDecode(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(os.path.dirname(__file__), 'data', 'shapes')
+        self.image_fns = sorted(fp for _, fp in utils.list_images(path))
+
+    def test_engines_agree(self):
+        for fn in self.image_fns:
+            rgb = imaging.load_image(fn, "RGB", engine="cv2")
+            assert (rgb == imaging.load_image(fn, "RGB", engine="pil")).all()
+            for reduce in [1, 2, 4, 8]:
+                gray = imaging.load_image(fn, "L", reduce=reduce, engine="cv2")
+                pil_gray = imaging.load_image(fn, "L", reduce=reduce, engine="pil")
+                assert gray.shape == pil_gray.shape
+                assert gray.shape[0] == 1000 // reduce
+
+    def test_decode_into_buffer(self):
+        for engine in ["cv2", "pil"]:
+            out = np.zeros((500, 500), dtype='uint8')
+            image = imaging.load_image(self.image_fns[0], "L", reduce=2, out=out, engine=engine)
+            assert image is out
+            assert out.any()
+
+    def test_benchmark_loaders(self):
+        loaders = {
+            'PIL convert + np.array': lambda fn: np.array(Image.open(fn).convert("L"), "uint8"),
+            'pil': lambda fn: imaging.load_image(fn, "L", engine="pil"),
+            'pil draft 1/2': lambda fn: imaging.load_image(fn, "L", reduce=2, engine="pil"),
+            'cv2': lambda fn: imaging.load_image(fn, "L", engine="cv2"),
+            'cv2 reduced 1/2': lambda fn: imaging.load_image(fn, "L", reduce=2, engine="cv2"),
+            'cv2 reduced 1/4': lambda fn: imaging.load_image(fn, "L", reduce=4, engine="cv2"),
+        }
+        n_repeats = 5
+        for name, loader in loaders.items():
+            start = time.time()
+            for _ in range(n_repeats):
+                for fn in self.image_fns:
+                    loader(fn)
+            duration_ms = 1000 * (time.time() - start) / n_repeats / len(self.image_fns)
+            print("%s: %.3f ms per image" % (name, duration_ms))
+
+
+class TestImageStack(unittest.TestCase):
+
+    def setUp(self):
+        self.sample_dir = tempfile.mkdtemp()
+        path = os.path.join(os.path.dirname(__file__), 'data', 'shapes')
+        for _, fp in utils.list_images(path):
+            shutil.copy(fp, self.sample_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.sample_dir)
+
+    def test_pack_and_read(self):
+        imaging.pack_image_stack(self.sample_dir)
+        stack = imaging.ImageStack(self.sample_dir)
+        assert len(stack) == len(list(utils.list_images(self.sample_dir)))
+        assert isinstance(stack.frames, np.memmap)
+        for frame, path in stack.imagedefs():
+            assert (frame == imaging.load_grayscale_image(path)).all()
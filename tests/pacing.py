@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+
+import can
+
+from sensor.canbus import pacing
+
+
+class TestPacer(unittest.TestCase):
+
+    def setUp(self):
+        self.pacer = pacing.Pacer(0.001, 0.5)
+        self.holdoff = mock.patch.object(pacing, 'DECREASE_HOLDOFF', 0)
+        self.holdoff.start()
+
+    def tearDown(self):
+        self.holdoff.stop()
+
+    def test_bounds(self):
+        pacer = self.pacer
+        assert pacer.delay == pacing.START_DELAY
+        for _ in range(10000):
+            pacer.on_sent()
+        assert abs(pacer.delay - 0.001) < 1e-9
+        for _ in range(100):
+            pacer.on_error()
+        assert abs(pacer.delay - 0.5) < 1e-9
+        pacer.set_bounds(0.001, 0.2)
+        assert abs(pacer.delay - 0.2) < 1e-9
+        assert pacing.Pacer(0, 1).max_rate == pacing.BUS_FRAME_RATE
+
+    def test_aimd(self):
+        pacer = self.pacer
+        rate = pacer.rate
+        pacer.on_sent()
+        assert pacer.rate > rate
+        rate = pacer.rate
+        pacer.on_loss()
+        assert pacer.rate == rate * pacing.DECREASE
+
+    def test_holdoff(self):
+        self.holdoff.stop()
+        rate = self.pacer.rate
+        self.pacer.on_error()
+        self.pacer.on_error()
+        assert self.pacer.rate == rate * pacing.DECREASE
+        assert self.pacer.n_errors == 2
+        self.holdoff.start()
+
+    def test_slow_ack(self):
+        pacer = self.pacer
+        with mock.patch.object(pacing.time, 'time', side_effect=[0, 0.01, 1, 1.01, 2, 2.5, 2.5]):
+            for _ in range(3):
+                pacer.on_block_sent()
+                pacer.on_ack()
+        assert pacer.n_slow_acks == 1
+
+    def test_send_retries(self):
+        send = mock.Mock(side_effect=[can.CanError('buffer full'), None])
+        with mock.patch.object(pacing.time, 'sleep'):
+            self.pacer.send(send, [1, 2])
+            assert send.call_count == 2
+            assert self.pacer.n_errors == 1
+            send = mock.Mock(side_effect=can.CanError('bus off'))
+            self.assertRaises(can.CanError, self.pacer.send, send)
+        assert send.call_count == pacing.SEND_RETRIES
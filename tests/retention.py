@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from sensor import retention
+
+
+class TestFrameRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp()
+        self.image = (np.random.RandomState(0).rand(64, 64) * 255).astype('uint8')
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def get_frames(self, **kwargs):
+        kwargs.setdefault('quota_mb', 0)
+        kwargs.setdefault('max_age_days', 0)
+        kwargs.setdefault('keep_empty', retention.KEEP_ALL)
+        kwargs.setdefault('evict_low_space', False)
+        return retention.FrameRetention(self.image_dir, min_free_mb=0, **kwargs)
+
+    def save(self, frames, i):
+        path = os.path.join(self.image_dir, '%03d.png' % i)
+        frames.save(path, self.image)
+        return path
+
+    def test_quota_evicts_oldest(self):
+        frames = self.get_frames()
+        self.save(frames, 0)
+        frame_mb = frames.total_bytes / 1024 / 1024
+        frames.quota_bytes = 3.5 * frame_mb * 1024 * 1024
+        paths = [self.save(frames, i) for i in range(1, 6)]
+        frames.evict()
+        assert list(frames.frames) == paths[-3:]
+        assert sorted(os.listdir(self.image_dir)) == [os.path.basename(p) for p in paths[-3:]]
+
+    def test_scan_and_age(self):
+        frames = self.get_frames()
+        paths = [self.save(frames, i) for i in range(3)]
+        old = time.time() - 3 * 24 * 3600
+        os.utime(paths[0], (old, old))
+        frames = self.get_frames(max_age_days=1)
+        assert list(frames.frames) == paths
+        frames.evict()
+        assert list(frames.frames) == paths[1:]
+
+    def test_keep_empty(self):
+        frames = self.get_frames(keep_empty=retention.KEEP_THUMBNAIL)
+        path = self.save(frames, 0)
+        frames.set_detections(path, 0)
+        assert os.listdir(self.image_dir) == ['000_thumb.png']
+        frames.keep_empty = retention.KEEP_NONE
+        path = self.save(frames, 1)
+        frames.set_detections(path, 2)
+        assert os.path.isfile(path)
+        path = self.save(frames, 2)
+        frames.set_detections(path, 0)
+        assert not os.path.isfile(path)
+
+    def test_low_space_stops_saving(self):
+        frames = self.get_frames()
+        paths = [self.save(frames, i) for i in range(3)]
+        # quota and age are unlimited, the disk is full
+        frames = retention.FrameRetention(self.image_dir, quota_mb=0, max_age_days=0, keep_empty=retention.KEEP_ALL,
+                                          min_free_mb=float('inf'), evict_low_space=False)
+        assert not frames.save(os.path.join(self.image_dir, '003.png'), self.image)
+        assert list(frames.frames) == paths
+        assert sorted(os.listdir(self.image_dir)) == [os.path.basename(p) for p in paths]
+
+    def test_low_space_evicts_when_allowed(self):
+        frames = self.get_frames()
+        for i in range(3):
+            self.save(frames, i)
+        frames.evict_low_space = True
+        frames.min_free_mb = float('inf')
+        frames.evict()
+        assert list(frames.frames) == []
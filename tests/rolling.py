@@ -0,0 +1,29 @@
+import unittest
+
+import numpy as np
+
+from sensor import rolling
+
+
+class TestRollingStats(unittest.TestCase):
+
+    def test_windows_match_numpy(self):
+        values = np.random.RandomState(0).rand(1000) * 10
+        stats = rolling.RollingStats(100)
+        for i, value in enumerate(values, 1):
+            stats.add(value)
+            for w in [1, 10, 50]:
+                window = values[max(i - w, 0):i]
+                assert np.isclose(stats.sum(w), window.sum())
+                assert np.isclose(stats.mean(w), window.mean())
+                assert np.isclose(stats.var(w), window.var())
+
+    def test_rate_matches_tumbling_batches(self):
+        values = np.random.RandomState(1).rand(200)
+        stats = rolling.RollingStats(100)
+        for value in values[:99]:
+            stats.add(value)
+        assert stats.rate(50) is None
+        stats.add(values[99])
+        d0, d1 = values[:50].sum(), values[50:100].sum()
+        assert np.isclose(stats.rate(50), (d1 - d0) / d0)
@@ -0,0 +1,52 @@
+import time
+import unittest
+
+from sensor.canbus import pacing, sender
+
+
+class TestSender(unittest.TestCase):
+
+    def setUp(self):
+        self.sender = sender.Sender(pacing.Pacer(0, 0))
+        self.sent = []
+
+    def tearDown(self):
+        self.sender.stop()
+
+    def test_priorities(self):
+        for i in range(3):
+            self.sender.send(sender.BULK, self.sent.append, ('bulk', i))
+        self.sender.call(sender.BULK, self.sent.append, ('bulk', 'done'))
+        self.sender.send(sender.STATE, self.sent.append, ('state', 0))
+        self.sender.send(sender.CONTROL, self.sent.append, ('control', 0))
+        self.sender.start()
+        self.sender.flush()
+        assert self.sent == [('control', 0), ('state', 0),
+                             ('bulk', 0), ('bulk', 1), ('bulk', 2), ('bulk', 'done')]
+
+    def test_drop_bulk(self):
+        self.sender.send(sender.BULK, self.sent.append, ('bulk', 0))
+        self.sender.send(sender.CONTROL, self.sent.append, ('control', 0))
+        self.sender.drop_bulk()
+        self.sender.send(sender.BULK, self.sent.append, ('bulk', 1))
+        self.sender.start()
+        self.sender.flush()
+        # control messages queued before the drop are still sent
+        assert self.sent == [('control', 0), ('bulk', 1)]
+
+    def test_errors(self):
+        def fail():
+            raise ValueError("not connected")
+
+        self.sender.start()
+        self.sender.call(sender.CONTROL, fail)
+        self.sender.send(sender.CONTROL, self.sent.append, 1)
+        self.sender.flush()
+        assert self.sent == [1]
+
+    def test_flush_timeout(self):
+        self.sender.call(sender.CONTROL, self.sent.append, 1)
+        start = time.time()
+        self.sender.flush(timeout=0.1)
+        assert time.time() - start < 1
+        assert self.sent == []
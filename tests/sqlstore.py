@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from sensor import sqlstore
+
+
+class TestDetectionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.db_root = tempfile.mkdtemp()
+        self.db_dir = os.path.join(self.db_root, '0')
+        os.makedirs(self.db_dir)
+        self.store = sqlstore.DetectionStore(sqlstore.store_path(self.db_dir))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.db_root)
+
+    def fill(self, n_frames, n_diams):
+        diams = np.random.RandomState(0).rand(n_diams) * 50
+        for idx in range(n_frames):
+            self.store.insert_many({
+                'snaps': [(idx, 'img_%d.jpg' % idx, 1000.0 + idx, idx % 10, diams.mean(), 30000, 0.1)],
+                'diams': [(idx, d) for d in diams.tolist()],
+            })
+
+    def test_queries(self):
+        self.fill(100, 5)
+        rows = self.store.snaps(time_from=1010, time_to=1020)
+        assert [r[0] for r in rows] == list(range(10, 20))
+        rows = self.store.snaps(min_particles=9)
+        assert [r[0] for r in rows] == list(range(9, 100, 10))
+        assert len(self.store.diams(5)) == 5
+        found = list(sqlstore.query_snaps(self.db_root, idx_from=98))
+        assert [(d, r[0]) for d, r in found] == [(self.db_dir, 98), (self.db_dir, 99)]
+
+    def test_export_text(self):
+        self.fill(3, 2)
+        with open(sqlstore.export_snaps(self.db_dir)) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 3
+        assert lines[0].split(';')[:3] == ['0', 'img_0.jpg', '0']
+
+    def test_benchmark_writes(self):
+        n_frames, n_diams = 500, 50
+        diams = np.random.RandomState(0).rand(n_diams) * 50
+
+        start = time.time()
+        text_path = os.path.join(self.db_dir, 'data.db')
+        for idx in range(n_frames):
+            with open(text_path, 'a') as f:
+                for diam in diams:
+                    f.write('%d;%s;%s\n' % (idx, 'img.jpg', diam))
+        text_rate = n_frames * n_diams / (time.time() - start)
+
+        start = time.time()
+        batch = []
+        for idx in range(n_frames):
+            batch += [(idx, d) for d in diams.tolist()]
+            if len(batch) >= 1000:
+                self.store.insert('diams', batch)
+                batch = []
+        self.store.insert('diams', batch)
+        sqlite_rate = n_frames * n_diams / (time.time() - start)
+        assert self.store.count('diams') == n_frames * n_diams
+        print("text: %d rows/s, sqlite: %d rows/s" % (text_rate, sqlite_rate))
@@ -0,0 +1,33 @@
+import struct
+import unittest
+from unittest import mock
+
+from sensor.canbus import state
+from sensor.canbus.requests import REQUEST
+from sensor.canbus.transfer import TRANSFER
+
+MIN_DELAY, MAX_DELAY = 4, 5
+
+
+class TestDelayParams(unittest.TestCase):
+
+    def setUp(self):
+        self.can_app = mock.Mock()
+        self.handler = state.StateHandler(self.can_app)
+        self.handler.min_delay, self.handler.max_delay = 0.002, 0.5
+        self.handler.pacer.set_bounds(0.002, 0.5)
+        patch = mock.patch.object(state.StateHandler, 'set_config_key')
+        self.set_config_key = patch.start()
+        self.addCleanup(patch.stop)
+
+    def set_param(self, param_id, value):
+        self.handler.set_param(param_id, struct.pack('>f', value))
+        return self.can_app.cmd_res.call_args[0][0]
+
+    def test_delay_bounds(self):
+        assert self.set_param(MIN_DELAY, 0.01) == [REQUEST.SET_PARAM, TRANSFER.OK]
+        assert abs(self.handler.pacer.max_rate - 100) < 1e-3
+        for param_id, value in [(MIN_DELAY, 1.0), (MAX_DELAY, 0.005), (MAX_DELAY, -1)]:
+            assert self.set_param(param_id, value) == [REQUEST.SET_PARAM, TRANSFER.ERROR]
+        assert abs(self.handler.max_delay - 0.5) < 1e-6
+        self.set_config_key.assert_called_once()
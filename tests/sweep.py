@@ -0,0 +1,47 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sensor.detector import sweep
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.results_path = os.path.join(self.out_dir, 'sweep.jsonl')
+        path = os.path.join(os.path.dirname(__file__), 'data', 'shapes')
+        self.groups = {'a': [os.path.join(path, 'shapes_0.jpg')], 'b': [os.path.join(path, 'shapes_1.jpg')]}
+        self.param_sets = [{'maxThreshold': t} for t in [150, 200, 250]]
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def run_sweep(self, mask=None):
+        return sweep.Sweep(self.groups, self.param_sets, self.results_path, mask=mask, workers=2).run()
+
+    def read_rows(self):
+        with open(self.results_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_resume_and_retry_errors(self):
+        best = self.run_sweep()
+        assert len(best) == 3
+        rows = self.read_rows()
+        # failed set is run again, finished ones aren't
+        failed = {'hash': rows[0]['hash'], 'params': rows[0]['params'], 'error': 'ValueError()'}
+        with open(self.results_path, 'a') as f:
+            f.write(json.dumps(failed) + '\n')
+        assert self.run_sweep() == best
+        rows = self.read_rows()
+        assert len(rows) == 5
+        assert rows[-1]['hash'] == failed['hash'] and 'score' in rows[-1]
+
+    def test_mask_is_part_of_the_key(self):
+        self.run_sweep()
+        self.run_sweep(mask=80)
+        rows = self.read_rows()
+        assert len(rows) == 6
+        assert len({row['hash'] for row in rows}) == 6
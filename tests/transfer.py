@@ -1,7 +1,34 @@
+import binascii
+import collections
+import functools
 import os
+import shutil
+import sys
+import tempfile
+import time
+import types
 import unittest
+from unittest import mock
 
-from sensor.canbus import transfer
+import j1939
+
+from sensor import utils
+from sensor.canbus import pacing, transfer
+from sensor.canbus.requests import REQUEST
+
+try:
+    from sensor.canbus import app as can_app
+except ImportError:
+    # off Ubuntu and Windows sensor.proxy drives the gpio, the app only needs its bus type here
+    sys.modules['sensor.proxy'] = types.SimpleNamespace(bustype='virtual')
+    try:
+        from sensor.canbus import app as can_app
+    finally:
+        del sys.modules['sensor.proxy']
+
+# [s] delay between chunks and between TP packets of the benchmark
+BUS_DELAY = 0.002
+BUS_TIMEOUT = 60
 
 
 class TestTxRx(unittest.TestCase):
@@ -34,11 +61,11 @@ class TestTxRx(unittest.TestCase):
             blocks.append([n_chk, crc, chunks])
 
         for n_chk, crc, chunks in blocks:
-            file_rx.chunks = []
+            file_rx.clear_block()
             file_rx.supposed_crc = crc
             for chk in chunks:
                 file_rx.append_chunk(chk)
-            # print(len(file_rx.chunks), n_chk)
+            # print(file_rx.n_chunks, n_chk)
             if file_rx.block_complete(n_chk):
 
                 if file_rx.check_crc32():
@@ -56,3 +83,332 @@ class TestTxRx(unittest.TestCase):
         chunks_a = list(file_tx.read_chunks())
         chunks_b = list(file_tx.read_chunks())
         assert (chunks_a == chunks_b)
+
+    def test_nack(self):
+        for missing in [[0], [5], [3, 4, 11], [0, 219], list(range(100, 220, 7))]:
+            assert transfer.unpack_nack(transfer.pack_nack(missing)) == missing
+        # one lost chunk fits a single frame
+        assert len(transfer.pack_nack([150])) == 2
+        assert transfer.unpack_nack(transfer.pack_nack([])) == []
+
+    def test_place_chunks(self):
+        file_tx = self.file_tx
+        file_rx = self.file_rx
+        file_tx.read_next()
+        n_chk = file_tx.count_chunks()
+        for i in reversed(range(n_chk)):
+            if i not in (3, 7):
+                file_rx.place_chunk(i, file_tx.get_chunk(i))
+        assert file_rx.missing_chunks(n_chk) == [3, 7]
+        for i in (3, 7):
+            file_rx.place_chunk(i, file_tx.get_chunk(i))
+        assert file_rx.missing_chunks(n_chk) == []
+        assert file_rx.get_block() == file_tx.block
+        assert file_rx.check_crc32() is False
+        file_rx.supposed_crc = file_tx.get_crc32()
+        assert file_rx.check_crc32()
+        file_rx.clear_block()
+        for i, data in [(-1, b'x'), (transfer.TRANSFER.MAX_CHUNKS, b'x'), (0, bytes(7))]:
+            assert not file_rx.place_chunk(i, data)
+        assert file_rx.missing_chunks(n_chk) == list(range(n_chk))
+        assert file_rx.missing_chunks(n_chk) == list(range(n_chk))
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'snaps.db')
+        self.dest = os.path.join(self.tmp_dir, 'dest', 'snaps.db')
+        with open(self.src, 'w') as f:
+            for idx in range(3000):
+                f.write('%d;/photos/img_%06d.jpg;%d;%f;%d;%f\n' % (idx, idx, idx % 7, idx * 0.37, 50, idx * 0.01))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def check_transfer(self, mode, corrupt_block=None):
+        file_tx = transfer.FileTx(self.src, transfer.TRANSFER.BLOCK_SIZE, transfer.get_codec(mode))
+        file_rx = transfer.FileRx(self.dest, transfer.get_codec(mode))
+        i = 0
+        while True:
+            try:
+                block = file_tx.read_next()
+            except StopIteration:
+                break
+            file_rx.supposed_crc = file_tx.get_crc32()
+            if i == corrupt_block:
+                file_rx.set_block(bytes(len(block)))
+                assert not file_rx.check_crc32()
+            file_rx.set_block(block)
+            assert file_rx.check_crc32()
+            file_rx.write_block()
+            i += 1
+        file_tx.close()
+        file_rx.close()
+        with open(self.src, 'rb') as src, open(self.dest, 'rb') as dest:
+            assert src.read() == dest.read()
+        assert file_tx.raw_bytes == file_rx.raw_bytes
+        assert file_tx.sent_bytes == file_rx.received_bytes
+        print("%s: %s" % (mode, file_rx.summary()))
+        return file_tx.raw_bytes / file_tx.sent_bytes
+
+    def test_zlib(self):
+        assert self.check_transfer(transfer.MODE.ZLIB, corrupt_block=2) > 3
+
+    def test_lzma(self):
+        assert self.check_transfer(transfer.MODE.LZMA) > 3
+
+    def test_uncompressed(self):
+        assert self.check_transfer(transfer.MODE.CHUNKED) == 1
+
+    def test_negotiate(self):
+        assert transfer.negotiate_mode(transfer.MODE.COMPRESSED) == transfer.MODE.ZLIB
+        assert transfer.negotiate_mode(transfer.MODE.LZMA | transfer.MODE.BULK) == transfer.MODE.LZMA | transfer.MODE.BULK
+        assert transfer.negotiate_mode(0x80) == transfer.MODE.CHUNKED
+
+
+class TestRxThroughput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src.db')
+        self.dest = os.path.join(self.tmp_dir, 'dest.db')
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(4 * 1024 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_benchmark_receive(self):
+        file_tx = transfer.FileTx(self.src)
+        blocks = []
+        for block in file_tx.read_blocks():
+            file_tx.block = block
+            blocks.append((file_tx.count_chunks(), file_tx.get_crc32(), list(file_tx.read_chunks())))
+        file_tx.close()
+        n_bytes = os.path.getsize(self.src)
+
+        # previous receive path: list of chunks joined by reduce
+        start = time.time()
+        for n_chk, crc, chunks in blocks:
+            received = []
+            for chk in chunks:
+                received += [bytes(chk)]
+            block = functools.reduce(lambda a, b: a + b, received, bytes())
+            assert binascii.crc32(block, 0) == crc
+        list_rate = n_bytes / (time.time() - start)
+
+        start = time.time()
+        file_rx = transfer.FileRx(self.dest)
+        for n_chk, crc, chunks in blocks:
+            file_rx.supposed_crc = crc
+            for chk in chunks:
+                file_rx.append_chunk(chk)
+            assert file_rx.block_complete(n_chk) and file_rx.check_crc32()
+            file_rx.write_block()
+            file_rx.clear_block()
+        file_rx.close()
+        buffer_rate = n_bytes / (time.time() - start)
+
+        with open(self.src, 'rb') as src, open(self.dest, 'rb') as dest:
+            assert src.read() == dest.read()
+        print("Receive: list %.1f MB/s, buffer %.1f MB/s" % (list_rate / 1e6, buffer_rate / 1e6))
+
+
+def connect_app(channel, address, client_mode=False):
+    """ CanApp on a virtual bus, as app.init_app() """
+    name = j1939.Name(arbitrary_address_capable=1, manufacturer_code=666, identity_number=address)
+    ecu = j1939.ElectronicControlUnit()
+    can_app.set_bam_interval(ecu, BUS_DELAY)
+    ecu.connect(bustype='virtual', channel=channel)
+    cnt = can_app.CanApp(name, address, client_mode=client_mode)
+    ecu.add_ca(controller_application=cnt)
+    cnt.start()
+    set_pacer(cnt, pacing.Pacer(BUS_DELAY, BUS_DELAY))
+    return cnt
+
+
+def set_pacer(cnt, pacer):
+    cnt.state_handler.pacer = cnt.sender.pacer = pacer
+
+
+def close_app(cnt):
+    cnt.stop()
+    cnt._ecu.disconnect()
+
+
+class BusProbe:
+    """ Counts and loses transfer frames of a CanApp """
+
+    def __init__(self, cnt):
+        # every drop_every-th chunk response is lost
+        self.drop_every = 0
+        # {arg id: number of data responses with it to lose}
+        self.drop_args = collections.Counter()
+        self.n_chunks = 0
+        self.n_finished = 0
+        # receive times of GET_PARAM responses
+        self.param_times = []
+        self._send_message = cnt.send_message
+        self._response_get_bytes = cnt.transfer_handler.response_get_bytes
+        self._client_get_param = cnt.state_handler.client_get_param
+        cnt.send_message = self.send_message
+        cnt.transfer_handler.response_get_bytes = self.response_get_bytes
+        cnt.state_handler.client_get_param = self.client_get_param
+
+    def send_message(self, priority, pgn, data):
+        if pgn == can_app.PGN.RESPONSE and data[0] == REQUEST.GET_BYTES:
+            arg_id = data[1]
+            if self.drop_args[arg_id] > 0:
+                self.drop_args[arg_id] -= 1
+                return
+            if 0 < arg_id <= transfer.TRANSFER.MAX_CHUNKS:
+                self.n_chunks += 1
+                if self.drop_every and self.n_chunks % self.drop_every == 0:
+                    return
+        self._send_message(priority, pgn, data)
+
+    def response_get_bytes(self, arg_id, data):
+        self._response_get_bytes(arg_id, data)
+        if arg_id == transfer.TRANSFER.STOP:
+            self.n_finished += 1
+
+    def client_get_param(self, *args):
+        self.param_times.append(time.time())
+        self._client_get_param(*args)
+
+
+class TestBusTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.patches = [mock.patch.object(utils.Pathing, 'db_root', os.path.join(self.root, 'dbs')),
+                        mock.patch.object(utils.Pathing, 'codes_root', self.root)]
+        for patch in self.patches:
+            patch.start()
+        db_dir = os.path.join(utils.Pathing.db_root, '0')
+        os.makedirs(db_dir)
+        self.data = os.urandom(8 * 1024)
+        with open(os.path.join(db_dir, 'snaps.db'), 'wb') as f:
+            f.write(self.data)
+
+        channel = 'transfer_%d' % id(self)
+        self.server = connect_app(channel, 10)
+        self.client = connect_app(channel, 20, client_mode=True)
+        self.server_bus, self.client_bus = BusProbe(self.server), BusProbe(self.client)
+        end = time.time() + BUS_TIMEOUT
+        normal = j1939.ControllerApplication.State.NORMAL
+        while not (self.server.state == normal and self.client.state == normal) and time.time() < end:
+            time.sleep(0.05)
+
+    def tearDown(self):
+        close_app(self.server)
+        close_app(self.client)
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def transfer(self, modes, keep=False):
+        """ Transfer db #0 from server to client, bytes/s """
+        dest = os.path.join(utils.Pathing.codes_root, 'transfer', '0', 'snaps.db')
+        if os.path.isfile(dest) and not keep:
+            os.remove(dest)
+        n_finished = self.client_bus.n_finished
+        start = time.time()
+        self.client.cmd_get_file(0, modes)
+        while self.client_bus.n_finished == n_finished and time.time() - start < BUS_TIMEOUT:
+            time.sleep(0.01)
+        seconds = time.time() - start
+        with open(dest, 'rb') as f:
+            assert f.read() == self.data
+        return len(self.data) / seconds
+
+    def test_chunked_and_bulk(self):
+        chunked = self.transfer(transfer.MODE.CHUNKED)
+        assert self.server.transfer_handler.mode == transfer.MODE.CHUNKED
+        bulk = self.transfer(transfer.MODE.BULK)
+        assert self.client.transfer_handler.mode == transfer.MODE.BULK
+        print("Virtual bus transfer: chunked %.0f B/s, bulk %.0f B/s" % (chunked, bulk))
+
+    def test_adaptive_pacing(self):
+        set_pacer(self.server, pacing.Pacer(0, 0.1))
+        self.server_bus.drop_every = 300
+        rate = self.transfer(transfer.MODE.SEQUENCED)
+        pacer = self.server.state_handler.pacer
+        print("Virtual bus transfer with adaptive pacing: %.0f B/s, %s" % (rate, pacer))
+        assert pacer.n_losses > 0
+        assert pacer.n_sent >= len(self.data) // transfer.TRANSFER.CHUNK_SIZE
+
+    def test_control_during_transfer(self):
+        n_finished = self.client_bus.n_finished
+        self.client.cmd_get_file(0, transfer.MODE.CHUNKED)
+        time.sleep(0.5)
+        assert self.client_bus.n_finished == n_finished
+        sent = time.time()
+        self.server.cmd_res([REQUEST.GET_PARAM, 1, 0, 0, 0, 0])
+        while not self.client_bus.param_times and time.time() - sent < BUS_TIMEOUT:
+            time.sleep(0.001)
+        latency = self.client_bus.param_times[0] - sent
+        print("Control message latency during transfer: %.1f ms" % (1000 * latency))
+        # sent ahead of the queued chunks of the block
+        assert latency < 20 * BUS_DELAY
+        while self.client_bus.n_finished == n_finished and time.time() - sent < BUS_TIMEOUT:
+            time.sleep(0.01)
+        assert self.client_bus.n_finished > n_finished
+
+    def test_resume(self):
+        modes = transfer.MODE.SEQUENCED | transfer.MODE.RESUME
+        self.transfer(modes)
+        n_chunks = self.server_bus.n_chunks
+        server_db = os.path.join(utils.Pathing.db_root, '0', 'snaps.db')
+        new_rows = os.urandom(600)
+        with open(server_db, 'ab') as f:
+            f.write(new_rows)
+        self.data += new_rows
+        self.transfer(modes, keep=True)
+        # only the tail is sent
+        assert self.server_bus.n_chunks - n_chunks == len(new_rows) // transfer.TRANSFER.CHUNK_SIZE
+
+        # changed start of the file is sent again
+        self.data = b'changed' + self.data[7:]
+        with open(server_db, 'wb') as f:
+            f.write(self.data)
+        n_chunks = self.server_bus.n_chunks
+        self.transfer(modes, keep=True)
+        assert self.server_bus.n_chunks - n_chunks == -(-len(self.data) // transfer.TRANSFER.CHUNK_SIZE)
+
+    def test_compressed(self):
+        self.data = ''.join('%d;/photos/img_%06d.jpg;%d;%f;50;0.0\n' % (i, i, i % 7, i * 0.37) for i in range(400)).encode()
+        with open(os.path.join(utils.Pathing.db_root, '0', 'snaps.db'), 'wb') as f:
+            f.write(self.data)
+        raw = self.transfer(transfer.MODE.BULK)
+        compressed = self.transfer(transfer.MODE.BULK | transfer.MODE.ZLIB)
+        assert self.client.transfer_handler.mode == transfer.MODE.BULK | transfer.MODE.ZLIB
+        print("Virtual bus transfer of text: raw %.0f B/s, zlib %.0f B/s" % (raw, compressed))
+        assert compressed > raw
+
+    def test_sequenced_lost_chunks(self):
+        self.server_bus.drop_every = 100
+        self.transfer(transfer.MODE.SEQUENCED)
+        n_chunks = -(-len(self.data) // transfer.TRANSFER.CHUNK_SIZE)
+        # only lost chunks are sent again
+        n_lost = n_chunks // (self.server_bus.drop_every - 1) + 1
+        assert self.server_bus.n_chunks <= n_chunks + n_lost
+
+    @mock.patch('sensor.canbus.transfer.RX_TIMEOUT', 0.5)
+    def test_lost_checksum_and_stop(self):
+        # receiver sends an empty NACK for the lost checksum, requests the file again for the lost stop
+        self.server_bus.drop_args[transfer.TRANSFER.CHECKSUM] = 1
+        self.server_bus.drop_args[transfer.TRANSFER.STOP] = 1
+        n_chunks = -(-len(self.data) // transfer.TRANSFER.CHUNK_SIZE)
+        self.transfer(transfer.MODE.SEQUENCED | transfer.MODE.RESUME)
+        assert self.server_bus.n_chunks == n_chunks
+        assert self.client.transfer_handler.rx_timeouts == 0
+
+    @mock.patch('sensor.canbus.transfer.RX_TIMEOUT', 0.5)
+    def test_lost_chunk_resumes(self):
+        # chunks of a full block carry MAX_CHUNKS
+        self.server_bus.drop_args[transfer.TRANSFER.MAX_CHUNKS] = 1
+        self.transfer(transfer.MODE.CHUNKED | transfer.MODE.RESUME)
+        assert self.client.transfer_handler.rx_timeouts == 0